@@ -18,7 +18,7 @@ for i in $(seq 20)
 do
 	n=$(date +$(hostname)-%F-%H-%M-%S.h264)
 	raspivid -w 800 -h 600 -o $n -fps 25 -t $((60 * 60 * 1000))
-	scp $n pi@192.168.51.10:/mnt/movies/$n && rm $n
 done
 
+# Movies are pulled by transfer.py on the server (see retrieve_movies.sh)
 rm $RUN_FILE
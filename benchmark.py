@@ -0,0 +1,359 @@
+# benchmark.py
+# Renders synthetic arena videos with known trajectories, then measures
+# throughput and accuracy of multi_tracker on them.
+
+import argparse
+import cv2
+import itertools
+import json
+from multiprocessing import Pool
+from multi_tracker import process_video, read_traj_rows, write_traj_rows, \
+    count_id_switches, create_dir
+import numpy as np
+import os
+import resource
+
+
+def simulate_trajectories(bee_number, frames, radius, speed=40.0, fps=25.0,
+                          turn_sd=0.3, stop_prob=0.01, start_prob=0.02,
+                          min_separation=0.0, seed=0):
+    '''
+    Simulates bees walking inside a circular arena as correlated random walks
+    which stop and start at random. Bees turn back towards the centre when
+    they reach the wall.
+    Args:
+        bee_number - integer number of bees
+        frames - integer number of frames
+        radius - radius (pixels) of area bees may walk in
+        speed - walking speed in pixels per second
+        fps - frames per second
+        turn_sd - standard deviation of heading change per frame (radians)
+        stop_prob - probability per frame of a walking bee stopping
+        start_prob - probability per frame of a stopped bee walking
+        min_separation - bees closer than this (pixels) are pushed apart. By
+                         default bees may walk over each other (collisions).
+        seed - random seed
+    Returns:
+        array with shape (frames, bee_number, 2) of row, column coordinates
+        relative to centre of arena
+    '''
+    rng = np.random.RandomState(seed)
+    r = radius * np.sqrt(rng.uniform(0, 0.8, bee_number))
+    a = rng.uniform(0, 2 * np.pi, bee_number)
+    pos = np.column_stack((r * np.sin(a), r * np.cos(a)))
+    heading = rng.uniform(0, 2 * np.pi, bee_number)
+    walking = np.ones(bee_number, dtype=bool)
+    step = speed / fps
+
+    traj = np.zeros((frames, bee_number, 2))
+    for f in range(frames):
+        u = rng.uniform(size=bee_number)
+        walking = np.where(walking, u > stop_prob, u < start_prob)
+        heading += rng.normal(0, turn_sd, bee_number)
+        pos += walking[:, None] * step * np.column_stack((np.sin(heading),
+                                                          np.cos(heading)))
+
+        # Turn back from the wall
+        dist = np.sqrt(np.sum(pos ** 2, axis=1))
+        out = dist > radius
+        if out.any():
+            pos[out] *= (radius / dist[out])[:, None]
+            heading[out] = np.arctan2(-pos[out, 0], -pos[out, 1]) + \
+                rng.normal(0, 0.5, out.sum())
+
+        # Push apart bees which are too close
+        if min_separation > 0:
+            for i, j in itertools.combinations(range(bee_number), 2):
+                d = pos[i] - pos[j]
+                n = np.sqrt(np.sum(d ** 2))
+                if 0 < n < min_separation:
+                    push = 0.5 * (min_separation - n) * d / n
+                    pos[i] += push
+                    pos[j] -= push
+
+        traj[f] = pos
+
+    return traj
+
+
+def gaussian_blob(sigma):
+    '''
+    Returns a square image of a Gaussian with peak 1.0 and radius 3 * sigma.
+    '''
+    radius = int(np.ceil(3 * sigma))
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    g = np.exp(-x ** 2 / (2 * sigma ** 2))
+
+    return np.outer(g, g)
+
+
+def add_blob(image, blob, row, col, amplitude):
+    '''
+    Adds amplitude * blob to image centred at (row, col), clipping at edges.
+    '''
+    radius = blob.shape[0] / 2
+    r, c = int(round(row)), int(round(col))
+    r0, r1 = max(r - radius, 0), min(r + radius + 1, image.shape[0])
+    c0, c1 = max(c - radius, 0), min(c + radius + 1, image.shape[1])
+    if r0 >= r1 or c0 >= c1:
+        return None
+    image[r0:r1, c0:c1] += amplitude * blob[r0 - r + radius:r1 - r + radius,
+                                            c0 - c + radius:c1 - c + radius]
+    return None
+
+
+def render_video(path, traj, frame_size=(800, 600), centre=(300, 400),
+                 radius=250, bee_sigma=8.0, contrast=90.0, noise_sd=4.0,
+                 reflection=0.3, fps=25.0, seed=0):
+    '''
+    Renders a synthetic arena video: a bright Petri-dish disc with a glare rim
+    on a dark background, dark Gaussian blobs for bees, faint reflections of
+    bees near the rim and Gaussian pixel noise.
+    Args:
+        path - path of output video (.avi)
+        traj - array returned by simulate_trajectories
+        frame_size - (width, height) of video
+        centre - (row, column) of centre of dish
+        radius - radius of dish (pixels)
+        bee_sigma - standard deviation of bee blobs (pixels)
+        contrast - depth of bee blobs (grey levels)
+        noise_sd - standard deviation of pixel noise (grey levels)
+        reflection - strength of reflections relative to contrast, 0 disables
+        fps - frames per second of video
+        seed - random seed for noise
+    Returns:
+        ground truth trajectory rows in the format of
+        MultiKalman.write_coords, in full frame coordinates
+    '''
+    rng = np.random.RandomState(seed)
+    w, h = frame_size
+    background = np.zeros((h, w), dtype=np.float32) + 40
+    cv2.circle(background, (centre[1], centre[0]), radius, 160, -1)
+    cv2.circle(background, (centre[1], centre[0]), radius, 210, 3)
+    background = cv2.GaussianBlur(background, (0, 0), 2)
+    blob = gaussian_blob(bee_sigma)
+    bee_radius = 3 * bee_sigma
+
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps,
+                          frame_size)
+    frames, bee_number = traj.shape[:2]
+    rows = np.zeros((frames, 1 + 3 * bee_number))
+    rows[:, 0] = (np.arange(frames) + 1) / fps
+    rows[:, 1::3] = np.arange(bee_number)
+    rows[:, 2::3] = traj[:, :, 0] + centre[0]
+    rows[:, 3::3] = traj[:, :, 1] + centre[1]
+
+    for f in range(frames):
+        image = background.copy()
+        for b in range(bee_number):
+            add_blob(image, blob, rows[f, 2 + 3 * b], rows[f, 3 + 3 * b],
+                     -contrast)
+
+            # Mirror image of bee in the dish wall
+            d = np.sqrt(np.sum(traj[f, b] ** 2))
+            if reflection > 0 and radius - d < bee_radius and d > 0:
+                mirror = traj[f, b] * (2 * radius - d) / d
+                add_blob(image, blob, mirror[0] + centre[0],
+                         mirror[1] + centre[1], -contrast * reflection)
+        if noise_sd > 0:
+            image += rng.normal(0, noise_sd, image.shape).astype(np.float32)
+        gray = np.clip(image, 0, 255).astype(np.uint8)
+        out.write(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+
+    out.release()
+    return rows
+
+
+def to_frame_coords(rows, roi, scale):
+    '''
+    Converts tracker output coordinates (scaled, relative to region of
+    interest) to full frame coordinates. Tracks not yet found stay at 0, 0.
+    '''
+    rows = rows.copy()
+    found = (rows[:, 2::3] != 0) | (rows[:, 3::3] != 0)
+    rows[:, 2::3] = np.where(found, rows[:, 2::3] / scale + roi[0], 0)
+    rows[:, 3::3] = np.where(found, rows[:, 3::3] / scale + roi[1], 0)
+
+    return rows
+
+
+def run_case(case):
+    '''
+    Tracks a synthetic video and compares the result to its ground truth. Run
+    in a fresh worker process so peak memory belongs to this case only.
+    Args:
+        case - dictionary with keys video, truth, bee_number, sigma, scale,
+               roi, max_dist, fps, outpath
+    Returns:
+        dictionary of case parameters and results
+    '''
+    result = process_video(case['video'], case['bee_number'],
+                           case['sigma'] * case['scale'], roi=case['roi'],
+                           scale=case['scale'], show_video=-1, fps=case['fps'],
+                           max_dist=case['max_dist'] * case['scale'],
+                           quiet=True, outpath=case['outpath'])
+    rows = to_frame_coords(read_traj_rows(result[1]), case['roi'],
+                           case['scale'])
+    truth = read_traj_rows(case['truth'])
+    switches, matches, error = count_id_switches(rows, truth, case['fps'],
+                                                 case['max_dist'])
+
+    out = dict((key, case[key]) for key in ('bee_number', 'sigma', 'scale'))
+    out['fps'] = result[3]
+    out['peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    # count_id_switches gives an error of 0 without matches, which would make
+    # a run that tracked nothing look perfect
+    out['loc_error'] = error if matches > 0 else np.nan
+    out['id_switches'] = switches
+    out['detected'] = matches / float(truth.shape[0] * case['bee_number'])
+
+    return out
+
+
+def read_params(path):
+    '''
+    Returns:
+        dictionary of rendering parameters of a synthetic video, None if path
+        does not exist
+    '''
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as params_file:
+        return json.load(params_file)
+
+
+def run_benchmark(out_dir, bee_numbers=(1, 2, 4), sigmas=(12, 16, 20),
+                  scales=(0.5, 1.0), frames=1500, speed=40.0, noise_sd=4.0,
+                  reflection=0.3, bee_sigma=8.0, max_dist=25, fps=25.0):
+    '''
+    Renders a synthetic video for each bee number and tracks it for every
+    sigma and scale. A video is reused only if it was rendered with the same
+    parameters, which are recorded in <video>-params.json.
+    Args:
+        out_dir - directory for videos, ground truth and results
+        bee_numbers - numbers of bees to render videos for
+        sigmas - sigma values for laplacian of gaussian kernel (unscaled)
+        scales - scale factors to process at
+        frames - number of frames per video
+        speed, noise_sd, reflection, bee_sigma - passed to
+            simulate_trajectories and render_video
+        max_dist - assignment distance threshold (unscaled), also used to
+                   match tracks to ground truth
+        fps - frames per second of videos
+    Returns:
+        list of result dictionaries (see run_case). Results are also written
+        to benchmark.csv in out_dir. Raises RuntimeError after writing them
+        if any case detected no bees.
+    '''
+    create_dir(out_dir)
+    centre, radius = (300, 400), 250
+    # The tracker only looks inside a circle of radius 0.55 * roi size
+    # (multi_tracker.get_roi_mask), so the roi is sized for that circle to lie
+    # inside the dish, clear of its rim and the dark surround, and bees walk
+    # inside the circle
+    mask_radius = radius - 2 * bee_sigma
+    half = int(mask_radius / 0.55) / 2
+    roi = [centre[0] - half, centre[1] - half, centre[0] + half,
+           centre[1] + half]
+    walk_radius = mask_radius - 2 * bee_sigma
+
+    cases = []
+    for bee_number in bee_numbers:
+        name = os.path.join(out_dir, 'synthetic-%ibees' % bee_number)
+        video, truth = name + '.avi', name + '-truth.csv'
+        params_path = name + '-params.json'
+        params = {'bee_number': bee_number, 'frames': frames, 'speed': speed,
+                  'noise_sd': noise_sd, 'reflection': reflection,
+                  'bee_sigma': bee_sigma, 'fps': fps, 'centre': list(centre),
+                  'radius': radius, 'walk_radius': walk_radius}
+        if not (os.path.isfile(video) and os.path.isfile(truth) and
+                read_params(params_path) == params):
+            print 'Rendering %s' % video
+            traj = simulate_trajectories(bee_number, frames, walk_radius,
+                                         speed=speed, fps=fps, seed=bee_number)
+            truth_rows = render_video(video, traj, centre=centre,
+                                      radius=radius, bee_sigma=bee_sigma,
+                                      noise_sd=noise_sd, reflection=reflection,
+                                      fps=fps, seed=bee_number)
+            with open(truth, 'w') as truth_file:
+                write_traj_rows(truth_rows, truth_file)
+            # Written last, so an interrupted render is not reused
+            with open(params_path, 'w') as params_file:
+                json.dump(params, params_file, indent=1, sort_keys=True)
+
+        for sigma, scale in itertools.product(sigmas, scales):
+            cases.append({'video': video, 'truth': truth,
+                          'bee_number': bee_number, 'sigma': sigma,
+                          'scale': scale, 'roi': roi, 'max_dist': max_dist,
+                          'fps': fps, 'outpath': out_dir})
+
+    results = []
+    print '{:>5} {:>6} {:>6} {:>8} {:>8} {:>8} {:>9} {:>9}'.format(
+        'bees', 'sigma', 'scale', 'FPS', 'peakMB', 'error', 'switches',
+        'detected')
+    for case in cases:
+        pool = Pool(1, maxtasksperchild=1)
+        res = pool.apply(run_case, (case,))
+        pool.close()
+        pool.join()
+        print '{bee_number:>5d} {sigma:>6.1f} {scale:>6.2f} {fps:>8.1f} ' \
+            '{peak_mb:>8.1f} {loc_error:>8.2f} {id_switches:>9d} ' \
+            '{detected:>9.3f}'.format(**res)
+        results.append(res)
+
+    columns = ['bee_number', 'sigma', 'scale', 'fps', 'peak_mb', 'loc_error',
+               'id_switches', 'detected']
+    with open(os.path.join(out_dir, 'benchmark.csv'), 'w') as csv_file:
+        csv_file.write(','.join(columns) + '\n')
+        for res in results:
+            csv_file.write(','.join(str(res[c]) for c in columns) + '\n')
+
+    failed = [res for res in results if res['detected'] == 0]
+    if len(failed) > 0:
+        raise RuntimeError('No bees detected in %s of %s cases: %s' % (
+            len(failed), len(results), ', '.join(
+                'bees=%(bee_number)s sigma=%(sigma)s scale=%(scale)s' % res
+                for res in failed)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Benchmark multi_tracker
+                                     on synthetic bee videos.''')
+
+    parser.add_argument('-b', nargs='+', default=[1, 2, 4], type=int,
+                        metavar='BeeNumber',
+                        help='Numbers of bees to render (default 1 2 4).')
+
+    parser.add_argument('-s', nargs='+', default=[12, 16, 20], type=float,
+                        metavar='Sigma',
+                        help='Sigma values to track with (default 12 16 20).')
+
+    parser.add_argument('-S', nargs='+', default=[0.5, 1.0], type=float,
+                        metavar='ScaleFactor',
+                        help='Scale factors to track at (default 0.5 1.0).')
+
+    parser.add_argument('-n', default=1500, type=int, metavar='Frames',
+                        help='Frames per synthetic video (default 1500).')
+
+    parser.add_argument('-v', default=40.0, type=float, metavar='Speed',
+                        help='Bee walking speed in pixels/s (default 40).')
+
+    parser.add_argument('-N', default=4.0, type=float, metavar='Noise',
+                        help='Pixel noise standard deviation (default 4).')
+
+    parser.add_argument('-r', default=0.3, type=float, metavar='Reflection',
+                        help='''Strength of reflections in dish wall, 0 to
+                        disable (default 0.3).''')
+
+    parser.add_argument('OutDir', type=str,
+                        help='Directory for videos and results.')
+
+    args = parser.parse_args()
+    run_benchmark(args.OutDir, bee_numbers=args.b, sigmas=args.s,
+                  scales=args.S, frames=args.n, speed=args.v, noise_sd=args.N,
+                  reflection=args.r)
+
+if __name__ == '__main__':
+    main()
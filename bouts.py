@@ -0,0 +1,292 @@
+# bouts.py
+# Bout statistics of decoded states ('state' from traj_hmm.decode_states or
+# 'thresh' from traj_hmm.thresh_decode, saved in store partitions by
+# traj_hmm.decode_partitions). A bout is a run of one state within a
+# trajectory. Runs are found vectorised, chunk by chunk, so processed files
+# and store partitions of any size are read in constant memory.
+
+import argparse
+import numpy as np
+import pandas as pd
+from post_process import iter_columns
+from traj_store import list_partitions, read_meta
+
+# Bout duration bin edges in seconds (the last bin includes longer bouts)
+DURATION_EDGES = np.append(0., np.logspace(-1, 5, 61))
+
+
+class BoutCounter:
+    '''
+    Accumulates bouts of each state from rows in trajectory order:
+        hist - array (n_states, bins) of bouts ending with a state change
+        censored_hist - array (n_states, bins) of censored bouts, which touch
+                        the start or end of a trajectory or an undecoded (-1)
+                        row, so are at least as long as measured
+        transitions - array (n_states, n_states) of direct state changes
+        time - array (n_states, ) of total time in each state
+        ended_time - array (n_states, ) of total duration of uncensored bouts
+    The duration of a bout is from its first row to the first row of the next
+    bout (to the last row of the trajectory for the last bout), as
+    traj_hmm.get_state_times.
+    '''
+    def __init__(self, edges=DURATION_EDGES, n_states=2):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        bins = len(self.edges) - 1
+        self.hist = np.zeros((n_states, bins), dtype=np.int64)
+        self.censored_hist = np.zeros((n_states, bins), dtype=np.int64)
+        self.transitions = np.zeros((n_states, n_states), dtype=np.int64)
+        self.time = np.zeros(n_states)
+        self.ended_time = np.zeros(n_states)
+        # Open run at the end of the last chunk: traj, state, start time,
+        # last time, left censored
+        self._carry = None
+
+    def _grow(self, n_states):
+        if n_states <= len(self.hist):
+            return
+        extra = n_states - len(self.hist)
+        self.hist = np.pad(self.hist, ((0, extra), (0, 0)), 'constant')
+        self.censored_hist = np.pad(self.censored_hist, ((0, extra), (0, 0)),
+                                    'constant')
+        self.transitions = np.pad(self.transitions, ((0, extra), (0, extra)),
+                                  'constant')
+        self.time = np.pad(self.time, (0, extra), 'constant')
+        self.ended_time = np.pad(self.ended_time, (0, extra), 'constant')
+
+    def _add_bouts(self, state, duration, censored):
+        keep = state >= 0
+        state = state[keep]
+        duration = duration[keep]
+        censored = censored[keep]
+        if len(state) == 0:
+            return
+        self._grow(state.max() + 1)
+        n_states, bins = self.hist.shape
+        b = np.clip(np.searchsorted(self.edges, duration, side='right') - 1,
+                    0, bins - 1)
+        key = state * bins + b
+        self.hist += np.bincount(key[~censored], minlength=n_states *
+                                 bins).reshape(n_states, bins)
+        self.censored_hist += np.bincount(key[censored], minlength=n_states *
+                                          bins).reshape(n_states, bins)
+        self.time += np.bincount(state, weights=duration, minlength=n_states)
+        self.ended_time += np.bincount(state[~censored],
+                                       weights=duration[~censored],
+                                       minlength=n_states)
+
+    def update(self, traj, t, state):
+        '''
+        Adds the next chunk of rows. Rows of a trajectory are contiguous and
+        in time order, and may be split across chunks.
+        Args:
+            traj - trajectory number of each row
+            t - time of each row
+            state - state of each row, -1 where not decoded
+        Returns:
+            None
+        '''
+        traj = np.asarray(traj, dtype=np.int64)
+        t = np.asarray(t, dtype=np.float64)
+        state = np.asarray(state, dtype=np.int64)
+        if len(t) == 0:
+            return None
+        left_first = True
+        if self._carry is not None:
+            # The open run is represented by its first and last rows
+            c_traj, c_state, c_start, c_last, left_first = self._carry
+            traj = np.concatenate(([c_traj, c_traj], traj))
+            t = np.concatenate(([c_start, c_last], t))
+            state = np.concatenate(([c_state, c_state], state))
+
+        changed = (traj[1:] != traj[:-1]) | (state[1:] != state[:-1])
+        starts = np.flatnonzero(np.insert(changed, 0, True))
+        prev = starts[1:] - 1
+        left = np.insert((traj[starts[1:]] != traj[prev]) | (state[prev] < 0),
+                         0, left_first)
+
+        # All runs but the last are complete
+        first = starts[:-1]
+        nxt = starts[1:]
+        same = traj[nxt] == traj[first]
+        end = np.where(same, t[nxt], t[nxt - 1])
+        self._add_bouts(state[first], end - t[first],
+                        left[:-1] | ~same | (state[nxt] < 0))
+
+        direct = same & (state[first] >= 0) & (state[nxt] >= 0)
+        if direct.any():
+            s0 = state[first][direct]
+            s1 = state[nxt][direct]
+            self._grow(max(s0.max(), s1.max()) + 1)
+            n_states = len(self.transitions)
+            self.transitions += np.bincount(
+                s0 * n_states + s1, minlength=n_states ** 2).reshape(
+                    n_states, n_states)
+
+        last = starts[-1]
+        self._carry = (traj[last], state[last], t[last], t[-1], left[-1])
+
+        return None
+
+    def finish(self):
+        '''
+        Adds the open run at the end of the data (as a censored bout).
+        '''
+        if self._carry is not None:
+            c_traj, c_state, c_start, c_last, c_left = self._carry
+            self._add_bouts(np.array([c_state]), np.array([c_last - c_start]),
+                            np.array([True]))
+            self._carry = None
+
+        return self
+
+    def add(self, other):
+        '''
+        Adds the bouts of another finished BoutCounter with the same edges
+        (eg. to combine days).
+        '''
+        assert np.array_equal(self.edges, other.edges)
+        self._grow(len(other.hist))
+        n = len(other.hist)
+        self.hist[:n] += other.hist
+        self.censored_hist[:n] += other.censored_hist
+        self.transitions[:n, :n] += other.transitions
+        self.time[:n] += other.time
+        self.ended_time[:n] += other.ended_time
+
+        return self
+
+    def survival(self):
+        '''
+        Kaplan-Meier estimate of bout duration survival for each state, at the
+        bin edges. Ending and censored bouts are grouped by bin, with censoring
+        taken to follow the ends in the same bin.
+        Returns:
+            edges, array of shape (n_states, len(edges)) of the probability
+            that a bout lasts at least each edge
+        '''
+        ended = self.hist.astype(np.float64)
+        total = ended + self.censored_hist
+        at_risk = total[:, ::-1].cumsum(axis=1)[:, ::-1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hazard = np.where(at_risk > 0, ended / at_risk, 0.)
+        surv = np.ones((len(ended), len(self.edges)))
+        surv[:, 1:] = np.cumprod(1. - hazard, axis=1)
+
+        return self.edges, surv
+
+    def summary(self):
+        '''
+        Returns:
+            DataFrame indexed by state with numbers of bouts and censored
+            bouts, total time, mean duration of uncensored bouts and median
+            duration (first edge where survival <= 0.5, NaN if none)
+        '''
+        edges, surv = self.survival()
+        bouts = self.hist.sum(axis=1)
+        median = np.full(len(surv), np.nan)
+        below = surv <= 0.5
+        found = below.any(axis=1)
+        median[found] = edges[below.argmax(axis=1)[found]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.ended_time / bouts
+        df = pd.DataFrame({'bouts': bouts,
+                           'censored': self.censored_hist.sum(axis=1),
+                           'time': self.time, 'mean_duration': mean,
+                           'median_duration': median},
+                          columns=['bouts', 'censored', 'time',
+                                   'mean_duration', 'median_duration'])
+        df.index.name = 'state'
+
+        return df
+
+
+def file_bouts(path, state_col='state', edges=DURATION_EDGES,
+               chunksize=1 << 20):
+    '''
+    Bout statistics of one processed trajectory csv file or store partition,
+    read in chunks (see post_process.iter_columns).
+    Args:
+        path - path of csv file or partition directory
+        state_col - 'state' or 'thresh'
+        edges - bout duration bin edges in seconds
+        chunksize - rows per chunk read from csv files
+    Returns:
+        finished BoutCounter
+    '''
+    counter = BoutCounter(edges=edges)
+    for df in iter_columns(path, ['traj', 't', state_col],
+                           chunksize=chunksize):
+        counter.update(df['traj'].values, df['t'].values,
+                       df[state_col].values)
+
+    return counter.finish()
+
+
+def store_bouts(store_dir, state_col='state', conditions=None,
+                edges=DURATION_EDGES):
+    '''
+    Bout statistics of each condition and day of a processed store (see
+    traj_store), one partition at a time. Partitions without state_col (not
+    yet decoded, see traj_hmm.decode_partitions) are skipped.
+    Args:
+        store_dir - root directory of store
+        state_col - 'state' or 'thresh'
+        conditions - conditions to include, by default all
+        edges - bout duration bin edges in seconds
+    Returns:
+        summary - DataFrame of BoutCounter.summary for each condition, date
+                  and state
+        counters - dictionary of BoutCounter with (condition, date) keys
+    '''
+    counters = {}
+    summaries = []
+    for condition, date, path in list_partitions(store_dir).values:
+        if conditions is not None and condition not in conditions:
+            continue
+        if state_col not in read_meta(path)['columns']:
+            print 'No %s column in condition %s, %s' % (state_col, condition,
+                                                        date)
+            continue
+        print 'Counting bouts in condition %s, %s' % (condition, date)
+        counter = file_bouts(path, state_col=state_col, edges=edges)
+        counters[(condition, date)] = counter
+        df = counter.summary().reset_index()
+        df.insert(0, 'date', date)
+        df.insert(0, 'condition', condition)
+        summaries.append(df)
+
+    if len(summaries) == 0:
+        return pd.DataFrame(), counters
+
+    return pd.concat(summaries, ignore_index=True), counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Summarise bouts of
+                                     decoded states for each condition and day
+                                     of a processed store.''')
+
+    parser.add_argument('-s', default='state', type=str, metavar='StateCol',
+                        help="State column, 'state' or 'thresh'.")
+
+    parser.add_argument('-c', default=None, type=int, nargs='+',
+                        metavar='Condition',
+                        help='Conditions to include (default all).')
+
+    parser.add_argument('-o', default=None, type=str, metavar='OutFile',
+                        help='Write the summary to a csv file.')
+
+    parser.add_argument('StoreDir', type=str,
+                        help='Root directory of the processed store.')
+
+    args = parser.parse_args()
+
+    summary, counters = store_bouts(args.StoreDir, state_col=args.s,
+                                    conditions=args.c)
+    if args.o is not None:
+        summary.to_csv(args.o, index=False)
+    else:
+        print summary.to_string()
+
+if __name__ == '__main__':
+    main()
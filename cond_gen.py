@@ -2,7 +2,12 @@ import argparse
 import csv
 import cv2
 import datetime as dt
+from metadata import parse_name, list_dir
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import os
+import sqlite3
+import subprocess
 
 
 def get_date(filename, time_offset):
@@ -12,12 +17,8 @@ def get_date(filename, time_offset):
     Returns:
         N_int, datetime object
     '''
-    d = filename[11:-5].split('-')
-    for i in range(len(d)):
-        d[i] = int(d[i])
-
-    dtime = dt.datetime(d[1], d[2], d[3], d[4], d[5], d[6])
-    return d[0], (dtime - dt.timedelta(hours=time_offset)).date()
+    camera, camera_num, dtime, scale = parse_name(filename)
+    return camera_num, (dtime - dt.timedelta(hours=time_offset)).date()
 
 
 def get_dict(conditions_file):
@@ -108,7 +109,211 @@ def get_roi(movie, roi_tup=(0, 0, -1, -1)):
     return r0, c0, r1, c1
 
 
-def write_cond_file(movie_dir, cond_file, in_dict, time_offset, roi=True):
+def sample_frames(movie, n=9, step=250, start=0, stop=None):
+    '''
+    Samples frames spread through a movie by seeking.
+    Args:
+        movie - string containing path of movie file
+        n - number of frames to sample
+        step - for movies without a frame index to seek with (raw h264),
+               every step-th frame from start is sampled instead
+        start, stop - range of frame indices to sample from, by default the
+                      whole movie
+    Returns:
+        list of frames
+    '''
+    cap = cv2.VideoCapture(movie)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    if total > 0:
+        stop = total if stop is None else min(stop, total)
+        if stop > start:
+            for index in np.unique(np.linspace(start, stop - 1,
+                                               n).astype(int)):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                ret, frame = cap.read()
+                if ret:
+                    frames.append(frame)
+    else:
+        i = 0
+        while len(frames) < n and (stop is None or i < stop) and cap.grab():
+            if i >= start and (i - start) % step == 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    frames.append(frame)
+            i += 1
+
+    cap.release()
+    return frames
+
+
+def median_background(frames):
+    '''
+    Computes the median grayscale image of a list of frames, removing bees.
+    '''
+    return np.median(np.array([cv2.cvtColor(f, cv2.COLOR_BGR2GRAY)
+                               for f in frames]), axis=0).astype(np.uint8)
+
+
+def detect_dish(image, min_frac=0.3, max_frac=0.6):
+    '''
+    Detects the Petri-dish in a grayscale image with a Hough circle transform.
+    Args:
+        image - grayscale image, ideally a median background
+        min_frac, max_frac - range of dish radius as fraction of min(h, w)
+    Returns:
+        centre row, centre column, radius or None if no circle found
+    '''
+    h, w = image.shape[:2]
+    blur = cv2.GaussianBlur(image, (0, 0), 3)
+    circles = cv2.HoughCircles(blur, cv2.HOUGH_GRADIENT, 2, min(h, w),
+                               param1=100, param2=50,
+                               minRadius=int(min_frac * min(h, w)),
+                               maxRadius=int(max_frac * min(h, w)))
+    if circles is None:
+        return None
+    x, y, radius = circles[0][0]
+
+    return int(round(y)), int(round(x)), int(round(radius))
+
+
+def circle_to_roi(centre_row, centre_col, radius, shape):
+    '''
+    Gets the square region of interest enclosing a circle, shrunk if
+    necessary to fit inside an image.
+    Args:
+        centre_row, centre_col, radius - circle returned by detect_dish
+        shape - shape of image
+    Returns:
+        r0, c0, r1, c1
+    '''
+    half = min(radius, centre_row, centre_col, shape[0] - centre_row,
+               shape[1] - centre_col)
+    return (centre_row - half, centre_col - half,
+            centre_row + half, centre_col + half)
+
+
+def adjust_roi(images, roi_tup, title):
+    '''
+    Interface for adjusting a region of interest drawn over images which have
+    already been decoded, so only the overlay is redrawn on each keypress.
+    Args:
+        images - list of images to display, first is shown initially
+        roi_tup - tuple (r0, c0, r1, c1) giving initial estimate
+        title - window title
+    Returns:
+        r0, c0, r1, c1
+    '''
+    title_str = 'q:accept e:nextimage wsad:move rf:scale (shift x10) ' + title
+    h, w = images[0].shape[:2]
+    r0, c0, r1, c1 = roi_tup
+    i = 0
+    moves = {'w': (-1, 0, 0), 's': (1, 0, 0), 'a': (0, -1, 0),
+             'd': (0, 1, 0), 'r': (0, 0, -1), 'f': (0, 0, 1)}
+
+    while 1:
+        image = images[i]
+        if len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        else:
+            image = image.copy()
+        cv2.rectangle(image, (c0, r0), (c1, r1), (0, 0, 255), 1)
+        cv2.circle(image, ((c0 + c1) / 2, (r0 + r1) / 2),
+                   int(0.55 * min(r1 - r0, c1 - c0)), (0, 255, 0), 1)
+        cv2.imshow(title_str, image)
+        keypress = cv2.waitKey(0) & 0xFF
+        if keypress in (ord('q'), 13):
+            break
+        elif keypress == ord('e'):
+            i = (i + 1) % len(images)
+        elif chr(keypress).lower() in moves:
+            step = 10 if chr(keypress).isupper() else 1
+            dr, dc, ds = moves[chr(keypress).lower()]
+            n0, m0 = r0 + dr * step, c0 + dc * step
+            n1, m1 = r1 + (dr + ds) * step, c1 + (dc + ds) * step
+            if 0 <= n0 < n1 - 1 and 0 <= m0 < m1 - 1 and n1 <= h and m1 <= w:
+                r0, c0, r1, c1 = n0, m0, n1, m1
+
+    cv2.destroyAllWindows()
+    return r0, c0, r1, c1
+
+
+def get_roi_auto(movie, roi_tup=(0, 0, -1, -1), confirm=True,
+                 return_detected=False):
+    '''
+    Determines region of interest from a median background of a few frames
+    sampled by seeking. The dish is detected automatically as the initial
+    estimate, falling back to roi_tup if none is found.
+    Args:
+        movie - string containing path of movie file
+        roi_tup - tuple (r0, c0, r1, c1) used if no dish is detected
+        confirm - show detected region of interest for adjustment
+        return_detected - also return whether the dish was detected
+    Returns:
+        r0, c0, r1, c1 (and True if the dish was detected, False if roi_tup or
+        a square fallback was used, if return_detected)
+    Raises:
+        IOError if no frames can be read from movie (eg. empty or still being
+        written)
+    '''
+    frames = sample_frames(movie)
+    if len(frames) == 0:
+        raise IOError('No frames could be read from %s' % movie)
+    background = median_background(frames)
+    h, w = background.shape
+    circle = detect_dish(background)
+    if circle is not None:
+        roi_tup = circle_to_roi(circle[0], circle[1], circle[2], (h, w))
+    else:
+        r0, c0, r1, c1 = roi_tup
+        if (r1 > h) or (c1 > w) or (-1 in (r1, c1)):
+            roi_tup = (r0, c0, min(h, w), min(h, w))
+
+    if confirm:
+        roi_tup = adjust_roi([background] + frames, roi_tup, movie)
+
+    if return_detected:
+        return tuple(roi_tup), circle is not None
+    return tuple(roi_tup)
+
+
+def read_roi_cache(cache_file):
+    '''
+    Reads regions of interest cached by write_roi_cache.
+    Args:
+        cache_file - path of cache csv file
+    Returns:
+        dictionary indexed by (cameraname, date) with (r0, c0, r1, c1) values
+    '''
+    cache = {}
+    if cache_file is None or not os.path.isfile(cache_file):
+        return cache
+    with open(cache_file, 'r') as in_file:
+        for line in csv.reader(in_file):
+            date = dt.datetime.strptime(line[1], '%Y-%m-%d').date()
+            cache[(line[0], date)] = tuple(int(v) for v in line[2:6])
+
+    return cache
+
+
+def write_roi_cache(cache_file, cache):
+    '''
+    Writes regions of interest for each camera and date to a csv file in the
+    format:
+        cameraname, yyyy-mm-dd, r0, c0, r1, c1
+    '''
+    if cache_file is None:
+        return None
+    with open(cache_file, 'w') as out_file:
+        for key in sorted(cache):
+            out_file.write('%s,%s,%s,%s,%s,%s\n' % (
+                (key[0], key[1].isoformat()) + tuple(cache[key])))
+
+    return None
+
+
+def write_cond_file(movie_dir, cond_file, in_dict, time_offset, roi=True,
+                    auto=False, confirm=True):
     '''
     Writes a csv file in the format:
         movie_filename, condition
@@ -116,36 +321,238 @@ def write_cond_file(movie_dir, cond_file, in_dict, time_offset, roi=True):
         movie_dir - directory where movies are stored
         cond_file - path output condition file
         in_dict - dictionary returned from get_dict()
+        roi - determine a region of interest for each camera and date. These
+              are cached in roi_cache.csv in movie_dir so each is only
+              determined once.
+        auto - determine regions of interest with get_roi_auto instead of
+               get_roi
+        confirm - passed to get_roi_auto
     '''
     if not (cond_file is None):
         out_file = open(cond_file, 'w')
 
+    cache_file = os.path.join(movie_dir, 'roi_cache.csv')
+    roi_cache = read_roi_cache(cache_file) if roi else {}
+
     prev_d = 0, 0
     r0 = c0 = 0
     r1 = c1 = -1
-    for f in sorted(os.listdir(movie_dir)):
-        try:
-            if f[0:11] == 'raspberrypi' and f[-5:] == '.h264':
-                d = get_date(f, time_offset)
-                if roi:
-                    if d != prev_d:
+    movies = list_dir(movie_dir, time_offset=time_offset, kind='movie')
+    for f, camera, camera_num, date in zip(movies.name, movies.camera,
+                                           movies.camera_num, movies.date):
+        d = camera_num, date.date()
+        if camera not in in_dict or d[1] not in in_dict[camera]:
+            continue
+        if roi:
+            if d != prev_d:
+                key = (camera, d[1])
+                if key in roi_cache:
+                    r0, c0, r1, c1 = roi_cache[key]
+                else:
+                    found = True
+                    if auto:
+                        (r0, c0, r1, c1), found = get_roi_auto(
+                            os.path.join(movie_dir, f),
+                            roi_tup=(r0, c0, r1, c1), confirm=confirm,
+                            return_detected=True)
+                    else:
                         r0, c0, r1, c1 = get_roi(os.path.join(movie_dir, f),
                                                  roi_tup=(r0, c0, r1, c1))
-                        prev_d = d
+                    # A fallback nobody confirmed is not cached, so detection
+                    # is tried again next time
+                    if found or confirm:
+                        roi_cache[key] = (r0, c0, r1, c1)
+                        write_roi_cache(cache_file, roi_cache)
+                prev_d = d
 
-                if cond_file is None:
-                    print '%s,%s,%s,%s,%s,%s' % (f, in_dict[f[0:13]][d[1]],
-                                                 r0, c0, r1, c1)
-                else:
-                    out_file.write('%s,%s,%s,%s,%s,%s\n' % (
-                        f, in_dict[f[0:13]][d[1]], r0, c0, r1, c1))
-        except KeyError:
-            continue
+        if cond_file is None:
+            print '%s,%s,%s,%s,%s,%s' % (f, in_dict[camera][d[1]],
+                                         r0, c0, r1, c1)
+        else:
+            out_file.write('%s,%s,%s,%s,%s,%s\n' % (
+                f, in_dict[camera][d[1]], r0, c0, r1, c1))
 
     if not (cond_file is None):
         out_file.close()
 
 
+def open_index(index_file):
+    '''
+    Opens movie index database, creating the movies table if necessary.
+    Args:
+        index_file - path of sqlite database
+    Returns:
+        sqlite3.Connection
+    '''
+    conn = sqlite3.connect(index_file)
+    conn.execute('''CREATE TABLE IF NOT EXISTS movies (
+                    filename TEXT PRIMARY KEY, path TEXT, camera TEXT,
+                    timestamp TEXT, date TEXT, size INTEGER, mtime REAL,
+                    frames INTEGER, fps REAL, width INTEGER, height INTEGER,
+                    condition TEXT, r0 INTEGER, c0 INTEGER, r1 INTEGER,
+                    c1 INTEGER)''')
+    return conn
+
+
+def count_frames(path):
+    '''
+    Counts the frames of a movie without a container frame count (eg. raw
+    h264), with ffprobe if it is installed, otherwise by decoding the movie.
+    Args:
+        path - path of movie file
+    Returns:
+        number of frames
+    '''
+    try:
+        out = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-count_packets', '-show_entries', 'stream=nb_read_packets',
+             '-of', 'csv=p=0', path])
+        return int(out.strip())
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        pass
+
+    cap = cv2.VideoCapture(path)
+    frames = 0
+    while cap.grab():
+        frames += 1
+    cap.release()
+
+    return frames
+
+
+def probe_movie(path):
+    '''
+    Reads movie properties from its container. Frames of movies without a
+    container frame count (eg. raw h264) are counted (see count_frames).
+    Args:
+        path - path of movie file
+    Returns:
+        frames, fps, width, height. fps is None for movies without a
+        container frame count, as raw h264 does not record a frame rate.
+    '''
+    cap = cv2.VideoCapture(path)
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    if frames <= 0:
+        frames = count_frames(path)
+        fps = None
+
+    return frames, fps, width, height
+
+
+def update_index(movie_dir, index_file, in_dict=None, time_offset=0,
+                 threads=8):
+    '''
+    Updates a persistent index of the movies in movie_dir. Only new movies,
+    movies whose size or modification time has changed and movies without a
+    frame count are opened, in parallel with a thread pool. Dates, conditions
+    and regions of interest (from roi_cache.csv, see write_cond_file) are
+    refreshed for every movie, and movies no longer in movie_dir are removed.
+    Args:
+        movie_dir - directory where movies are stored
+        index_file - path of sqlite database
+        in_dict - dictionary returned from get_dict(), or None
+        time_offset - hour offset passed to get_date
+        threads - number of threads to open movies with
+    Returns:
+        number of movies opened
+    '''
+    conn = open_index(index_file)
+    known = dict((row[0], row[1:]) for row in conn.execute(
+        'SELECT filename, mtime, size FROM movies'))
+    # Movies indexed before raw h264 frames were counted are probed again
+    uncounted = set(row[0] for row in conn.execute(
+        'SELECT filename FROM movies WHERE frames IS NULL'))
+
+    movies = list_dir(movie_dir, time_offset=time_offset, kind='movie')
+    names = dict(zip(movies.name, zip(movies.camera, movies.stem)))
+    listing = {}
+    for f in movies.name:
+        st = os.stat(os.path.join(movie_dir, f))
+        listing[f] = (st.st_mtime, st.st_size)
+
+    # Open new and modified movies
+    changed = sorted(f for f in listing
+                     if known.get(f) != listing[f] or f in uncounted)
+    pool = ThreadPool(threads)
+    probes = pool.map(probe_movie, [os.path.join(movie_dir, f)
+                                    for f in changed])
+    pool.close()
+    pool.join()
+    conn.executemany(
+        '''INSERT OR REPLACE INTO movies (filename, path, camera, timestamp,
+           size, mtime, frames, fps, width, height)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        [(f, os.path.abspath(os.path.join(movie_dir, f)), names[f][0],
+          names[f][1][len(names[f][0]) + 1:], listing[f][1], listing[f][0]) +
+         probe for f, probe in zip(changed, probes)])
+
+    # Remove deleted movies
+    conn.executemany('DELETE FROM movies WHERE filename = ?',
+                     [(f,) for f in known if f not in listing])
+
+    # Refresh dates, conditions and regions of interest
+    roi_cache = read_roi_cache(os.path.join(movie_dir, 'roi_cache.csv'))
+    updates = []
+    for f, camera, date in zip(movies.name, movies.camera, movies.date):
+        date = date.date()
+        condition = None
+        if in_dict is not None:
+            condition = in_dict.get(camera, {}).get(date)
+        roi = roi_cache.get((camera, date), (None, None, None, None))
+        updates.append((date.isoformat(), condition) + tuple(roi) + (f,))
+    conn.executemany('''UPDATE movies SET date = ?, condition = ?, r0 = ?,
+                        c0 = ?, r1 = ?, c1 = ? WHERE filename = ?''', updates)
+    conn.commit()
+    conn.close()
+
+    return len(changed)
+
+
+def read_index(index_file, columns=('filename', 'condition', 'r0', 'c0', 'r1',
+                                    'c1'), with_condition=True):
+    '''
+    Reads rows of the movie index, sorted by filename.
+    Args:
+        index_file - path of sqlite database
+        columns - columns to read
+        with_condition - only read movies which have a condition
+    Returns:
+        list of tuples
+    '''
+    conn = open_index(index_file)
+    query = 'SELECT %s FROM movies' % ', '.join(columns)
+    if with_condition:
+        query += ' WHERE condition IS NOT NULL'
+    rows = conn.execute(query + ' ORDER BY filename').fetchall()
+    conn.close()
+
+    return rows
+
+
+def write_cond_from_index(index_file, cond_file):
+    '''
+    Writes a conditions file in the format of write_cond_file from the movie
+    index. Movies without a region of interest are given the whole frame.
+    '''
+    out_file = None if cond_file is None else open(cond_file, 'w')
+    for row in read_index(index_file):
+        line = '%s,%s,%s,%s,%s,%s' % (row[:2] + tuple(
+            (0, 0, -1, -1)[i] if v is None else v
+            for i, v in enumerate(row[2:])))
+        if out_file is None:
+            print line
+        else:
+            out_file.write(line + '\n')
+
+    if out_file is not None:
+        out_file.close()
+
+
 def main():
     # Argument parser
     parser = argparse.ArgumentParser(description='Generate condition reference')
@@ -163,6 +570,24 @@ def main():
     parser.add_argument('-r', action='store_true', help='''Write regions of
                         interest (manual input)''')
 
+    parser.add_argument('-a', action='store_true', help='''Automatically
+                        detect the dish in a median of frames sampled from each
+                        movie as the region of interest. Implies -r.''')
+
+    parser.add_argument('-y', action='store_true', help='''Accept
+                        automatically detected regions of interest without
+                        confirmation.''')
+
+    parser.add_argument('-i', default=None, type=str, required=False,
+                        metavar='IndexFile',
+                        help='''Update a persistent sqlite index of the movies
+                        (only opening new or modified movies) and generate
+                        output from it.''')
+
+    parser.add_argument('-j', default=8, type=int, required=False,
+                        metavar='Threads',
+                        help='Threads used to open movies for the index.')
+
     parser.add_argument('ConditionsFile', type=str,
                         help='The path of the conditions csv file.')
 
@@ -175,7 +600,14 @@ def main():
     in_dict = get_dict(args.ConditionsFile)
 
     # Generate output
-    write_cond_file(args.MovieDir, args.o, in_dict, args.t, args.r)
+    if args.r or args.a or args.i is None:
+        write_cond_file(args.MovieDir, args.o, in_dict, args.t,
+                        args.r or args.a, auto=args.a, confirm=not args.y)
+        if args.i is not None:
+            update_index(args.MovieDir, args.i, in_dict, args.t, args.j)
+    else:
+        update_index(args.MovieDir, args.i, in_dict, args.t, args.j)
+        write_cond_from_index(args.i, args.o)
 
 if __name__ == '__main__':
     main()
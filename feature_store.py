@@ -0,0 +1,248 @@
+# feature_store.py
+# Out-of-core store of HMM feature matrices. Features of all trajectories are
+# appended to one raw float64 file which is memory mapped for fitting and
+# decoding, so months of data are never held in memory or concatenated.
+# Layout:
+#     <store>/
+#         meta.json - features, subsample factor, rows and source files
+#         features.f8 - rows x features, C order, native float64
+#         index.npy - int64 array of (source, traj, length) per sequence
+#         <column>.<dtype> - row aligned per-row outputs (eg. decoded states)
+#         selection.f8 - features of some of the sources (see select)
+
+import json
+import numpy as np
+import os
+import pandas as pd
+
+
+class FeatureStore:
+    '''
+    Growable memory-mapped feature matrix with an index of sequences.
+    Sequences (trajectories) are stored contiguously in the order they were
+    appended, so data()[offsets[i]:offsets[i] + lengths[i]] is sequence i.
+    '''
+    def __init__(self, path, features=None, subsample_factor=None):
+        '''
+        Opens the store at path, creating it if needed.
+        Args:
+            path - store directory
+            features - names of feature columns. Required to create a store,
+                       and checked against an existing one.
+            subsample_factor - subsample factor of the features. All sources
+                               of a store share one factor, so a different
+                               factor raises ValueError (use another store).
+        '''
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.data_path = os.path.join(path, 'features.f8')
+        self.index_path = os.path.join(path, 'index.npy')
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r') as in_file:
+                self.meta = json.load(in_file)
+            if features is not None:
+                assert list(features) == self.meta['features']
+        else:
+            assert features is not None
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.meta = {'features': list(features), 'rows': 0, 'sources': [],
+                         'subsample_factor': subsample_factor}
+            self._write_meta()
+        if self.meta.get('subsample_factor') is None:
+            factors = [s['subsample_factor'] for s in self.meta['sources']]
+            self.meta['subsample_factor'] = \
+                factors[0] if factors else subsample_factor
+        if subsample_factor not in (None, self.meta['subsample_factor']):
+            raise ValueError('Store %s has subsample factor %s, not %s' %
+                             (path, self.meta['subsample_factor'],
+                              subsample_factor))
+        # Sequences written after the last meta update are discarded
+        n_seq = sum(s['sequences'] for s in self.meta['sources'])
+        if os.path.isfile(self.index_path):
+            self.index = np.load(self.index_path)[:n_seq]
+        else:
+            self.index = np.empty((0, 3), dtype=np.int64)
+        self._update()
+
+    def _write_meta(self):
+        with open(self.meta_path + '.tmp', 'w') as out_file:
+            json.dump(self.meta, out_file, indent=1, sort_keys=True)
+        os.rename(self.meta_path + '.tmp', self.meta_path)
+
+    def _update(self):
+        self.features = self.meta['features']
+        self.subsample_factor = self.meta['subsample_factor']
+        self.rows = self.meta['rows']
+        self.lengths = self.index[:, 2]
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+
+    def data(self):
+        '''
+        Returns:
+            read-only memory map of the features, shape (rows, features)
+        '''
+        shape = (self.rows, len(self.features))
+        if self.rows == 0:
+            return np.empty(shape)
+        return np.memmap(self.data_path, dtype=np.float64, mode='r',
+                         shape=shape)
+
+    def sources(self):
+        '''
+        Returns:
+            DataFrame of source files with their first sequence and number of
+            sequences
+        '''
+        return pd.DataFrame(self.meta['sources'],
+                            columns=['path', 'mtime', 'subsample_factor',
+                                     'first', 'sequences'])
+
+    def sequences(self):
+        '''
+        Returns:
+            DataFrame with one row per sequence: source path, traj, offset
+            (first row of data()) and length
+        '''
+        paths = np.array([s['path'] for s in self.meta['sources']] or [''])
+        return pd.DataFrame({'source': paths[self.index[:, 0]],
+                             'traj': self.index[:, 1],
+                             'offset': self.offsets,
+                             'length': self.lengths},
+                            columns=['source', 'traj', 'offset', 'length'])
+
+    def has_source(self, path, mtime=None, subsample_factor=None):
+        '''
+        Returns True if path has been added (with the same modification time
+        and subsample factor, if given).
+        '''
+        for s in self.meta['sources']:
+            if (s['path'] == path and mtime in (None, s['mtime']) and
+                    subsample_factor in (None, s['subsample_factor'])):
+                return True
+        return False
+
+    def select(self, paths):
+        '''
+        Features of the sequences of some sources, in store order. If paths
+        include every source this is data(), otherwise the rows are copied
+        one source at a time to selection.f8, replacing any previous
+        selection, and memory mapped.
+        Args:
+            paths - source paths to include
+        Returns:
+            X - read-only memory map, shape (rows, features)
+            lengths - length of each sequence of X
+        '''
+        paths = set(paths)
+        keep = np.array([s['path'] in paths for s in self.meta['sources']],
+                        dtype=bool)
+        if keep.all():
+            return self.data(), self.lengths
+        selected = keep[self.index[:, 0]]
+        lengths = self.lengths[selected]
+        shape = (int(lengths.sum()), len(self.features))
+        if shape[0] == 0:
+            return np.empty(shape), lengths
+        data = self.data()
+        select_path = os.path.join(self.path, 'selection.f8')
+        with open(select_path, 'wb') as out_file:
+            for s in np.array(self.meta['sources'])[keep]:
+                last = s['first'] + s['sequences'] - 1
+                start = self.offsets[s['first']]
+                end = self.offsets[last] + self.lengths[last]
+                np.asarray(data[start:end]).tofile(out_file)
+
+        return np.memmap(select_path, dtype=np.float64, mode='r',
+                         shape=shape), lengths
+
+    def truncate(self, n_sources):
+        '''
+        Removes all but the first n_sources sources (eg. to replace a source
+        file that has changed, which is then appended again with the sources
+        that followed it). Row aligned columns are cut first, so an
+        interruption leaves rows without outputs rather than stale outputs.
+        '''
+        sources = self.meta['sources'][:n_sources]
+        n_seq = sum(s['sequences'] for s in sources)
+        rows = int(self.lengths[:n_seq].sum())
+        for name in os.listdir(self.path):
+            column, ext = os.path.splitext(name)
+            if name in ('meta.json', 'features.f8', 'index.npy',
+                        'selection.f8') or ext in ('', '.tmp'):
+                continue
+            itemsize = np.dtype(ext[1:]).itemsize
+            col_path = os.path.join(self.path, name)
+            if os.path.getsize(col_path) > rows * itemsize:
+                with open(col_path, 'r+b') as out_file:
+                    out_file.truncate(rows * itemsize)
+        self.meta['sources'] = sources
+        self.meta['rows'] = rows
+        self._write_meta()
+        self.index = self.index[:n_seq]
+        self._update()
+
+        return None
+
+    def append(self, X, lengths, trajs, source, mtime=None):
+        '''
+        Appends the sequences of one source file.
+        Args:
+            X - array of shape (sum(lengths), features)
+            lengths - length of each sequence
+            trajs - trajectory number of each sequence
+            source - path of source file
+            mtime - modification time of source file
+        Returns:
+            None
+        '''
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        assert X.shape == (lengths.sum(), len(self.features))
+        assert len(trajs) == len(lengths)
+
+        # Data beyond meta['rows'] is left over from an interrupted append
+        mode = 'r+b' if os.path.isfile(self.data_path) else 'wb'
+        with open(self.data_path, mode) as out_file:
+            out_file.seek(self.rows * X.shape[1] * X.itemsize)
+            X.tofile(out_file)
+            out_file.truncate()
+
+        new = np.empty((len(lengths), 3), dtype=np.int64)
+        new[:, 0] = len(self.meta['sources'])
+        new[:, 1] = trajs
+        new[:, 2] = lengths
+        index = np.vstack([self.index, new])
+        with open(self.index_path + '.tmp', 'wb') as out_file:
+            np.save(out_file, index)
+        os.rename(self.index_path + '.tmp', self.index_path)
+
+        self.meta['sources'].append({'path': source, 'mtime': mtime,
+                                     'subsample_factor':
+                                         self.subsample_factor,
+                                     'first': len(self.index),
+                                     'sequences': len(lengths)})
+        self.meta['rows'] += len(X)
+        self._write_meta()
+        self.index = index
+        self._update()
+
+        return None
+
+    def column(self, name, dtype=np.int8, fill=-1):
+        '''
+        Row aligned output column (eg. decoded states), created filled with
+        fill and extended with fill if rows have been appended since.
+        Returns:
+            writable memory map of shape (rows, )
+        '''
+        dtype = np.dtype(dtype)
+        path = os.path.join(self.path, '%s.%s' % (name, dtype.str[1:]))
+        size = os.path.getsize(path) // dtype.itemsize \
+            if os.path.isfile(path) else 0
+        if size < self.rows:
+            with open(path, 'ab') as out_file:
+                np.full(self.rows - size, fill, dtype=dtype).tofile(out_file)
+        if self.rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r+', shape=(self.rows,))
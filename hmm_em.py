@@ -0,0 +1,596 @@
+# hmm_em.py
+# Baum-Welch fitting of Gaussian HMMs over many sequences, with the E-step
+# split across a process pool. The forward-backward pass is vectorised across
+# sequences, and across blocks of long sequences, so tens of millions of rows
+# take a few numpy operations per block row rather than a python loop per row.
+
+import ctypes
+from hmmlearn.hmm import GaussianHMM
+import mmap
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from sklearn.cluster import KMeans
+import sys
+
+# Rows of X in each E-step task (a longer sequence is a task on its own)
+CHUNK_ROWS = 1 << 20
+
+
+def log_likelihood(X, means, covars, covariance_type='diag'):
+    '''
+    Log density of each row of X under each Gaussian.
+    Args:
+        X - array of shape (n_samples, n_features)
+        means - array of shape (n_components, n_features)
+        covars - array of shape (n_components, n_features) for 'diag' or
+                 (n_components, n_features, n_features) for 'full'
+        covariance_type - 'diag' or 'full'
+    Returns:
+        array of shape (n_samples, n_components)
+    '''
+    n_features = X.shape[1]
+    if covariance_type == 'diag':
+        covars = np.maximum(covars, np.finfo(float).tiny)
+        return -0.5 * (n_features * np.log(2 * np.pi) +
+                       np.log(covars).sum(axis=1) +
+                       ((X[:, np.newaxis, :] - means) ** 2 /
+                        covars).sum(axis=2))
+
+    out = np.empty((len(X), len(means)))
+    for c in range(len(means)):
+        chol = np.linalg.cholesky(covars[c])
+        z = np.dot(X - means[c], np.linalg.inv(chol).T)
+        out[:, c] = -0.5 * (n_features * np.log(2 * np.pi) +
+                            (z ** 2).sum(axis=1)) - \
+            np.log(np.diagonal(chol)).sum()
+    return out
+
+
+def _blocks(lengths, size):
+    '''
+    Splits sequences into blocks of at most size rows.
+    Returns:
+        first row, length, sequence and index within sequence of each block
+    '''
+    starts = np.cumsum(lengths) - lengths
+    n_blocks = (lengths + size - 1) // size
+    seq = np.repeat(np.arange(len(lengths)), n_blocks)
+    k = np.arange(n_blocks.sum()) - np.repeat(np.cumsum(n_blocks) - n_blocks,
+                                              n_blocks)
+    start = starts[seq] + k * size
+    length = np.minimum(size, lengths[seq] - k * size)
+
+    return start, length, seq, k
+
+
+def _normalise(a):
+    s = a.sum(axis=-1)
+    return a / s[..., np.newaxis], s
+
+
+def _forward_backward_blocks(b, lengths, startprob, transmat, size):
+    '''
+    Scaled forward-backward pass (see forward_backward) with sequences split
+    into blocks of size rows, which are stepped through together: first to
+    multiply out each block's transfer matrix, then block by block along each
+    sequence to find the forward and backward vectors at block boundaries,
+    then within blocks again to fill in every row.
+    Args:
+        b - array (n_samples, n_components) of scaled emission likelihoods
+        lengths - array of sequence lengths (> 0), summing to n_samples
+        startprob, transmat - model parameters
+        size - rows per block
+    Returns:
+        forward and backward vectors (each normalised), log likelihood of
+        each sequence (without the scaling of b)
+    '''
+    n = len(startprob)
+    start, length, seq, k = _blocks(lengths, size)
+    n_seq = len(lengths)
+    first = k == 0
+
+    # Blocks sorted by length, so the blocks still going at row j of a block
+    # are a prefix, and rows laid out as (block, row in block, state)
+    order = np.argsort(-length, kind='mergesort')
+    active = len(order) - np.searchsorted(np.sort(length), np.arange(size),
+                                          side='right')
+    valid = np.arange(size) < length[order][:, np.newaxis]
+    rows = np.where(valid, start[order][:, np.newaxis] + np.arange(size), 0)
+    bp = b[rows]
+
+    # Transfer matrix of each block: product of transmat * b over its rows
+    # (no transition into the first row of a sequence)
+    q = np.empty((len(order), n, n))
+    q[:] = transmat
+    q[first[order]] = np.eye(n)
+    q *= bp[:, 0, np.newaxis, :]
+    s = q.sum(axis=(1, 2))
+    q /= s[:, np.newaxis, np.newaxis]
+    log_q = np.log(s)
+    for j in range(1, size):
+        m = active[j]
+        qm = np.dot(q[:m].reshape(m * n, n), transmat).reshape(m, n, n) * \
+            bp[:m, j, np.newaxis, :]
+        s = qm.sum(axis=(1, 2))
+        q[:m] = qm / s[:, np.newaxis, np.newaxis]
+        log_q[:m] += np.log(s)
+    unsorted = np.empty_like(order)
+    unsorted[order] = np.arange(len(order))
+    q = q[unsorted]
+    log_q = log_q[unsorted]
+
+    # Forward and backward vectors at block boundaries, stepping along the
+    # blocks of all sequences together
+    by_k = np.argsort(k, kind='mergesort')
+    k_bounds = np.searchsorted(k[by_k], np.arange(k.max() + 2))
+    v_in = np.empty((len(k), n))
+    v_seq = np.tile(startprob, (n_seq, 1))
+    log_prob = np.zeros(n_seq)
+    for i in range(k.max() + 1):
+        idx = by_k[k_bounds[i]:k_bounds[i + 1]]
+        v_in[idx] = v_seq[seq[idx]]
+        v_out, s = _normalise(np.einsum('bi,bij->bj', v_in[idx], q[idx]))
+        v_seq[seq[idx]] = v_out
+        log_prob[seq[idx]] += np.log(s) + log_q[idx]
+    beta_end = np.empty((len(k), n))
+    w_seq = np.ones((n_seq, n))
+    for i in range(k.max(), -1, -1):
+        idx = by_k[k_bounds[i]:k_bounds[i + 1]]
+        beta_end[idx] = w_seq[seq[idx]]
+        if i > 0:
+            w_seq[seq[idx]] = _normalise(
+                np.einsum('bij,bj->bi', q[idx], beta_end[idx]))[0]
+
+    # Fill in rows within blocks
+    alpha = np.empty_like(bp)
+    a = v_in[order]
+    not_first = ~first[order]
+    a[not_first] = np.dot(a[not_first], transmat)
+    alpha[:, 0] = _normalise(a * bp[:, 0])[0]
+    for j in range(1, size):
+        m = active[j]
+        alpha[:m, j] = _normalise(np.dot(alpha[:m, j - 1], transmat) *
+                                  bp[:m, j])[0]
+    beta = np.empty_like(bp)
+    be = beta_end[order]
+    for j in range(size - 1, -1, -1):
+        m = active[j]
+        m2 = 0
+        if j + 1 < size:
+            m2 = active[j + 1]
+            beta[:m2, j] = _normalise(np.dot(bp[:m2, j + 1] *
+                                             beta[:m2, j + 1],
+                                             transmat.T))[0]
+        beta[m2:m, j] = be[m2:m]
+
+    # Back to row order
+    rows = rows[valid]
+    alpha_rows = np.empty_like(b)
+    alpha_rows[rows] = alpha[valid]
+    beta_rows = np.empty_like(b)
+    beta_rows[rows] = beta[valid]
+
+    return alpha_rows, beta_rows, log_prob
+
+
+def forward_backward(frame_log_lik, lengths, startprob, transmat):
+    '''
+    Scaled forward-backward pass over concatenated sequences, in float64.
+    Sequences are grouped by length, and each group is split into blocks of
+    about the square root of its longest length (see
+    _forward_backward_blocks), so the number of numpy operations grows with
+    the square root of the longest sequence rather than its length.
+    Args:
+        frame_log_lik - array (n_samples, n_components) of emission log
+                        likelihoods
+        lengths - array of sequence lengths (> 0), summing to n_samples
+        startprob - initial state probabilities
+        transmat - transition matrix
+    Returns:
+        posteriors (n_samples, n_components), expected transition counts
+        (n_components, n_components), log likelihood of each sequence
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    offset = frame_log_lik.max(axis=1)
+    b = np.exp(frame_log_lik - offset[:, np.newaxis])
+    log_prob = np.add.reduceat(offset, starts)
+
+    # Block size for each sequence, a power of 2 near sqrt(length)
+    sizes = np.maximum(16, 2 ** np.ceil(np.log2(np.sqrt(lengths)))).astype(
+        np.int64)
+    alpha = np.empty_like(b)
+    beta = np.empty_like(b)
+    for size in np.unique(sizes):
+        seqs = np.flatnonzero(sizes == size)
+        if len(seqs) == len(lengths):
+            rows = slice(None)
+        else:
+            rows = np.repeat(starts[seqs] - np.cumsum(lengths[seqs]) +
+                             lengths[seqs], lengths[seqs]) + \
+                np.arange(lengths[seqs].sum())
+        alpha[rows], beta[rows], lp = _forward_backward_blocks(
+            b[rows], lengths[seqs], startprob, transmat, size)
+        log_prob[seqs] += lp
+
+    posteriors = _normalise(alpha * beta)[0]
+
+    # Expected transitions, summed over all rows after the first of each
+    # sequence
+    later = np.ones(len(b), dtype=bool)
+    later[starts] = False
+    later = np.flatnonzero(later)
+    bb = b[later] * beta[later]
+    prev = alpha[later - 1]
+    norm = (np.dot(prev, transmat) * bb).sum(axis=1)
+    xi = np.dot((prev / norm[:, np.newaxis]).T, bb) * transmat
+
+    return posteriors, xi, log_prob
+
+
+def _as_float64(X):
+    '''
+    X as a C contiguous float64 array, keeping a memory map as it is.
+    '''
+    if (isinstance(X, np.memmap) and X.dtype == np.float64 and
+            X.flags.c_contiguous):
+        return X
+    return np.ascontiguousarray(X, dtype=np.float64)
+
+
+def _covariance(X):
+    '''
+    Sample covariance of the rows of X, CHUNK_ROWS at a time so a memory
+    mapped X is not copied into memory.
+    '''
+    total = np.zeros(X.shape[1])
+    outer = np.zeros((X.shape[1], X.shape[1]))
+    for start in range(0, len(X), CHUNK_ROWS):
+        chunk = np.asarray(X[start:start + CHUNK_ROWS], dtype=np.float64)
+        total += chunk.sum(axis=0)
+        outer += np.dot(chunk.T, chunk)
+    mean = total / len(X)
+
+    return (outer - len(X) * np.outer(mean, mean)) / (len(X) - 1)
+
+
+_em_shared = {}
+
+
+def _init_em_worker(X, shape, offsets, lengths, covariance_type):
+    '''
+    Sets up the data for _estep_worker, without copying shared arrays.
+    '''
+    if isinstance(X, str):
+        _em_shared['X'] = np.memmap(X, dtype=np.float64, mode='r',
+                                    shape=shape)
+    else:
+        _em_shared['X'] = np.frombuffer(X, dtype=np.float64).reshape(shape)
+    _em_shared['offsets'] = offsets
+    _em_shared['lengths'] = lengths
+    _em_shared['covariance_type'] = covariance_type
+
+
+def _estep_worker(task):
+    '''
+    E-step over a subset of sequences.
+    Args:
+        task - (array of sequence indices, (startprob, transmat, means,
+               covars))
+    Returns:
+        dictionary of sufficient statistics, with 'logprob'
+    '''
+    seqs, (startprob, transmat, means, covars) = task
+    offsets = _em_shared['offsets'][seqs]
+    lengths = _em_shared['lengths'][seqs]
+    X = _em_shared['X']
+    if len(seqs) == 1:
+        X = X[offsets[0]:offsets[0] + lengths[0]]
+    else:
+        X = X[np.repeat(offsets - np.cumsum(lengths) + lengths, lengths) +
+              np.arange(lengths.sum())]
+    covariance_type = _em_shared['covariance_type']
+
+    frame_log_lik = log_likelihood(X, means, covars, covariance_type)
+    post, xi, log_prob = forward_backward(frame_log_lik, lengths, startprob,
+                                          transmat)
+    stats = {'nobs': len(seqs), 'rows': len(X),
+             'logprob': log_prob.sum(),
+             'start': post[np.cumsum(lengths) - lengths].sum(axis=0),
+             'trans': xi,
+             'post': post.sum(axis=0),
+             'obs': np.dot(post.T, X)}
+    if covariance_type == 'diag':
+        stats['obs**2'] = np.dot(post.T, X ** 2)
+    else:
+        stats['obs*obs.T'] = np.array([np.dot((X * post[:, c:c + 1]).T, X)
+                                       for c in range(len(startprob))])
+
+    return stats
+
+
+def _add_stats(total, stats, weight=1.0):
+    for key, value in stats.items():
+        if key in total:
+            total[key] = total[key] + weight * value
+        else:
+            total[key] = weight * value
+
+
+class ParallelGaussianHMM:
+    '''
+    Gaussian HMM ('diag' or 'full' covariances) fitted by Baum-Welch. Follows
+    hmmlearn's GaussianHMM (parameter names, priors and initialisation), and
+    converts to one with to_hmmlearn for decoding.
+    The E-step is run on sequences in parallel with a process pool, and
+    sufficient statistics are accumulated in double precision.
+    With batch_size set, each iteration uses a random subset of sequences of
+    about batch_size rows (stepwise EM): statistics are scaled up to the full
+    data and blended into running statistics with step size
+    (iteration + 2) ** -step_decay.
+    '''
+    def __init__(self, n_components=1, covariance_type='diag', min_covar=1e-3,
+                 n_iter=10, tol=1e-2, covars_prior=1e-2, processes=1,
+                 batch_size=None, step_decay=0.6, random_state=None,
+                 verbose=False):
+        '''
+        Args:
+            n_components - number of hidden states
+            covariance_type - 'diag' or 'full'
+            min_covar - added to the diagonal of the initial covariances
+            n_iter - maximum number of iterations
+            tol - stop when the log likelihood improves by less than this
+                  (full batch only)
+            covars_prior - prior added to covariance estimates, as hmmlearn
+            processes - E-step worker processes, 0 uses all processors
+            batch_size - rows per iteration for stepwise EM, by default all
+            step_decay - in (0.5, 1], decay of stepwise EM step size
+            random_state - seed for initialisation and batches
+            verbose - print log likelihood of each iteration
+        '''
+        assert covariance_type in ('diag', 'full')
+        self.n_components = n_components
+        self.covariance_type = covariance_type
+        self.min_covar = min_covar
+        self.n_iter = n_iter
+        self.tol = tol
+        self.covars_prior = covars_prior
+        self.processes = processes
+        self.batch_size = batch_size
+        self.step_decay = step_decay
+        self.random_state = random_state
+        self.verbose = verbose
+        self.history = []
+
+    def _init(self, X, lengths):
+        '''
+        Uniform start and transition probabilities, k-means means (of at most
+        100000 rows) and the data covariance, as hmmlearn.
+        '''
+        rng = np.random.RandomState(self.random_state)
+        n = self.n_components
+        self.startprob_ = np.full(n, 1.0 / n)
+        self.transmat_ = np.full((n, n), 1.0 / n)
+        sample = X
+        if len(X) > 100000:
+            sample = X[rng.choice(len(X), 100000, replace=False)]
+        kmeans = KMeans(n_clusters=n, random_state=self.random_state)
+        self.means_ = kmeans.fit(sample).cluster_centers_
+        cv = _covariance(X) + self.min_covar * np.eye(X.shape[1])
+        if self.covariance_type == 'diag':
+            self.covars_ = np.tile(np.diag(cv), (n, 1))
+        else:
+            self.covars_ = np.tile(cv, (n, 1, 1))
+
+    def from_hmmlearn(self, model):
+        '''
+        Takes parameters from a fitted hmmlearn GaussianHMM (eg. to continue
+        fitting it).
+        '''
+        self.startprob_ = np.array(model.startprob_, dtype=np.float64)
+        self.transmat_ = np.array(model.transmat_, dtype=np.float64)
+        self.means_ = np.array(model.means_, dtype=np.float64)
+        covars = np.array(model.covars_, dtype=np.float64)
+        if self.covariance_type == 'diag' and covars.ndim == 3:
+            covars = np.array([np.diag(c) for c in covars])
+        self.covars_ = covars
+
+        return self
+
+    def to_hmmlearn(self):
+        '''
+        Returns:
+            hmmlearn GaussianHMM with the fitted parameters
+        '''
+        model = GaussianHMM(self.n_components,
+                            covariance_type=self.covariance_type,
+                            min_covar=self.min_covar, init_params='')
+        model.startprob_ = self.startprob_.copy()
+        model.transmat_ = self.transmat_.copy()
+        model.n_features = self.means_.shape[1]
+        model.means_ = self.means_.copy()
+        model.covars_ = self.covars_.copy()
+
+        return model
+
+    def _compute_log_likelihood(self, X):
+        return log_likelihood(X, self.means_, self.covars_,
+                              self.covariance_type)
+
+    def _params(self):
+        return self.startprob_, self.transmat_, self.means_, self.covars_
+
+    def _start(self, X, lengths):
+        '''
+        Shares X with a pool of E-step workers (or sets up this process). A
+        memory map of a whole file (eg. feature_store.FeatureStore.data) is
+        opened by each worker rather than copied.
+        '''
+        filename = None
+        if (isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and
+                X.offset == 0 and X.dtype == np.float64 and
+                X.flags.c_contiguous):
+            filename = X.filename
+        X = _as_float64(X)
+        if lengths is None:
+            lengths = [len(X)]
+        lengths = np.asarray(lengths, dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        keep = lengths > 0
+        self._lengths = lengths[keep]
+        self._offsets = offsets[keep]
+        if self.processes == 1:
+            _init_em_worker(X, X.shape, self._offsets, self._lengths,
+                            self.covariance_type)
+            self._pool = None
+        else:
+            if filename is None:
+                shared = RawArray(ctypes.c_double, X.size)
+                np.frombuffer(shared, dtype=np.float64)[:] = X.ravel()
+            else:
+                shared = filename
+            self._pool = Pool(self.processes if self.processes > 0 else None,
+                              _init_em_worker,
+                              (shared, X.shape, self._offsets, self._lengths,
+                               self.covariance_type))
+        return X
+
+    def _stop(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+        _em_shared.clear()
+
+    def _tasks(self, seqs):
+        '''
+        Groups sequences into tasks of about CHUNK_ROWS rows.
+        '''
+        processes = self.processes if self.processes > 0 else cpu_count()
+        rows = self._lengths[seqs].sum()
+        chunk = max(1, min(CHUNK_ROWS, rows // (4 * processes) + 1))
+        bounds = np.searchsorted(np.cumsum(self._lengths[seqs]),
+                                 np.arange(chunk, rows, chunk))
+        bounds = np.unique(np.concatenate(([0], bounds, [len(seqs)])))
+        params = self._params()
+
+        return [(seqs[lo:hi], params) for lo, hi in zip(bounds[:-1],
+                                                          bounds[1:])
+                if hi > lo]
+
+    def _estep(self, seqs):
+        '''
+        Returns:
+            sufficient statistics summed over sequences seqs
+        '''
+        tasks = self._tasks(seqs)
+        if self._pool is None:
+            results = (_estep_worker(task) for task in tasks)
+        else:
+            results = self._pool.imap_unordered(_estep_worker, tasks)
+        total = {}
+        for stats in results:
+            _add_stats(total, stats)
+
+        return total
+
+    def _do_mstep(self, stats):
+        '''
+        Updates parameters from sufficient statistics, as hmmlearn's
+        GaussianHMM with default priors.
+        '''
+        self.startprob_ = stats['start'] / stats['start'].sum()
+        self.transmat_ = stats['trans'] / stats['trans'].sum(axis=1)[:,
+                                                                     np.newaxis]
+        denom = stats['post'][:, np.newaxis]
+        self.means_ = stats['obs'] / denom
+        if self.covariance_type == 'diag':
+            c_n = (stats['obs**2'] - 2 * self.means_ * stats['obs'] +
+                   self.means_ ** 2 * denom)
+            self.covars_ = (self.covars_prior + c_n) / np.maximum(denom, 1e-5)
+        else:
+            n_features = self.means_.shape[1]
+            c_n = np.empty((self.n_components, n_features, n_features))
+            for c in range(self.n_components):
+                obsmean = np.outer(stats['obs'][c], self.means_[c])
+                c_n[c] = (stats['obs*obs.T'][c] - obsmean - obsmean.T +
+                          np.outer(self.means_[c], self.means_[c]) *
+                          stats['post'][c])
+            self.covars_ = (self.covars_prior + c_n) / \
+                stats['post'][:, np.newaxis, np.newaxis]
+
+    def _batch(self, rng):
+        '''
+        Random subset of sequences with about batch_size rows.
+        '''
+        order = rng.permutation(len(self._lengths))
+        n = np.searchsorted(np.cumsum(self._lengths[order]),
+                            self.batch_size) + 1
+
+        return np.sort(order[:n])
+
+    def fit(self, X, lengths=None, init=True):
+        '''
+        Fits the model.
+        Args:
+            X - array of shape (n_samples, n_features)
+            lengths - lengths of sequences in X, by default one sequence
+            init - initialise parameters from X. If False, parameters are
+                   already set (eg. by from_hmmlearn)
+        Returns:
+            self
+        '''
+        X = _as_float64(X)
+        if init:
+            self._init(X, lengths)
+        self._start(X, lengths)
+        rng = np.random.RandomState(self.random_state)
+        all_seqs = np.arange(len(self._lengths))
+        running = None
+        self.history = []
+        try:
+            for i in range(self.n_iter):
+                if self.batch_size is None:
+                    stats = self._estep(all_seqs)
+                else:
+                    seqs = self._batch(rng)
+                    stats = self._estep(seqs)
+                    scale = float(self._lengths.sum()) / stats['rows']
+                    step = (i + 2) ** -self.step_decay
+                    if running is None:
+                        running = stats
+                        for key in running:
+                            running[key] = running[key] * scale
+                    else:
+                        blended = {}
+                        _add_stats(blended, running, 1 - step)
+                        _add_stats(blended, stats, step * scale)
+                        running = blended
+                    logprob = stats['logprob'] / stats['rows']
+                    stats = running
+                self._do_mstep(stats)
+                if self.batch_size is None:
+                    logprob = stats['logprob']
+                self.history.append(logprob)
+                if self.verbose:
+                    print 'Iteration %s: log likelihood %s' % (i + 1, logprob)
+                    sys.stdout.flush()
+                if (self.batch_size is None and len(self.history) > 1 and
+                        self.history[-1] - self.history[-2] < self.tol):
+                    break
+        finally:
+            self._stop()
+
+        return self
+
+    def score(self, X, lengths=None):
+        '''
+        Returns:
+            log likelihood of X under the model
+        '''
+        self._start(X, lengths)
+        try:
+            return self._estep(np.arange(len(self._lengths)))['logprob']
+        finally:
+            self._stop()
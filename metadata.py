@@ -0,0 +1,140 @@
+# metadata.py
+# Parses camera, recording time and scale from movie and trajectory filenames,
+# for whole directory listings at once.
+
+import datetime as dt
+import os
+import pandas as pd
+import re
+
+# Movie and trajectory filenames, in the formats:
+#     raspberrypiNN-yyyy-mm-dd-HH-MM-SS.h264
+#     raspberrypiNN-yyyy-mm-dd-HH-MM-SS-<scale>-traj.csv
+NAME_RE = re.compile(r'^(?P<stem>(?P<camera>raspberrypi(?P<camera_num>\d+))-'
+                     r'(?P<datetime>\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}))'
+                     r'(?:\.h264|-?(?P<scale>\d+(?:\.\d*)?)-traj\.csv)$')
+TIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
+
+
+def parse_name(filename):
+    '''
+    Parses a single movie or trajectory filename.
+    Args:
+        filename - name or path of file
+    Returns:
+        camera_name, camera_number, date_time, scaling_factor (None for
+        movies)
+    Raises:
+        ValueError if filename is not in a recognised format
+    '''
+    m = NAME_RE.match(os.path.basename(filename))
+    if m is None:
+        raise ValueError('Unrecognised filename %s' % filename)
+    scale = m.group('scale')
+
+    return (m.group('camera'), int(m.group('camera_num')),
+            dt.datetime.strptime(m.group('datetime'), TIME_FORMAT),
+            None if scale is None else float(scale))
+
+
+def parse_names(filenames, time_offset=0):
+    '''
+    Parses a list of movie and/or trajectory filenames. Files which are not in
+    a recognised format are left out.
+    Args:
+        filenames - list of names or paths of files
+        time_offset - hours subtracted from recording time to determine the
+                      date of a recording (for filming overnight)
+    Returns:
+        DataFrame with columns 'path', 'name', 'stem' (camera and time part of
+        name shared by a movie and its trajectory files), 'camera',
+        'camera_num', 'datetime', 'date' and 'scale' (NaN for movies)
+    '''
+    paths = pd.Series(list(filenames), dtype=object)
+    names = paths.map(os.path.basename)
+    parts = names.str.extract(NAME_RE.pattern, expand=True)
+    found = parts['camera'].notnull().values
+
+    df = parts.loc[found, ['stem', 'camera']].copy()
+    df.insert(0, 'path', paths[found].values)
+    df.insert(1, 'name', names[found].values)
+    df['camera_num'] = parts.loc[found, 'camera_num'].astype(int)
+    df['datetime'] = pd.to_datetime(parts.loc[found, 'datetime'],
+                                    format=TIME_FORMAT)
+    df['date'] = (df['datetime'] -
+                  pd.Timedelta(hours=time_offset)).dt.normalize()
+    df['scale'] = parts.loc[found, 'scale'].astype(float)
+
+    return df.reset_index(drop=True)
+
+
+def list_dir(directory, time_offset=0, kind=None):
+    '''
+    Parses all movie and/or trajectory filenames in a directory.
+    Args:
+        directory - directory to list
+        time_offset - passed to parse_names
+        kind - 'movie', 'traj' or None for both
+    Returns:
+        DataFrame returned by parse_names, sorted by name, with paths joined
+        to directory
+    '''
+    names = sorted(os.listdir(directory))
+    df = parse_names([os.path.join(directory, f) for f in names],
+                     time_offset=time_offset)
+    if kind == 'movie':
+        df = df[df.scale.isnull()]
+    elif kind == 'traj':
+        df = df[df.scale.notnull()]
+
+    return df.reset_index(drop=True)
+
+
+def conditions_table(cond_file):
+    '''
+    Reads a conditions csv file with a 'Date' column (dd/mm/yyyy) and a column
+    of conditions for each camera.
+    Args:
+        cond_file - path of conditions file
+    Returns:
+        DataFrame with columns 'camera', 'date' and 'condition'
+    '''
+    cond_df = pd.read_csv(cond_file, parse_dates=['Date'], dayfirst=True)
+    cond_long = pd.melt(cond_df, id_vars=['Date'], var_name='camera',
+                        value_name='condition')
+    cond_long.rename(columns={'Date': 'date'}, inplace=True)
+
+    return cond_long.dropna(subset=['condition'])
+
+
+def join_conditions(names_df, cond_file):
+    '''
+    Adds a 'condition' column to the output of parse_names by joining against
+    a conditions file. Files without a condition are left out.
+    Args:
+        names_df - DataFrame returned by parse_names
+        cond_file - path of conditions file, or DataFrame returned by
+                    conditions_table
+    Returns:
+        joined DataFrame
+    '''
+    if isinstance(cond_file, pd.DataFrame):
+        cond_long = cond_file
+    else:
+        cond_long = conditions_table(cond_file)
+
+    return pd.merge(names_df, cond_long, on=['camera', 'date'], how='inner')
+
+
+def traj_basename(filename, scale):
+    '''
+    Gets the name of the trajectory file for a movie processed at a scale.
+    Args:
+        filename - name or path of movie file
+        scale - scaling factor movie was processed at
+    Returns:
+        name in the format <movie name>-<scale>-traj.csv
+    '''
+    stem = os.path.splitext(os.path.basename(filename))[0]
+
+    return '%s-%s-traj.csv' % (stem, scale)
@@ -2,19 +2,157 @@
 # Tracks multiple bees using Kalman filters
 
 import argparse
+import array
+import collections
+from cond_gen import sample_frames, detect_dish, circle_to_roi, read_index
+from metadata import traj_basename
 from mpl_toolkits.mplot3d import Axes3D
 from multiprocessing import Pool
 import csv
 import cv2
+import itertools
+import json
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import Queue
+import subprocess
+import threading
 import time
+from timeit import default_timer
+import traceback
 from scipy.spatial.distance import cdist
 from sklearn.utils.linear_assignment_ import linear_assignment
 import sys
 assert Axes3D   # Hack to stop pyflakes throwing W0611 imported but unused error
 
+# Stages of the tracker timed by StageTimer, in order of execution
+STAGES = ('decode', 'grayscale', 'log', 'normalise', 'threshold', 'local_max',
+          'weights', 'predict', 'assign', 'correct', 'write')
+
+# batch_worker error for a movie stopped with 'q'
+INTERRUPTED = 'interrupted'
+
+# Histogram bin edges (seconds) for stage timings, 1us to 10s
+TIMING_BINS = np.logspace(-6, 1, 71)
+
+
+class TrackingInterrupted(Exception):
+    '''
+    Raised by process_video when tracking is stopped with 'q', so the movie is
+    not recorded as complete.
+    '''
+    pass
+
+
+class StageTimer:
+    '''
+    Records wall time of each stage of the tracker for every frame. Call
+    start() at the start of a stage sequence and lap(stage) at the end of each
+    stage.
+    '''
+    def __init__(self, stages=STAGES):
+        self.stages = stages
+        self.times = dict((stage, array.array('d')) for stage in stages)
+        self.last = default_timer()
+
+    def start(self):
+        self.last = default_timer()
+
+    def lap(self, stage):
+        now = default_timer()
+        self.times[stage].append(now - self.last)
+        self.last = now
+
+    def summary(self):
+        '''
+        Returns:
+            dictionary indexed by stage, containing count, total, mean, median,
+            p95 and max times in seconds, and histogram counts over
+            TIMING_BINS.
+        '''
+        out = {}
+        for stage in self.stages:
+            t = np.frombuffer(self.times[stage], dtype=np.float64)
+            if len(t) == 0:
+                continue
+            out[stage] = {'count': len(t), 'total': float(t.sum()),
+                          'mean': float(t.mean()),
+                          'median': float(np.median(t)),
+                          'p95': float(np.percentile(t, 95)),
+                          'max': float(t.max()),
+                          # Laps outside TIMING_BINS count in the end bins
+                          'hist': np.histogram(np.clip(t, TIMING_BINS[0],
+                                                       TIMING_BINS[-1]),
+                                               bins=TIMING_BINS)[0].tolist()}
+
+        return out
+
+    def dump(self, path):
+        '''
+        Writes summary to a json file.
+        '''
+        dump_timing(self.summary(), path)
+
+
+def dump_timing(summary, path):
+    '''
+    Writes a stage timing summary to a json file.
+    Args:
+        summary - dictionary returned by StageTimer.summary or merge_timing
+        path - path of json file
+    '''
+    with open(path, 'w') as json_file:
+        json.dump({'bins': TIMING_BINS.tolist(), 'stages': summary},
+                  json_file, indent=1)
+
+
+def merge_timing(paths):
+    '''
+    Combines stage timing summaries, eg. across a batch of movies. Medians and
+    95th percentiles of the combined timings are estimated from the histograms.
+    Args:
+        paths - paths of json files written by StageTimer.dump
+    Returns:
+        combined summary dictionary
+    '''
+    merged = {}
+    for path in paths:
+        with open(path, 'r') as json_file:
+            summary = json.load(json_file)['stages']
+        for stage, stats in summary.items():
+            if stage not in merged:
+                merged[stage] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                 'hist': np.zeros(len(TIMING_BINS) - 1,
+                                                  dtype=np.int64)}
+            merged[stage]['count'] += stats['count']
+            merged[stage]['total'] += stats['total']
+            merged[stage]['max'] = max(merged[stage]['max'], stats['max'])
+            merged[stage]['hist'] += np.array(stats['hist'], dtype=np.int64)
+
+    centres = np.sqrt(TIMING_BINS[1:] * TIMING_BINS[:-1])
+    for stats in merged.values():
+        cumulative = np.cumsum(stats['hist']) / float(max(stats['count'], 1))
+        stats['mean'] = stats['total'] / max(stats['count'], 1)
+        # Files written before laps were clipped into the end bins may leave
+        # laps out of the histogram, so the cumulative fraction can stay
+        # below 0.5 or 0.95
+        last = len(centres) - 1
+        stats['median'] = float(centres[min(np.searchsorted(cumulative, 0.5),
+                                            last)])
+        stats['p95'] = float(centres[min(np.searchsorted(cumulative, 0.95),
+                                         last)])
+        stats['hist'] = stats['hist'].tolist()
+
+    return merged
+
+
+def get_timing_path(out_filename):
+    '''
+    Returns path of stage timing json file for a trajectory file.
+    '''
+    return os.path.splitext(out_filename)[0] + '-timing.json'
+
 
 def get_log_kernel(sigma, show_wireframe=False):
     '''
@@ -46,9 +184,8 @@ def get_log_kernel(sigma, show_wireframe=False):
     return kernel
 
 
-# @profile
 def process_frame(frame, bee_number, log_kernel, roi=[0, 0, -1, -1],
-                  roi_mask=None, scale=1.0, thresh_kernel_size=101):
+                  roi_mask=None, scale=1.0, thresh_kernel_size=101, timer=None):
     '''
     Processes frame to find bee locations.
     Args:
@@ -58,6 +195,7 @@ def process_frame(frame, bee_number, log_kernel, roi=[0, 0, -1, -1],
         roi - list containing top left and bottom right coordinates (indices)
                 of region of interest. By default, whole frame.
         scale - float <= 1.0 scaling factor for frames.
+        timer - optional StageTimer to record stage times with
     Returns:
         List of intermediate process images sorted in revers order (index 0 is
         final processed image).
@@ -77,20 +215,28 @@ def process_frame(frame, bee_number, log_kernel, roi=[0, 0, -1, -1],
         cv2.circle(circlemask, (w / 2, h / 2), int(0.55 * min(h, w)), 255, -1)
     else:
         circlemask = roi_mask
+    if timer is not None:
+        timer.lap('grayscale')
 
     # Apply Laplacian of Gaussian convolution and linearly transform pixels into
     # range [0.0, 1.0]
     p = cv2.filter2D(frameroi, cv2.CV_32F, log_kernel)
+    if timer is not None:
+        timer.lap('log')
     pmax = np.amax(p)
     pmin = np.amin(p)
     norm = (p - pmin) * (1 / (pmax - pmin))
     norm8 = cv2.convertScaleAbs(norm, alpha=255.0)
+    if timer is not None:
+        timer.lap('normalise')
 
     # Threshold smoothed 8 bit image and erode to generate mask
     a_thresh = cv2.adaptiveThreshold(norm8, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
                                      cv2.THRESH_BINARY, thresh_kernel_size, -35)
     a_threshroi = cv2.bitwise_and(a_thresh, circlemask)
     mask = cv2.erode(a_threshroi, np.ones((3, 3)), iterations=1).astype(bool)
+    if timer is not None:
+        timer.lap('threshold')
 
     # Threshold smoothed image
     # ret1, thresh = cv2.threshold(normalised, 0.70, 1.0, cv2.THRESH_TOZERO)
@@ -101,10 +247,28 @@ def process_frame(frame, bee_number, log_kernel, roi=[0, 0, -1, -1],
     # (bees), 0.0 at a contour line around the bees, and 0.5 background.
     l_max = np.array((norm == cv2.dilate(norm, np.ones((3, 3)))) * mask,
                      dtype=np.float32)
+    if timer is not None:
+        timer.lap('local_max')
 
     return [l_max, mask, a_threshroi, norm8, norm, frameroi, frame]
 
 
+def get_observed(p):
+    '''
+    Extracts observed bee coordinates from the output of process_frame.
+    Args:
+        p - list returned by process_frame
+    Returns:
+        numpy array with shape (3, n) containing observed coordinates and a
+        third row containing weights for assignment.
+    '''
+    # Pixels are indexed with the integer indices, not float coordinates
+    rows, cols = np.nonzero(p[0] == 1.0)
+    detected_coords = np.array((rows, cols), dtype=np.float32)
+
+    return np.vstack((detected_coords, p[1][rows, cols]))
+
+
 def reassign(assignment, n, costs, max_dist, weights):
     '''
     Reassignment for non-linear assignment case. This tries to reassign
@@ -268,11 +432,14 @@ class MultiKalman:
         # Call kf.predict() on each Kalman Filter in self.tracks
         return np.hstack(kf.predict() for kf in self.tracks).astype(np.float32)
 
-    def correct(self, unassigned_pos, predicted_pos, current_time):
+    def correct(self, unassigned_pos, predicted_pos, current_time, timer=None):
         '''Calls KalmanFilter.correct on each kalman filter in self.track with
         an appropriate assignment of observations to each kalman filter.
+        Optionally records assignment and correction times with a StageTimer.
         '''
         assignment = assign(unassigned_pos, predicted_pos, self.max_dist)
+        if timer is not None:
+            timer.lap('assign')
         for index in assignment:
             i0, i1 = index[0], index[1]
             if not self.found_dict[self.tracks[i0]]:
@@ -300,6 +467,17 @@ class MultiKalman:
                     self.last_track += 1
 
         self.prev_assignment = assignment
+        if timer is not None:
+            timer.lap('correct')
+
+    def coords(self):
+        '''
+        Returns:
+            list of (track number, y, x) for each Kalman filter, as written by
+            write_coords
+        '''
+        return [(self.track_dict[kf], kf.statePost[0, 0], kf.statePost[1, 0])
+                for kf in self.tracks]
 
     def write_coords(self, current_time, out_file, scale_factor=1.0):
         '''
@@ -313,9 +491,8 @@ class MultiKalman:
             time,[trackNumber,y,x] * number of tracks
         '''
         out_list = [current_time]
-        for kf in self.tracks:
-            out_list.extend([self.track_dict[kf], kf.statePost[0, 0],
-                             kf.statePost[1, 0]])
+        for coords in self.coords():
+            out_list.extend(coords)
         out_file.write(('%f' + ',%i,%f,%f' * len(self.tracks) + '\n')
                        % tuple(out_list))
 
@@ -463,23 +640,154 @@ def get_roi_mask(roi, scale):
     return roi_mask
 
 
+class ArenaModel:
+    '''
+    Follows the position of the dish through a movie. Small grayscale frames
+    are sampled into a rolling buffer every sample_interval seconds, and every
+    update_interval seconds the dish is re-detected in their median. When the
+    dish has moved (eg. the camera was bumped) the region of interest is moved
+    with it, keeping its size, so coordinates stay relative to the dish, and
+    the mask is redrawn around the detected dish to exclude glare outside it.
+    Sampling and updates are timed from start_time, the capture time of the
+    first frame tracked (eg. the start of a chunk).
+    '''
+    def __init__(self, roi, scale, sample_interval=10.0, update_interval=300.0,
+                 buffer_size=9, downsample=0.25, tolerance=2, mask_frac=1.0,
+                 start_time=0.0):
+        self.roi = list(roi)
+        self.scale = scale
+        self.sample_interval = sample_interval
+        self.update_interval = update_interval
+        self.downsample = downsample
+        self.tolerance = tolerance
+        self.mask_frac = mask_frac
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.next_sample = start_time + sample_interval
+        self.next_update = start_time + update_interval
+        self.frame_shape = None
+        self.circle = None
+        self.mask = get_roi_mask(roi, scale)
+
+    def initial_frames(self, filename, start_frame, fps):
+        '''
+        Samples the frames the rolling buffer would hold after tracking from
+        start_frame: buffer_size frames sample_interval seconds apart.
+        '''
+        step = max(int(round(self.sample_interval * fps)), 1)
+        n = self.buffer.maxlen
+        return sample_frames(filename, n=n, step=step, start=start_frame,
+                             stop=start_frame + n * step)
+
+    def add_sample(self, frame):
+        '''
+        Adds a downsampled grayscale frame to the rolling buffer.
+        '''
+        self.frame_shape = frame.shape[:2]
+        self.buffer.append(cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                                      (0, 0), fx=self.downsample,
+                                      fy=self.downsample))
+
+    def initialise(self, frames):
+        '''
+        Estimates the dish position from frames sampled near the start of the
+        segment tracked (see initial_frames). If roi is undefined it is set to
+        the square enclosing the dish.
+        Returns:
+            True if the dish was detected
+        '''
+        for frame in frames:
+            self.add_sample(frame)
+        return self.estimate()
+
+    def update(self, frame, capture_time):
+        '''
+        Samples frame if due and re-estimates the dish position if due.
+        Returns:
+            True if roi and mask have changed
+        '''
+        if capture_time >= self.next_sample:
+            self.add_sample(frame)
+            self.next_sample = capture_time + self.sample_interval
+        if capture_time >= self.next_update:
+            self.next_update = capture_time + self.update_interval
+            return self.estimate()
+        return False
+
+    def estimate(self):
+        '''
+        Detects the dish in the median of the buffer and moves roi and mask.
+        Returns:
+            True if roi and mask have changed
+        '''
+        if len(self.buffer) == 0:
+            return False
+        background = np.median(np.array(self.buffer), axis=0).astype(np.uint8)
+        circle = detect_dish(background)
+        if circle is None:
+            return False
+        circle = tuple(int(round(v / self.downsample)) for v in circle)
+        if self.circle is not None and \
+                max(abs(a - b) for a, b in zip(circle, self.circle)) <= \
+                self.tolerance:
+            return False
+        self.circle = circle
+
+        fh, fw = self.frame_shape
+        if -1 in self.roi:
+            self.roi = list(circle_to_roi(circle[0], circle[1], circle[2],
+                                          self.frame_shape))
+        else:
+            h, w = self.roi[2] - self.roi[0], self.roi[3] - self.roi[1]
+            r0 = min(max(circle[0] - h / 2, 0), fh - h)
+            c0 = min(max(circle[1] - w / 2, 0), fw - w)
+            self.roi = [r0, c0, r0 + h, c0 + w]
+
+        h, w = self.roi[2] - self.roi[0], self.roi[3] - self.roi[1]
+        circlemask = np.zeros((h, w), dtype=np.uint8)
+        cv2.circle(circlemask, (circle[1] - self.roi[1], circle[0] - self.roi[0]),
+                   int(self.mask_frac * circle[2]), 255, -1)
+        self.mask = cv2.resize(circlemask, (0, 0), fx=self.scale,
+                               fy=self.scale)
+        return True
+
+    def write_log(self, capture_time, out_file):
+        '''
+        Writes current dish position to csv file.
+        Format:
+            time,centre_row,centre_col,radius,r0,c0,r1,c1
+        '''
+        out_file.write('%f,%i,%i,%i,%i,%i,%i,%i\n' % (
+            (capture_time,) + tuple(self.circle) + tuple(self.roi)))
+
+
+def get_arena_path(out_filename):
+    '''
+    Returns path of dish position log for a trajectory file.
+    '''
+    return os.path.splitext(out_filename)[0] + '-arena.csv'
+
+
 def get_out_filepath(filename, scale, outpath=''):
     '''
+    Gets path of trajectory file for a movie (see metadata.traj_basename).
+    Args:
+        filename - path of movie file
+        scale - scaling factor movie is processed at
+        outpath - directory to write to. By default same directory as movie.
+    Returns:
+        path of trajectory file
     '''
     if outpath == '':
-        out_filename = filename[:filename.find('.')] + '%s-traj.csv' % scale
-    else:
-        filebsenm = os.path.basename(filename)
-        out_filebsenm = filebsenm[:filebsenm.find('.')] + '-%s-traj.csv' % scale
-        out_filename = os.path.join(outpath, out_filebsenm)
+        outpath = os.path.dirname(filename)
 
-    return out_filename
+    return os.path.join(outpath, traj_basename(filename, scale))
 
 
-# @profile
 def process_video(filename, bee_number, s, roi=[0, 0, -1, -1], scale=1.0,
                   show_video=0, discard=0, fps=25.0, duration=(60 * 60 * 1000),
-                  max_dist=50, reset_time=0.5, quiet=False, outpath=''):
+                  max_dist=50, reset_time=0.5, quiet=False, outpath='',
+                  out_filename=None, start_frame=0, end_frame=None, chunks=1,
+                  overlap=50, timing=False, track_arena=False):
     '''Processes video by running process_frame for each frame in video.
     Args:
         filename - string, name of video to be processed
@@ -497,50 +805,98 @@ def process_video(filename, bee_number, s, roi=[0, 0, -1, -1], scale=1.0,
         max_dist - int distance threshold for assigning observations to bees
         reset_time - float time in seconds before unassigned Kalman filter is
                      reinitialised
+        out_filename - path of output file, by default from get_out_filepath
+        start_frame - int, index of first frame to process
+        end_frame - int, index to stop processing at. By default end of movie.
+        chunks - int, number of time chunks to split the movie into. Each
+                 chunk is tracked in its own process and track identities are
+                 stitched together (see process_video_chunked).
+        overlap - int, frames each chunk overlaps the previous chunk by
+        timing - if True, record time taken by each stage of every frame and
+                 write a summary next to the output (see get_timing_path)
+        track_arena - if True, detect the dish and follow it as it drifts
+                      (see ArenaModel). Positions are logged next to the
+                      output (see get_arena_path).
+    Returns:
+        filename, out_filename, done_frames, ave_fps, h, m, s (print with
+        print_done)
+    Raises:
+        TrackingInterrupted if stopped with 'q' while showing video
     '''
+    if out_filename is None:
+        out_filename = get_out_filepath(filename, scale, outpath=outpath)
+    if chunks > 1:
+        return process_video_chunked(
+            filename, bee_number, s, out_filename, chunks, overlap=overlap,
+            roi=roi, scale=scale, discard=discard, fps=fps, duration=duration,
+            max_dist=max_dist, reset_time=reset_time, quiet=quiet,
+            timing=timing, track_arena=track_arena)
+
     show_index = show_video
     draw_kalman = True
 
-    circlemask = get_roi_mask(roi, scale)
+    arena = None
+    if track_arena:
+        first = max(discard, start_frame)
+        arena = ArenaModel(roi, scale, start_time=first / fps)
+        if arena.initialise(arena.initial_frames(filename, first, fps)):
+            roi = arena.roi
+            arena_out = open(get_arena_path(out_filename), 'w')
+            arena.write_log(first / fps, arena_out)
+        else:
+            arena = None
+            if not quiet:
+                print 'No dish detected in {}, using fixed roi'.format(
+                    filename)
+
+    circlemask = get_roi_mask(roi, scale) if arena is None else arena.mask
     k = get_log_kernel(s)
     mkf = MultiKalman(bee_number, max_dist, reset_time)
     cap = cv2.VideoCapture(filename)
     thresh_k_size = get_thresh_kernel_size(roi, scale)
 
     total_frames = int(fps * duration / 1000)
+    if end_frame is not None:
+        total_frames = min(total_frames, end_frame)
     print_process_header(filename, cap, total_frames, fps, quiet)
 
-    done_frames = 0
-    for i in range(discard):
-        cap.read()
-        done_frames += 1
+    done_frames = max(discard, start_frame)
+    first_frame = done_frames
+    seek_frame(cap, done_frames)
 
-    out_filename = get_out_filepath(filename, scale, outpath=outpath)
     out = open(out_filename, 'w')
 
     start_time = time.clock()
     tictoc = time.clock()
+    last_time = start_time
+    p = []
+    timer = StageTimer() if timing else None
+    interrupted = False
 
-    while 1:
+    while end_frame is None or done_frames < end_frame:
 
         # Read next frame, process and detect. End loop if movie complete.
+        if timer is not None:
+            timer.start()
         ret, frame = cap.read()
         if not ret:
             break
         done_frames += 1
+        if timer is not None:
+            timer.lap('decode')
         p = process_frame(frame, bee_number, k, roi=roi, roi_mask=circlemask,
-                          scale=scale, thresh_kernel_size=thresh_k_size)
+                          scale=scale, thresh_kernel_size=thresh_k_size,
+                          timer=timer)
 
         # Update Kalman filters with tracking observations
-        detected_coords = np.array(np.where(p[0] == 1.0), dtype=np.float32)
-        detected_weights = []
-        for coord in detected_coords.transpose():
-            detected_weights.append(p[1][coord[0], coord[1]])
-
-        observed = np.vstack((detected_coords, detected_weights))
+        observed = get_observed(p)
+        if timer is not None:
+            timer.lap('weights')
         capture_time = done_frames / fps
         pred_coords = mkf.predict(capture_time)
-        mkf.correct(observed, pred_coords, capture_time)
+        if timer is not None:
+            timer.lap('predict')
+        mkf.correct(observed, pred_coords, capture_time, timer=timer)
 
         # Display the resulting frame if show_video is in range, and change
         # which video is displayed on button press.
@@ -548,6 +904,7 @@ def process_video(filename, bee_number, s, roi=[0, 0, -1, -1], scale=1.0,
             show_index, draw_kalman = display_frame(p, show_index, filename,
                                                     draw_kalman, mkf)
             if (show_index, draw_kalman) == (-1, -1):
+                interrupted = True
                 break
 
         # Show percentage complete
@@ -555,24 +912,511 @@ def process_video(filename, bee_number, s, roi=[0, 0, -1, -1], scale=1.0,
             tictoc = show_progress(done_frames, total_frames, tictoc, 100)
 
         # Output to csv file
+        if timer is not None:
+            timer.start()
         mkf.write_coords(capture_time, out)
+        if timer is not None:
+            timer.lap('write')
+
+        # Move region of interest with dish
+        if arena is not None and arena.update(frame, capture_time):
+            roi, circlemask = arena.roi, arena.mask
+            arena.write_log(capture_time, arena_out)
         last_time = time.clock()
 
     # Finalise
     tot_time = last_time - start_time
     m, s = divmod(int(tot_time), 60)
     h, m = divmod(m, 60)
-    ave_fps = done_frames / tot_time
-    if not quiet:
-        print_done((filename, out_filename, done_frames, ave_fps, h, m, s))
+    # Frames tracked by this call, not counting frames seeked past
+    tracked_frames = done_frames - first_frame
+    ave_fps = tracked_frames / tot_time if tot_time > 0 else 0.0
     if show_video in range(len(p)):
         cv2.destroyAllWindows()
 
     cap.release()
     out.close()
+    if timer is not None:
+        timer.dump(get_timing_path(out_filename))
+    if arena is not None:
+        arena_out.close()
+    if interrupted:
+        raise TrackingInterrupted('Stopped tracking {} at frame {}'.format(
+            filename, done_frames))
+    return filename, out_filename, tracked_frames, ave_fps, h, m, s
+
+
+def seek_frame(cap, index):
+    '''
+    Moves a capture so that the next frame read is frame number index. Raw
+    h264 files have no frame index to seek with, so frames are grabbed until
+    index is reached instead.
+    Args:
+        cap - cv2.VideoCapture instance at start of movie
+        index - integer index of next frame to read
+    Returns:
+        True if index was reached
+    '''
+    if index <= 0:
+        return True
+    if cap.set(cv2.CAP_PROP_POS_FRAMES, index):
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == index:
+            return True
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for i in range(index):
+        if not cap.grab():
+            return False
+
+    return True
+
+
+def read_traj_rows(path):
+    '''
+    Reads a raw trajectory file written by MultiKalman.write_coords.
+    Args:
+        path - path of trajectory csv file
+    Returns:
+        array with a row per frame: time,[trackNumber,y,x] * number of tracks
+    '''
+    if os.path.getsize(path) == 0:
+        return np.zeros((0, 1))
+
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+
+def write_traj_rows(rows, out_file):
+    '''
+    Writes trajectory rows in the format of MultiKalman.write_coords.
+    Args:
+        rows - array returned by read_traj_rows
+        out_file - open file to write to
+    '''
+    n = (rows.shape[1] - 1) / 3
+    np.savetxt(out_file, rows, fmt=['%f'] + ['%i', '%f', '%f'] * n,
+               delimiter=',')
+
+
+def traj_rows_to_long(rows, fps):
+    '''
+    Flattens trajectory rows into one entry per track per frame, leaving out
+    tracks which have not been found yet (coordinates at 0, 0).
+    Args:
+        rows - array returned by read_traj_rows
+        fps - frames per second of movie
+    Returns:
+        frame indices, track numbers, (n, 2) array of coordinates
+    '''
+    n = (rows.shape[1] - 1) / 3
+    frames = np.repeat(np.round(rows[:, 0] * fps).astype(np.int64), n)
+    tracks = rows[:, 1::3].ravel().astype(np.int64)
+    coords = np.column_stack((rows[:, 2::3].ravel(), rows[:, 3::3].ravel()))
+    found = (coords != 0).any(axis=1)
+
+    return frames[found], tracks[found], coords[found]
+
+
+def match_tracks(prev_rows, rows, fps, max_dist):
+    '''
+    Matches track numbers in rows to track numbers in prev_rows by their mean
+    distance over the frames both files contain. Only rows in the overlap are
+    compared.
+    Args:
+        prev_rows - trajectory rows of earlier chunk
+        rows - trajectory rows of later chunk, overlapping prev_rows
+        fps - frames per second of movie
+        max_dist - maximum mean distance for tracks to be matched
+    Returns:
+        dictionary with track numbers of rows as keys and matched track
+        numbers of prev_rows as values
+    '''
+    # Overlap window: rows of each chunk within the time span of the other
+    prev_rows = prev_rows[prev_rows[:, 0] >= rows[0, 0] - 0.5 / fps]
+    rows = rows[rows[:, 0] <= prev_rows[-1, 0] + 0.5 / fps] \
+        if prev_rows.shape[0] > 0 else rows[:0]
+    p_frames, p_tracks, p_coords = traj_rows_to_long(prev_rows, fps)
+    frames, tracks, coords = traj_rows_to_long(rows, fps)
+    p_ids = np.unique(p_tracks)
+    ids = np.unique(tracks)
+    if len(p_ids) == 0 or len(ids) == 0:
+        return {}
+
+    costs = np.zeros((len(ids), len(p_ids))) + 1e9
+    for i, track in enumerate(ids):
+        t_frames, t_coords = frames[tracks == track], coords[tracks == track]
+        for j, p_track in enumerate(p_ids):
+            p_mask = p_tracks == p_track
+            # Frames of a track are increasing, so common frames are found in
+            # the earlier track by binary search
+            common = np.in1d(t_frames, p_frames[p_mask])
+            if common.any():
+                p_idx = np.searchsorted(p_frames[p_mask], t_frames[common])
+                costs[i, j] = np.mean(np.sqrt(np.sum(
+                    (t_coords[common] - p_coords[p_mask][p_idx]) ** 2,
+                    axis=1)))
+
+    matches = {}
+    for i, j in linear_assignment(costs):
+        if costs[i, j] < max_dist:
+            matches[ids[i]] = p_ids[j]
+
+    return matches
+
+
+def stitch_chunks(chunk_paths, out_filename, fps, max_dist):
+    '''
+    Joins overlapping chunk trajectory files into a single trajectory file.
+    Track numbers of each chunk are matched to the previous chunk in their
+    overlap, and unmatched tracks are given new numbers, so track numbers are
+    consistent across the whole movie. Rows of each overlap are taken from the
+    earlier chunk.
+    Args:
+        chunk_paths - paths of chunk trajectory files in time order
+        out_filename - path of joined trajectory file
+        fps - frames per second of movie
+        max_dist - maximum mean distance for tracks to be matched
+    Returns:
+        number of frames written, number of tracks matched across chunk
+        boundaries, number of tracks left unmatched
+    '''
+    out = open(out_filename, 'w')
+    prev_rows = None
+    next_track = 0
+    done_frames = 0
+    matched = unmatched = 0
+    for path in chunk_paths:
+        rows = read_traj_rows(path)
+        if rows.shape[0] == 0:
+            continue
+
+        # Rows in the overlap were written with the previous chunk
+        if prev_rows is None:
+            matches = {}
+            keep = np.ones(rows.shape[0], dtype=bool)
+        else:
+            matches = match_tracks(prev_rows, rows, fps, max_dist)
+            keep = rows[:, 0] > prev_rows[-1, 0] + 0.5 / fps
+
+        # Renumber tracks from chunk numbers to global numbers
+        ids = rows[:, 1::3].astype(np.int64)
+        lookup = np.zeros(ids.max() + 1, dtype=np.int64)
+        for track in np.unique(ids[keep]):
+            if track in matches:
+                lookup[track] = matches[track]
+                matched += 1
+            else:
+                lookup[track] = next_track
+                next_track += 1
+                if prev_rows is not None:
+                    unmatched += 1
+        rows = rows[keep]
+        rows[:, 1::3] = lookup[ids[keep]]
+        write_traj_rows(rows, out)
+        done_frames += rows.shape[0]
+        if rows.shape[0] > 0:
+            prev_rows = rows
+
+    out.close()
+    return done_frames, matched, unmatched
+
+
+def process_video_chunked(filename, bee_number, s, out_filename, chunks,
+                          overlap=50, roi=[0, 0, -1, -1], scale=1.0, discard=0,
+                          fps=25.0, duration=(60 * 60 * 1000), max_dist=50,
+                          reset_time=0.5, quiet=False, timing=False,
+                          track_arena=False):
+    '''
+    Processes a single movie in parallel by splitting it into time chunks.
+    Each chunk starts overlap frames before the end of the previous chunk, and
+    track identities are stitched across chunk boundaries with stitch_chunks.
+    Must not be called from a daemonic process (eg. a Pool worker).
+    Args:
+        see process_video
+    Returns:
+        filename, out_filename, done_frames, ave_fps, h, m, s
+    '''
+    total_frames = get_frame_count(filename)
+    if total_frames == 0:
+        total_frames = int(fps * duration / 1000)
+    edges = np.linspace(discard, total_frames, chunks + 1).astype(int)
+
+    jobs = []
+    chunk_paths = []
+    for i in range(chunks):
+        chunk_paths.append('%s.chunk%i' % (out_filename, i))
+        start = edges[i] if i == 0 else max(discard, edges[i] - overlap)
+        jobs.append((filename, (bee_number, s),
+                     {'roi': roi, 'scale': scale, 'show_video': -1,
+                      'fps': fps, 'duration': duration, 'max_dist': max_dist,
+                      'reset_time': reset_time, 'quiet': True,
+                      'out_filename': chunk_paths[i], 'start_frame': start,
+                      'end_frame': edges[i + 1], 'timing': timing,
+                      'track_arena': track_arena}))
+
+    start_time = time.time()
+    pool = Pool(chunks)
+    results = pool.map(batch_worker, jobs)
+    pool.close()
+    pool.join()
+    for chunk_filename, result, error, seconds in results:
+        if error is not None:
+            raise RuntimeError('Chunk of %s failed\n%s' % (chunk_filename,
+                                                             error))
+
+    done_frames, matched, unmatched = stitch_chunks(chunk_paths, out_filename,
+                                                    fps, max_dist)
+    for path in chunk_paths:
+        os.remove(path)
+    if track_arena:
+        with open(get_arena_path(out_filename), 'w') as arena_out:
+            for path in chunk_paths:
+                if os.path.isfile(get_arena_path(path)):
+                    with open(get_arena_path(path), 'r') as arena_in:
+                        arena_out.write(arena_in.read())
+                    os.remove(get_arena_path(path))
+    if timing:
+        timing_paths = [get_timing_path(path) for path in chunk_paths]
+        dump_timing(merge_timing(timing_paths), get_timing_path(out_filename))
+        for path in timing_paths:
+            os.remove(path)
+
+    tot_time = time.time() - start_time
+    m, s = divmod(int(tot_time), 60)
+    h, m = divmod(m, 60)
+    ave_fps = done_frames / tot_time
+    if not quiet:
+        print 'Stitched {} chunks: {} tracks matched, {} unmatched'.format(
+            chunks, matched, unmatched)
+
     return filename, out_filename, done_frames, ave_fps, h, m, s
 
 
+def count_id_switches(rows, ref_rows, fps, max_dist):
+    '''
+    Compares trajectories against reference trajectories of the same movie
+    (eg. a serial run, or ground truth). In each frame, tracks are matched to
+    reference tracks by position. An identity switch is counted whenever a
+    reference track is matched to a different track than it was previously.
+    Args:
+        rows - trajectory rows to test
+        ref_rows - reference trajectory rows
+        fps - frames per second of movie
+        max_dist - maximum distance for tracks to be matched
+    Returns:
+        number of identity switches, number of matches, mean distance between
+        matched positions
+    '''
+    frames, tracks, coords = traj_rows_to_long(rows, fps)
+    r_frames, r_tracks, r_coords = traj_rows_to_long(ref_rows, fps)
+    f_starts = np.searchsorted(frames, np.unique(r_frames))
+    f_ends = np.searchsorted(frames, np.unique(r_frames), side='right')
+    r_bounds = np.hstack((np.searchsorted(r_frames, np.unique(r_frames)),
+                          len(r_frames)))
+
+    last_match = {}
+    switches = matches = 0
+    total_dist = 0.0
+    for i in range(len(f_starts)):
+        t_sl = slice(f_starts[i], f_ends[i])
+        r_sl = slice(r_bounds[i], r_bounds[i + 1])
+        if f_ends[i] == f_starts[i]:
+            continue
+        costs = cdist(r_coords[r_sl], coords[t_sl], 'euclidean')
+        for r_i, t_i in linear_assignment(costs):
+            if costs[r_i, t_i] > max_dist:
+                continue
+            ref_track = r_tracks[r_sl][r_i]
+            track = tracks[t_sl][t_i]
+            if ref_track in last_match and last_match[ref_track] != track:
+                switches += 1
+            last_match[ref_track] = track
+            matches += 1
+            total_dist += costs[r_i, t_i]
+
+    return switches, matches, total_dist / max(matches, 1)
+
+
+def compare_traj_files(path, ref_path, fps=25.0, max_dist=25):
+    '''
+    Prints identity switch rate of a trajectory file against a reference
+    trajectory file of the same movie (see count_id_switches).
+    Returns:
+        number of identity switches, number of matches, mean distance
+    '''
+    switches, matches, mean_dist = count_id_switches(
+        read_traj_rows(path), read_traj_rows(ref_path), fps, max_dist)
+    print '{} vs {}\n{} identity switches in {} matches ({:.3f} per 1000), ' \
+        'mean distance {:.2f}'.format(path, ref_path, switches, matches,
+                                      1000. * switches / max(matches, 1),
+                                      mean_dist)
+
+    return switches, matches, mean_dist
+
+
+def open_stream(source, frame_size):
+    '''
+    Starts an ffmpeg process decoding an h264 byte stream into raw BGR frames.
+    Args:
+        source - '-' to read from stdin, otherwise any ffmpeg input url, eg.
+                 tcp://0.0.0.0:5000?listen to wait for a camera to connect.
+        frame_size - (width, height) of frames in stream
+    Returns:
+        subprocess.Popen instance with frames available on its stdout
+    '''
+    if source == '-':
+        stdin = sys.stdin
+        source = 'pipe:0'
+    else:
+        stdin = None
+    cmd = ['ffmpeg', '-loglevel', 'error', '-fflags', 'nobuffer',
+           '-f', 'h264', '-i', source, '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+           '-s', '%dx%d' % tuple(frame_size), 'pipe:1']
+
+    return subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                            bufsize=frame_size[0] * frame_size[1] * 3)
+
+
+class FrameReader(threading.Thread):
+    '''
+    Reads raw frames from a pipe into a bounded queue. If the tracker falls
+    behind, the oldest queued frame is dropped so latency stays bounded. Frames
+    are queued with their index in the stream so capture times are unaffected
+    by dropped frames.
+    '''
+    def __init__(self, pipe, frame_size, max_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.shape = (frame_size[1], frame_size[0], 3)
+        self.frame_bytes = frame_size[0] * frame_size[1] * 3
+        self.queue = Queue.Queue(max_queue)
+        self.read_frames = 0
+        self.dropped_frames = 0
+
+    def run(self):
+        while 1:
+            buf = self.pipe.read(self.frame_bytes)
+            if len(buf) < self.frame_bytes:
+                break
+            self.read_frames += 1
+            item = (self.read_frames,
+                    np.frombuffer(buf, dtype=np.uint8).reshape(self.shape))
+            while 1:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except Queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped_frames += 1
+                    except Queue.Empty:
+                        pass
+
+        # Signal end of stream
+        self.queue.put(None)
+
+
+def show_stream_status(done_frames, reader, time_at_last_call, frames,
+                       capture_time):
+    '''
+    Displays processing rate and latency of a live stream.
+    Args:
+        done_frames - integer number of frames processed
+        reader - FrameReader instance for stream
+        time_at_last_call - time at last iteration
+        frames - number of frames processed since last call
+        capture_time - capture time of last processed frame
+    Returns:
+        time at this iteration
+    '''
+    toc = time.time()
+    fps = frames / (toc - time_at_last_call)
+    em, es = divmod(int(capture_time), 60)
+    eh, em = divmod(em, 60)
+    sys.stdout.write(
+        '\r{:02d}:{:02d}:{:02d} FPS{:>6.1f} Queued{:>4d} Dropped{:>7d}'.format(
+            eh, em, es, fps, reader.queue.qsize(), reader.dropped_frames))
+    sys.stdout.flush()
+
+    return toc
+
+
+def process_stream(source, bee_number, s, out_filename, roi=[0, 0, -1, -1],
+                   scale=1.0, frame_size=(800, 600), fps=25.0, max_dist=50,
+                   reset_time=0.5, max_latency=1.0, flush_interval=1.0,
+                   quiet=False, callback=None):
+    '''Tracks bees in a live h264 stream, such as raspivid output piped to
+    stdin or sent to a local TCP socket. Trajectory rows are flushed to
+    out_filename as they are produced. To test locally at 25 fps:
+        ffmpeg -re -i movie.h264 -c copy -f h264 - | multi_tracker.py -i -
+    Args:
+        source - '-' for stdin or an ffmpeg input url (see open_stream)
+        bee_number - integer, number of bees to be expected
+        s - int or float, sigma value for laplacian of gaussian kernel
+        out_filename - path of trajectory csv file to write
+        roi - list containing top left and bottom right coordinates (indices)
+                of region of interest. By default, whole frame.
+        scale - float <= 1.0 scale frames by scaling factor
+        frame_size - (width, height) of frames in stream
+        fps - float frames per second of stream, defaults to 25.0
+        max_dist - int distance threshold for assigning observations to bees
+        reset_time - float time in seconds before unassigned Kalman filter is
+                     reinitialised
+        max_latency - float, seconds of frames which may be queued before the
+                      oldest frames are dropped
+        flush_interval - float, seconds of stream between output file flushes
+        callback - optional function called for each frame with the capture
+                   time and MultiKalman.coords(), eg. OnlineDecoder.update
+                   from traj_hmm to classify behaviour live
+    Returns:
+        source, out_filename, done_frames, dropped_frames
+    '''
+    circlemask = get_roi_mask(roi, scale)
+    k = get_log_kernel(s)
+    mkf = MultiKalman(bee_number, max_dist, reset_time)
+    thresh_k_size = get_thresh_kernel_size(roi, scale)
+    flush_frames = max(1, int(flush_interval * fps))
+
+    proc = open_stream(source, frame_size)
+    reader = FrameReader(proc.stdout, frame_size, max(1, int(max_latency * fps)))
+    reader.start()
+    out = open(out_filename, 'w')
+
+    done_frames = 0
+    tictoc = time.time()
+    try:
+        while 1:
+            item = reader.queue.get()
+            if item is None:
+                break
+            frame_index, frame = item
+            done_frames += 1
+            p = process_frame(frame, bee_number, k, roi=roi,
+                              roi_mask=circlemask, scale=scale,
+                              thresh_kernel_size=thresh_k_size)
+            capture_time = frame_index / fps
+            pred_coords = mkf.predict(capture_time)
+            mkf.correct(get_observed(p), pred_coords, capture_time)
+            mkf.write_coords(capture_time, out)
+            if callback is not None:
+                callback(capture_time, mkf.coords())
+
+            if done_frames % flush_frames == 0:
+                out.flush()
+                if not quiet:
+                    tictoc = show_stream_status(done_frames, reader, tictoc,
+                                                flush_frames, capture_time)
+    except KeyboardInterrupt:
+        proc.terminate()
+
+    out.close()
+    proc.wait()
+    if not quiet:
+        print '\n{} -> {}\n{} Frames, {} Dropped'.format(
+            source, out_filename, done_frames, reader.dropped_frames)
+
+    return source, out_filename, done_frames, reader.dropped_frames
+
+
 def print_done(tup):
     '''
     Prints summary
@@ -588,18 +1432,25 @@ def parse_conditions(path_tup):
     '''
     Parses conditions file.
     Args:
-        path_tup - path of conditions file, movie directory
+        path_tup - path of conditions file, movie directory. The conditions
+                   file may also be a movie index (.db) built by cond_gen.
     Returns:
         list of movie filenames, dictionary with filenames as keys and
         bee_number as values
     '''
     b_ref = {'1': 1, '2': 2, '3': 2, '4': 4}
-    csv_file = open(path_tup[0], 'r')
-    csv_reader = csv.reader(csv_file)
+    if path_tup[0][-3:] == '.db':
+        lines = [[str(v) for v in row] for row in read_index(path_tup[0])]
+        for line in lines:
+            if line[2] == 'None':
+                line[2:6] = ['0', '0', '-1', '-1']
+    else:
+        csv_file = open(path_tup[0], 'r')
+        lines = csv.reader(csv_file)
     movie_list = []
     b = {}
     r = {}
-    for line in csv_reader:
+    for line in lines:
         movie = path_tup[1] + line[0]
         b[movie] = b_ref[line[1]]
         r[movie] = [int(line[i]) for i in range(2, 6)]
@@ -619,6 +1470,190 @@ def create_dir(path):
                 raise
 
 
+def get_frame_count(filename):
+    '''
+    Gets the number of frames in a movie from its container.
+    Args:
+        filename - path of movie file
+    Returns:
+        integer number of frames, 0 if the container does not record it (eg.
+        raw h264 files)
+    '''
+    cap = cv2.VideoCapture(filename)
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    return max(frames, 0)
+
+
+# process_video keywords which do not change its output
+DISPLAY_KWDS = ('show_video', 'quiet', 'outpath', 'out_filename', 'timing')
+
+
+def job_key(job):
+    '''
+    Identifies the output of a batch job, so a completed movie is only
+    skipped when it would be tracked to the same file with the same settings.
+    Args:
+        job - tuple (filename, args, kwds) passed to process_video
+    Returns:
+        movie filename, output trajectory path, json string of tracking
+        parameters
+    '''
+    filename, args, kwds = job
+    out_filename = kwds.get('out_filename')
+    if out_filename is None:
+        out_filename = get_out_filepath(filename, kwds.get('scale', 1.0),
+                                        outpath=kwds.get('outpath', ''))
+    params = dict((k, v) for k, v in kwds.items() if k not in DISPLAY_KWDS)
+    params['args'] = args
+
+    return filename, out_filename, json.dumps(
+        params, sort_keys=True, default=lambda o: o.tolist())
+
+
+def read_manifest(manifest_path):
+    '''
+    Reads a batch manifest of completed movies.
+    Args:
+        manifest_path - path of manifest csv file
+    Returns:
+        dictionary with job_key tuples as keys and output trajectory paths as
+        values. Movies whose output file no longer exists, and rows written
+        without parameters, are left out.
+    '''
+    done = {}
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return done
+    with open(manifest_path, 'r') as manifest_file:
+        for line in csv.reader(manifest_file):
+            if len(line) > 6 and os.path.isfile(line[1]):
+                done[(line[0], line[1], line[6])] = line[1]
+
+    return done
+
+
+def write_manifest_row(manifest_path, result, seconds, params):
+    '''
+    Appends a completed process_video result to a batch manifest.
+    Args:
+        manifest_path - path of manifest csv file
+        result - tuple returned by process_video
+        seconds - wall time taken to process movie
+        params - tracking parameters of the job (from job_key)
+    Format:
+        movie,out_filename,frames,fps,seconds,completion time,parameters
+    '''
+    if manifest_path is None:
+        return None
+    with open(manifest_path, 'ab') as manifest_file:
+        csv.writer(manifest_file).writerow([
+            result[0], result[1], '%i' % result[2], '%.2f' % result[3],
+            '%.1f' % seconds, time.strftime('%Y-%m-%d-%H-%M-%S'), params])
+
+    return None
+
+
+def batch_worker(job):
+    '''
+    Runs process_video for one batch job. Exceptions are caught and returned
+    so that a failed movie is reported instead of silently lost.
+    Args:
+        job - tuple (filename, args, kwds) passed to process_video
+    Returns:
+        filename, process_video result (None if failed or interrupted),
+        traceback string (None if successful, INTERRUPTED if stopped with
+        'q'), wall time in seconds
+    '''
+    filename, args, kwds = job
+    tic = time.time()
+    try:
+        result = process_video(filename, *args, **kwds)
+        return filename, result, None, time.time() - tic
+    except TrackingInterrupted:
+        return filename, None, INTERRUPTED, time.time() - tic
+    except Exception:
+        return filename, None, traceback.format_exc(), time.time() - tic
+
+
+def run_batch(jobs, processes=1, manifest_path=None, timing_path=None):
+    '''
+    Processes a batch of movies. Jobs are ordered longest first and handed to
+    each worker as soon as it is free, so long movies do not hold up the end
+    of the batch. Completed movies are recorded in the manifest and skipped if
+    the batch is restarted with the same output paths and parameters (see
+    job_key).
+    Args:
+        jobs - list of (filename, args, kwds) tuples passed to process_video
+        processes - number of worker processes. 1 processes in this process,
+                    0 uses all processors.
+        manifest_path - path of manifest csv file, None to disable resuming
+        timing_path - path to write combined stage timings of the movies
+                      processed to. Jobs must be run with timing enabled.
+    Returns:
+        failures - list of (filename, traceback string) for movies which
+                   failed
+        completed - number of movies processed. Skipped and interrupted
+                    movies are not counted, and interrupted movies are
+                    neither failed nor recorded as complete.
+    '''
+    done = read_manifest(manifest_path)
+    keys = dict((job[0], job_key(job)) for job in jobs)
+    pending = [job for job in jobs if keys[job[0]] not in done]
+    if len(done) > 0:
+        print 'Skipping {} completed files listed in {}'.format(
+            len(jobs) - len(pending), manifest_path)
+
+    # Longest first, using container frame counts and file size for movies
+    # without a frame count.
+    pending.sort(key=lambda job: (get_frame_count(job[0]),
+                                  os.path.getsize(job[0])), reverse=True)
+
+    if processes == 1:
+        pool = None
+        results = itertools.imap(batch_worker, pending)
+    else:
+        pool = Pool(processes if processes > 0 else None)
+        results = pool.imap_unordered(batch_worker, pending)
+
+    start_time = time.time()
+    total_frames = 0
+    failures = []
+    timing_paths = []
+    interrupted = 0
+    for filename, result, error, seconds in results:
+        if error is None:
+            print_done(result)
+            write_manifest_row(manifest_path, result, seconds,
+                               keys[filename][2])
+            total_frames += result[2]
+            timing_paths.append(get_timing_path(result[1]))
+        elif error == INTERRUPTED:
+            print 'Interrupted {}, not recorded as complete'.format(filename)
+            interrupted += 1
+        else:
+            print 'FAILED {}\n{}'.format(filename, error)
+            failures.append((filename, error))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    tot_time = time.time() - start_time
+    completed = len(pending) - len(failures) - interrupted
+    if tot_time > 0:
+        print '{} Frames from {} files, {:.1f} FPS across all workers'.format(
+            total_frames, completed, total_frames / tot_time)
+    if timing_path is not None and len(timing_paths) > 0:
+        dump_timing(merge_timing(timing_paths), timing_path)
+        print 'Stage timings written to {}'.format(timing_path)
+    if len(failures) > 0:
+        print '{} files failed:\n{}'.format(
+            len(failures), '\n'.join(f[0] for f in failures))
+
+    return failures, completed
+
+
 def main():
     # Set up command line interface
     parser = argparse.ArgumentParser(description='Process multiple bee movies.')
@@ -631,7 +1666,9 @@ def main():
                         value enables multiprocessing to process multiple files
                         in parallel. 0 Enables maximum processors.
                         Enables quiet mode. Not recommended to use in
-                        conjunction with 'v'.''')
+                        conjunction with 'v'. Completed files are recorded in
+                        manifest.csv next to the outputs and skipped when the
+                        batch is rerun.''')
 
     parser.add_argument('-s', default=16, type=float, required=False,
                         metavar='Sigma',
@@ -683,13 +1720,56 @@ def main():
 
     parser.add_argument('-c', default=['', ''], type=str, required=False,
                         nargs=2, metavar=('ConditionsCSV', 'MovieDir'),
-                        help='''Input Conditions CSV file. If this is set
-                        then MovieFiles, -r and -b will be ignored.''')
+                        help='''Input Conditions CSV file, or movie index
+                        (.db) from cond_gen. If this is set then MovieFiles, -r
+                        and -b will be ignored.''')
 
     parser.add_argument('-o', default='', type=str, required=False,
                         metavar='Path', help='''Path to output trajectory csv
                         files to. (Default is same directory as movies)''')
 
+    parser.add_argument('-i', default='', type=str, required=False,
+                        metavar='Source',
+                        help='''Track a live h264 stream instead of movie
+                        files. '-' reads from stdin, otherwise an ffmpeg url
+                        such as tcp://0.0.0.0:5000?listen. Trajectories are
+                        written continuously.''')
+
+    parser.add_argument('-W', nargs=2, default=[800, 600], type=int,
+                        required=False, metavar=('Width', 'Height'),
+                        help='Frame size of live stream (default 800 600).')
+
+    parser.add_argument('-L', default=1.0, type=float, required=False,
+                        metavar='MaxLatency',
+                        help='''Seconds of live stream which may be queued
+                        before frames are dropped (default 1.0).''')
+
+    parser.add_argument('-K', default=1, type=int, required=False,
+                        metavar='Chunks',
+                        help='''Split each movie into K time chunks which are
+                        tracked in parallel and stitched together. Files are
+                        then processed one at a time, ignoring -M.''')
+
+    parser.add_argument('-O', default=50, type=int, required=False,
+                        metavar='OverlapFrames',
+                        help='Frames of overlap between chunks (default 50).')
+
+    parser.add_argument('-T', action='store_true',
+                        help='''Record time taken by each tracking stage and
+                        write json summaries next to each output and for the
+                        whole batch (timing.json).''')
+
+    parser.add_argument('-A', action='store_true',
+                        help='''Detect the dish in each movie and move the
+                        region of interest with it if the camera drifts.
+                        Dish positions are logged next to the output.''')
+
+    parser.add_argument('-R', default='', type=str, required=False,
+                        metavar='ReferenceTraj',
+                        help='''Serial trajectory file to compare the output
+                        of a single movie against. Prints identity switch
+                        rate.''')
+
     parser.add_argument('MovieFiles', type=str, nargs='*',
                         help='The paths of each movie file to be processed.')
 
@@ -706,6 +1786,15 @@ def main():
     else:
         vid_index = -1
 
+    if len(args.i) > 0:
+        stream_name = time.strftime('stream-%Y-%m-%d-%H-%M-%S.h264')
+        process_stream(args.i, args.b, args.s * args.S,
+                       get_out_filepath(stream_name, args.S, outpath=args.o),
+                       roi=args.r, scale=args.S, frame_size=args.W,
+                       fps=args.f, max_dist=args.m * args.S,
+                       reset_time=args.t, max_latency=args.L, quiet=args.q)
+        return None
+
     if len(args.c[0]) > 0:
         movie_files, b, r = parse_conditions(args.c)
     else:
@@ -718,42 +1807,47 @@ def main():
 
     sigma = args.s * args.S
 
-    s_time = time.clock()
-    if args.M == 1:
-        for filename in movie_files:
-            print 'Processing %s' % filename
-            process_video(filename, b[filename], sigma, roi=r[filename],
-                          scale=args.S, show_video=vid_index, discard=args.d,
-                          max_dist=args.m * args.S, fps=args.f,
-                          duration=args.D, reset_time=args.t, quiet=args.q,
-                          outpath=args.o)
+    if len(args.o) > 0:
+        manifest_path = os.path.join(args.o, 'manifest.csv')
+    elif len(movie_files) > 0:
+        manifest_path = os.path.join(os.path.dirname(movie_files[0]),
+                                     'manifest.csv')
     else:
-        # Multiple processes will be used
-        if args.M == 0:
-            p = Pool()
-        else:
-            p = Pool(args.M)
-        for filename in movie_files:
-            print 'Processing %s' % filename
-            p.apply_async(process_video,
-                          args=(filename, b[filename], sigma),
-                          kwds={'roi': r[filename], 'scale': args.S,
-                                'show_video': vid_index,
-                                'discard': args.d, 'fps': args.f,
-                                'duration': args.D, 'max_dist': args.m * args.S,
-                                'reset_time': args.t, 'quiet': True,
-                                'outpath': args.o},
-                          callback=print_done)
-
-        # Close processes when done
-        p.close()
-        p.join()
-
-    t = time.clock() - s_time
+        manifest_path = None
+
+    jobs = []
+    for filename in movie_files:
+        jobs.append((filename, (b[filename], sigma),
+                     {'roi': r[filename], 'scale': args.S,
+                      'show_video': vid_index, 'discard': args.d,
+                      'fps': args.f, 'duration': args.D,
+                      'max_dist': args.m * args.S, 'reset_time': args.t,
+                      'quiet': args.q if args.M == 1 else True,
+                      'outpath': args.o, 'chunks': args.K,
+                      'overlap': args.O, 'timing': args.T,
+                      'track_arena': args.A}))
+
+    s_time = time.time()
+    if args.T and manifest_path is not None:
+        timing_path = os.path.join(os.path.dirname(manifest_path),
+                                   'timing.json')
+    else:
+        timing_path = None
+    failures, completed = run_batch(
+        jobs, processes=args.M if args.K == 1 else 1,
+        manifest_path=manifest_path, timing_path=timing_path)
+    if len(args.R) > 0 and len(movie_files) == 1:
+        compare_traj_files(get_out_filepath(movie_files[0], args.S,
+                                            outpath=args.o),
+                           args.R, fps=args.f, max_dist=args.m * args.S)
+
+    t = time.time() - s_time
     m, s = divmod(int(t), 60)
     h, m = divmod(m, 60)
     print 'Done... Processed {} files in {:02d}:{:02d}:{:02d}'.format(
-        len(movie_files), h, m, s)
+        completed, h, m, s)
+    if len(failures) > 0:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,287 @@
+# pipeline.py
+# Watches the movie directory, tracks new movies on a worker pool as they
+# arrive and post-processes each day as soon as its movies have been tracked.
+
+import argparse
+from cond_gen import get_dict, get_roi_auto, read_roi_cache, \
+    write_roi_cache, update_index, read_index
+import datetime as dt
+from metadata import list_dir
+from multi_tracker import batch_worker, read_manifest, write_manifest_row, \
+    print_done, create_dir, job_key
+from multiprocessing import Pool
+import os
+from post_process import process_trajectories
+import Queue
+import sys
+import time
+import traceback
+
+BEE_NUMBERS = {'1': 1, '2': 2, '3': 2, '4': 4}
+
+
+def post_worker(job):
+    '''
+    Runs process_trajectories for one day.
+    Args:
+        job - tuple (day, args, kwds) passed to process_trajectories, where day
+              is (condition, datetime.date)
+    Returns:
+        day, traceback string (None if successful), wall time in seconds
+    '''
+    day, args, kwds = job
+    tic = time.time()
+    try:
+        process_trajectories(*args, days=[day], **kwds)
+        return day, None, time.time() - tic
+    except Exception:
+        return day, traceback.format_exc(), time.time() - tic
+
+
+class Pipeline:
+    '''
+    Polls a movie directory. Each poll:
+        - detects regions of interest for new cameras/dates (optional)
+        - updates the movie index with dates, conditions and regions of
+          interest
+        - schedules tracking of new movies which have not been modified for
+          min_age seconds
+        - schedules post-processing of days with newly tracked movies once no
+          movies of the day are waiting to be tracked
+    Tracked movies are recorded in manifest.csv in traj_dir (see
+    multi_tracker.run_batch), so a restarted pipeline carries on where it left
+    off.
+    '''
+    def __init__(self, movie_dir, cond_file, traj_dir, processed_dir,
+                 index_file=None, processes=2, sigma=16.0, scale=1.0,
+                 time_offset=9, min_age=60.0, auto_roi=True, track_kwds={},
+                 post_kwds={}):
+        self.movie_dir = movie_dir
+        self.cond_file = cond_file
+        self.traj_dir = traj_dir
+        self.processed_dir = processed_dir
+        if index_file is None:
+            index_file = os.path.join(traj_dir, 'movies.db')
+        self.index_file = index_file
+        self.sigma = sigma
+        self.scale = scale
+        self.time_offset = time_offset
+        self.min_age = min_age
+        self.auto_roi = auto_roi
+        self.track_kwds = track_kwds
+        self.post_kwds = post_kwds
+
+        create_dir(traj_dir)
+        create_dir(processed_dir)
+        self.manifest_path = os.path.join(traj_dir, 'manifest.csv')
+        self.done = read_manifest(self.manifest_path)
+        # Movies being tracked, with their job_key
+        self.running = {}
+        self.failed = set()
+        self.movie_day = {}
+        self.roi_failed = set()
+        self.dirty = None
+        self.post_running = set()
+        self.results = Queue.Queue()
+        self.track_pool = Pool(processes if processes > 0 else None)
+        self.post_pool = Pool(1)
+
+    def detect_rois(self):
+        '''
+        Detects the dish in the first movie of each camera and date without a
+        cached region of interest, and adds it to roi_cache.csv. If no dish is
+        detected, nothing is cached and the next movie of that camera and
+        date is tried.
+        '''
+        cache_file = os.path.join(self.movie_dir, 'roi_cache.csv')
+        cache = read_roi_cache(cache_file)
+        movies = list_dir(self.movie_dir, time_offset=self.time_offset,
+                          kind='movie')
+        now = time.time()
+        found = False
+        for path, camera, date in zip(movies.path, movies.camera,
+                                      movies.date):
+            key = (camera, date.date())
+            if (key in cache or path in self.roi_failed or
+                    now - os.path.getmtime(path) < self.min_age):
+                continue
+            try:
+                roi, detected = get_roi_auto(path, confirm=False,
+                                             return_detected=True)
+            except Exception:
+                detected = False
+            if detected:
+                cache[key] = roi
+                found = True
+                print 'Region of interest for %s %s: %s' % (key + (roi,))
+            else:
+                self.roi_failed.add(path)
+                print 'Could not detect region of interest in %s' % path
+
+        if found:
+            write_roi_cache(cache_file, cache)
+
+    def schedule_tracking(self):
+        '''
+        Updates the movie index and submits new movies for tracking. On the
+        first call, days with movies tracked before a restart are marked for
+        post-processing.
+        '''
+        first = self.dirty is None
+        if first:
+            self.dirty = set()
+        update_index(self.movie_dir, self.index_file,
+                     in_dict=get_dict(self.cond_file),
+                     time_offset=self.time_offset)
+        now = time.time()
+        for row in read_index(self.index_file, columns=(
+                'filename', 'condition', 'date', 'mtime', 'r0', 'c0', 'r1',
+                'c1')):
+            if row[1] not in BEE_NUMBERS:
+                continue
+            path = os.path.join(self.movie_dir, row[0])
+            day = (int(row[1]), dt.datetime.strptime(row[2],
+                                                     '%Y-%m-%d').date())
+            self.movie_day[path] = day
+            roi = [0, 0, -1, -1] if row[4] is None else list(row[4:8])
+            kwds = {'roi': roi, 'scale': self.scale, 'show_video': -1,
+                    'max_dist': 25 * self.scale, 'quiet': True,
+                    'outpath': self.traj_dir}
+            kwds.update(self.track_kwds)
+            job = (path, (BEE_NUMBERS[row[1]], self.sigma * self.scale), kwds)
+            key = job_key(job)
+            if first and key in self.done:
+                self.dirty.add(day)
+            if (key in self.done or path in self.running or
+                    path in self.failed or now - row[3] < self.min_age):
+                continue
+            self.running[path] = key
+            self.track_pool.apply_async(batch_worker, (job,),
+                                        callback=self.results.put)
+
+    def collect(self):
+        '''
+        Records results of finished tracking and post-processing jobs.
+        '''
+        while 1:
+            try:
+                result = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            if len(result) == 3:
+                day, error, seconds = result
+                self.post_running.discard(day)
+                if error is None:
+                    print 'Processed condition %s, %s in %.0fs' % (
+                        day + (seconds,))
+                else:
+                    print 'FAILED post-processing %s, %s\n%s' % (
+                        day + (error,))
+                continue
+
+            filename, result, error, seconds = result
+            key = self.running.pop(filename)
+            if error is None:
+                print_done(result)
+                write_manifest_row(self.manifest_path, result, seconds, key[2])
+                self.done[key] = result[1]
+                self.dirty.add(self.movie_day[filename])
+            else:
+                print 'FAILED {}\n{}'.format(filename, error)
+                self.failed.add(filename)
+        sys.stdout.flush()
+
+    def schedule_post_processing(self):
+        '''
+        Submits post-processing of days with newly tracked movies, once no
+        movies of the day are being tracked. New hours are appended to the
+        day's outputs (see post_process.process_trajectories).
+        '''
+        busy = set(self.movie_day[f] for f in self.running)
+        for day in sorted(self.dirty - busy - self.post_running):
+            self.dirty.discard(day)
+            self.post_running.add(day)
+            kwds = {'append': True}
+            kwds.update(self.post_kwds)
+            kwds.update(time_offset=self.time_offset,
+                        index_file=self.index_file)
+            job = (day, (self.traj_dir, None, self.processed_dir), kwds)
+            self.post_pool.apply_async(post_worker, (job,),
+                                       callback=self.results.put)
+
+    def poll(self):
+        if self.auto_roi:
+            self.detect_rois()
+        self.schedule_tracking()
+        self.collect()
+        self.schedule_post_processing()
+
+    def run(self, interval=60.0):
+        '''
+        Polls every interval seconds until interrupted.
+        '''
+        try:
+            while 1:
+                self.poll()
+                time.sleep(interval)
+        finally:
+            self.track_pool.terminate()
+            self.post_pool.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Watch a movie directory,
+                                     tracking new movies and post-processing
+                                     each day as its movies are tracked.''')
+
+    parser.add_argument('-o', default='.', type=str, metavar='OutDir',
+                        help='''Directory for trajectory files (OutDir/traj)
+                        and post-processed days (OutDir/ProcessedFiles).''')
+
+    parser.add_argument('-M', default=2, type=int, metavar='Processes',
+                        help='''Tracking worker processes (default 2, 0 uses
+                        all processors).''')
+
+    parser.add_argument('-s', default=16, type=float, metavar='Sigma',
+                        help='Sigma passed to multi_tracker (default 16).')
+
+    parser.add_argument('-S', default=1.0, type=float, metavar='Scale',
+                        help='Scale passed to multi_tracker (default 1.0).')
+
+    parser.add_argument('-t', default=9, type=int, metavar='HourOffset',
+                        help='''Hour offset for determining the date of a
+                        movie (default 9).''')
+
+    parser.add_argument('-a', default=60.0, type=float, metavar='MinAge',
+                        help='''Only track movies not modified for this many
+                        seconds (default 60).''')
+
+    parser.add_argument('-i', default=60.0, type=float, metavar='Interval',
+                        help='Seconds between polls (default 60).')
+
+    parser.add_argument('-n', action='store_true', help='''Do not detect
+                        regions of interest, only use roi_cache.csv written by
+                        cond_gen.py.''')
+
+    parser.add_argument('-A', action='store_true',
+                        help='Follow drift of the dish (see multi_tracker -A).')
+
+    parser.add_argument('ConditionsFile', type=str,
+                        help='The path of the conditions csv file.')
+
+    parser.add_argument('MovieDir', type=str,
+                        help='Directory movies are copied to.')
+
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args.MovieDir, args.ConditionsFile,
+                        os.path.join(args.o, 'traj'),
+                        os.path.join(args.o, 'ProcessedFiles'),
+                        processes=args.M, sigma=args.s, scale=args.S,
+                        time_offset=args.t, min_age=args.a,
+                        auto_roi=not args.n,
+                        track_kwds={'track_arena': args.A})
+    pipeline.run(args.i)
+
+if __name__ == '__main__':
+    main()
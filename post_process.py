@@ -1,21 +1,205 @@
 # Cleans up trajectory files and joins them into one file.
 
 import argparse
+from cond_gen import read_index
+import ctypes
+import collections
 import cv2
 import datetime as dt
 import gc
+import json
+from metadata import parse_name, list_dir, join_conditions, TIME_FORMAT
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import LineCollection
 from matplotlib.colors import LogNorm
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 assert Axes3D
 from multi_tracker import get_log_kernel, process_frame, get_roi_mask, \
-    get_thresh_kernel_size
+    get_thresh_kernel_size, create_dir, get_observed, MultiKalman
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 from numpy.linalg import norm
 import os
 import pandas as pd
+import Queue
 import sys
+import threading
+from traj_store import partition_path, list_partitions, is_partition, \
+    read_partition, write_partition, iter_row_groups, read_meta, \
+    truncate_partition
+import zipfile
+
+# Column types of trajectory DataFrames. Missing states are -1.
+# Times stay float64 seconds rather than a frame index and fps: trajectory
+# files record only the capture time in seconds (MultiKalman.write_coords),
+# fps is a per-run tracker argument that is not stored with them and may
+# differ between movies (see cond_gen.probe_movie), and times of a day are
+# offset by the wall-clock start of each file. A float32 time late in a day
+# is only resolved to ~8ms, too coarse for the 40ms differences velocities
+# are calculated from.
+TRAJ_DTYPES = {'traj': np.uint32, 't': np.float64, 'x': np.float32,
+               'y': np.float32, 'angle': np.float32, 'speed': np.float32,
+               'rotation': np.float32, 'd_mid': np.float32, 'd': np.float32,
+               'state': np.int8, 'thresh': np.int8}
+
+# Version of the arrays cached by aggregate_figs. Caches of another version
+# are recomputed.
+AGGREGATE_VERSION = 3
+
+# Version of day manifest entries. Days recorded by another version are
+# rebuilt.
+DAY_VERSION = 3
+
+
+def compact_dtypes(df):
+    '''
+    Converts columns (and a 'traj' index) of a trajectory DataFrame to
+    TRAJ_DTYPES in place. NaN states are converted to -1.
+    Args:
+        df - trajectory or distance DataFrame
+    Returns:
+        df
+    '''
+    for col in df.columns:
+        dtype = TRAJ_DTYPES.get(col)
+        if dtype is None or df[col].dtype == dtype:
+            continue
+        if dtype == np.int8:
+            df[col] = df[col].fillna(-1).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    if df.index.name == 'traj' and df.index.dtype != np.uint32:
+        df.index = df.index.astype(np.uint32)
+
+    return df
+
+
+def read_traj_csv(path, index_col='traj', usecols=None):
+    '''
+    Reads a processed trajectory (or distance) csv file with compact dtypes.
+    Args:
+        path - path of csv file
+        index_col - column to index by
+        usecols - columns to read, by default all
+    Returns:
+        DataFrame
+    '''
+    # Integer columns may contain NaN, so are converted after reading
+    dtype = dict((col, dtype) for col, dtype in TRAJ_DTYPES.items()
+                 if dtype == np.float32)
+    df = pd.read_csv(path, index_col=index_col, usecols=usecols, dtype=dtype)
+
+    return compact_dtypes(df)
+
+
+def read_traj(path, columns=None, trange=None, index_col='traj'):
+    '''
+    Reads processed trajectory (or distance) data from a csv file or a
+    columnar store partition (see traj_store). From a partition only the
+    requested columns are decompressed and row groups outside trange are
+    skipped.
+    Args:
+        path - path of csv file or partition directory
+        columns - columns to read (not including index_col), by default all
+        trange - (start, end) only read rows with start <= t < end
+        index_col - column to index by, or None for a default index
+    Returns:
+        DataFrame
+    '''
+    read_cols = None
+    if columns is not None:
+        read_cols = list(columns)
+        if index_col is not None and index_col not in read_cols:
+            read_cols.insert(0, index_col)
+        if trange is not None and 't' not in read_cols:
+            read_cols.append('t')
+
+    if is_partition(path):
+        ranges = None if trange is None else {'t': trange}
+        df = read_partition(path, columns=read_cols, ranges=ranges)
+        compact_dtypes(df)
+        if index_col is not None:
+            df.set_index(index_col, inplace=True)
+    else:
+        df = read_traj_csv(path, index_col=index_col, usecols=read_cols)
+        if trange is not None:
+            df = df[(df.t.values >= trange[0]) & (df.t.values < trange[1])]
+
+    if columns is not None:
+        df = df[[c for c in columns if c != index_col]]
+    return compact_dtypes(df)
+
+
+def write_processed(df, path, append=False):
+    '''
+    Writes processed data to a csv file, or to a columnar store partition if
+    path does not end in .csv.
+    Args:
+        df - trajectory or distance DataFrame
+        path - path of csv file or partition directory
+        append - append to existing data
+    '''
+    if path.endswith('.csv'):
+        df.to_csv(path, mode='a' if append else 'w', header=not append)
+    else:
+        write_partition(df, path, append=append)
+
+
+def processed_path(directory, kind, condition, date_str):
+    '''
+    Gets the path of processed data for a day, preferring a columnar store
+    partition over a csv file.
+    Args:
+        directory - directory processed data is stored in
+        kind - 'trajectory' or 'distance'
+        condition - condition number
+        date_str - date in format YYYY-MM-DD
+    Returns:
+        path of partition directory or csv file
+    '''
+    path = partition_path(directory, kind, condition, date_str)
+    if is_partition(path):
+        return path
+    return '%s/cond%s/%s/%s.csv' % (directory, condition, kind, date_str)
+
+
+def list_processed(directory, conditions=[1, 2, 3, 4], kind='trajectory'):
+    '''
+    Lists processed data for each day, in csv files
+    (<directory>/cond<c>/<kind>/<date>.csv) or a columnar store in directory.
+    Days in both are read from the store.
+    Returns:
+        list of (condition, date_str, path) tuples, sorted
+    '''
+    days = {}
+    for c in conditions:
+        csv_dir = '%s/cond%s/%s' % (directory, c, kind)
+        if os.path.isdir(csv_dir):
+            for f in os.listdir(csv_dir):
+                if f[-4:] == '.csv':
+                    days[(c, f[:-4])] = '/'.join((csv_dir, f))
+    parts = list_partitions(directory, kind=kind)
+    for c, date_str, path in zip(parts.condition, parts.date, parts.path):
+        if c in conditions:
+            days[(c, date_str)] = path
+
+    return [key + (days[key],) for key in sorted(days)]
+
+
+def csv_to_store(directory, conditions=[1, 2, 3, 4]):
+    '''
+    Converts processed csv files in directory into a columnar store in the
+    same directory. The csv files are left in place.
+    '''
+    for kind, index_col in (('trajectory', 'traj'), ('distance', 't')):
+        for c, date_str, path in list_processed(directory, conditions, kind):
+            if path.endswith('.csv'):
+                print 'Converting %s' % path
+                write_partition(read_traj_csv(path, index_col=index_col),
+                                partition_path(directory, kind, c, date_str))
 
 
 def get_metadata(filename):
@@ -25,42 +209,41 @@ def get_metadata(filename):
     Returns:
         camera_name, date_time, scaling_factor
     '''
-    basename = os.path.basename(filename)
-    i = basename.find('-')
-    camera_name = basename[:i]
-    date_time = dt.datetime.strptime(basename[i + 1:i + 20],
-                                     '%Y-%m-%d-%H-%M-%S')
-    scaling_factor = float(basename.split('-')[-2])
+    camera_name, camera_num, date_time, scaling_factor = parse_name(filename)
 
     return camera_name, date_time, scaling_factor
 
 
-def get_filenames(trajdir, cond_file, time_offset=9):
+def get_filenames(trajdir, cond_file, time_offset=9, index_file=None):
     '''
     Produce a dataframe containing the paths of all trajectory files, indexed
     by condition then date.
     Args:
         trajdir - directory to look for raw trajectory files
         cond_file - path of csv file containing the condition for each date
+        index_file - path of movie index built by cond_gen. If set, conditions
+                     and dates are looked up in the index instead, and
+                     cond_file and time_offset are ignored.
     Returns:
         DataFrame indexed by 'condition' and 'date' with column 'path'
     '''
-    cond_df = pd.read_csv(cond_file, parse_dates=['Date'], index_col='Date',
-                          dayfirst=True)
-    offset_delta = dt.timedelta(hours=time_offset)
-    file_list = []
-    for f in os.listdir(trajdir):
-        if f[-8:] == 'traj.csv':
-            metadata = get_metadata(f)
-            date = (metadata[1] - offset_delta).date()
-            condition = cond_df.loc[date, metadata[0]]
-            file_list.append([condition, date, '/'.join([trajdir, f])])
-
-    files_df = pd.DataFrame(np.array(file_list), columns=['condition', 'date',
-                                                          'path'])
+    trajs = list_dir(trajdir, time_offset=time_offset, kind='traj')
+    if index_file is not None:
+        index_df = pd.DataFrame(
+            read_index(index_file, columns=('filename', 'condition', 'date')),
+            columns=['filename', 'condition', 'date'])
+        index_df['stem'] = index_df.filename.map(
+            lambda f: os.path.splitext(f)[0])
+        index_df['condition'] = index_df.condition.astype(int)
+        index_df['date'] = pd.to_datetime(index_df.date)
+        files_df = pd.merge(trajs.drop('date', axis=1),
+                            index_df[['stem', 'condition', 'date']],
+                            on='stem', how='inner')
+    else:
+        files_df = join_conditions(trajs, cond_file)
 
-    return files_df.sort_values(by=['condition', 'date', 'path']).set_index(
-        ['condition', 'date'])
+    return files_df[['condition', 'date', 'path']].sort_values(
+        by=['condition', 'date', 'path']).set_index(['condition', 'date'])
 
 
 def parse_traj_file(path, n):
@@ -78,31 +261,32 @@ def parse_traj_file(path, n):
     df = pd.concat(df_list)
     df.sort_values(by=['traj', 't'], inplace=True)
 
-    return df.reindex_axis(['traj', 't', 'x', 'y'], axis=1)
+    return compact_dtypes(df.reindex_axis(['traj', 't', 'x', 'y'], axis=1))
 
 
-def combine_traj_files(files, n):
+def combine_traj_files(files, n, first_time=None, traj_start=0):
     '''
     Parses and combines trajectory files with corrected times and traj indices.
     Args:
         files - filepaths to combine
         n - number of tracks in each file
+        first_time - datetime that times are relative to, by default the
+                     recording time of the first file
+        traj_start - index of first trajectory
     Returns:
         a complete trajectory dataframe, indexed by 'traj'
         (will be large - up to 200mb)
     '''
     df_list = []
-    first = True
-    traj_max = -1
+    traj_max = traj_start - 1
     i = 0
     for path in files:
         i += 1
         sys.stdout.write('\rParsing file %s/%s' % (i, len(files)))
         filename = os.path.basename(path)
         dtime = get_metadata(filename)[1]
-        if first:
+        if first_time is None:
             first_time = dtime
-            first = False
 
         df_current = parse_traj_file(path, n)
         # Update times
@@ -176,18 +360,24 @@ def subsample(df, b):
         a much smaller dataframe that the one we started with
     '''
     assert b % 2 == 1
-    df1 = pd.DataFrame(columns=['traj', 't', 'x', 'y']).set_index('traj')
+    df_list = []
     for traj in df.index.unique():
-        l = len(df.loc[traj])
-        a = df.loc[traj].iloc[0:l - l % b][['t', 'x', 'y']].values
+        # A list label keeps a one row trajectory a DataFrame
+        tdf = df.loc[[traj]]
+        l = len(tdf)
+        a = tdf.iloc[0:l - l % b][['t', 'x', 'y']].values
         a = a.reshape((a.shape[0] / b, b, a.shape[1]))
         medians = np.median(a, axis=1)  # Efficiently reduce data
-        df2 = pd.DataFrame(data=medians, columns=['t', 'x', 'y'],
-                           index=(np.zeros((medians.shape[0])) + traj))
-        if len(df2) >= 4:
-            df1 = df1.append(df2)  # Remove extremely short trajectories
+        if medians.shape[0] >= 4:  # Remove extremely short trajectories
+            df_list.append(pd.DataFrame(
+                data=medians, columns=['t', 'x', 'y'],
+                index=pd.Index(np.repeat(traj, medians.shape[0]),
+                               name='traj')))
+    if len(df_list) == 0:
+        return compact_dtypes(
+            pd.DataFrame(columns=['traj', 't', 'x', 'y']).set_index('traj'))
 
-    return df1
+    return compact_dtypes(pd.concat(df_list))
 
 
 def back_process(df):
@@ -240,51 +430,187 @@ def heat_map(df):
     plt.show()
 
 
-def traj_3d(df):
+def decimate_series(t, v, traj, buckets=2000, trange=None):
+    '''
+    Reduces a time series to the points needed to draw it buckets pixels
+    wide: the first, last, minimum and maximum point of each trajectory in
+    each time bucket, so peaks are kept. Points where v is NaN are left out.
+    Args:
+        t - array of times
+        v - array of values
+        traj - array of trajectory numbers, the rows of each trajectory
+               contiguous and sorted by time
+        buckets - number of time buckets across trange
+        trange - (start, end) of time axis, by default range of t
+    Returns:
+        sorted array of indices of points to keep
+    '''
+    idx = np.flatnonzero(~np.isnan(v))
+    if len(idx) == 0:
+        return idx
+    t1 = t[idx]
+    if trange is None:
+        trange = (t1.min(), t1.max())
+    width = float(trange[1] - trange[0]) / buckets or 1.0
+    bucket = np.clip(((t1 - trange[0]) / width).astype(np.int64), 0,
+                     buckets - 1)
+    traj1 = traj[idx]
+    new = np.ones(len(idx), dtype=bool)
+    new[1:] = (bucket[1:] != bucket[:-1]) | (traj1[1:] != traj1[:-1])
+    firsts = np.flatnonzero(new)
+    lasts = np.append(firsts[1:], len(idx)) - 1
+    # Sort each group by value, groups stay in place
+    order = np.lexsort((v[idx], np.cumsum(new)))
+    keep = np.unique(np.concatenate((firsts, lasts, order[firsts],
+                                     order[lasts])))
+
+    return idx[keep]
+
+
+def decimate_path(coords, traj, resolution=1000):
+    '''
+    Reduces a path to the points needed to draw it at a resolution. A point is
+    kept only where the path enters a new cell of a grid with resolution cells
+    along each axis, so the drawn path stays within a cell of the original.
+    Points with NaN coordinates are left out.
+    Args:
+        coords - array of shape (n, d) of coordinates
+        traj - array of trajectory numbers, the rows of each trajectory
+               contiguous
+        resolution - cells along each axis, int or sequence of d ints
+    Returns:
+        sorted array of indices of points to keep
+    '''
+    coords = np.asarray(coords, dtype=np.float64)
+    idx = np.flatnonzero(~np.isnan(coords).any(axis=1))
+    if len(idx) == 0:
+        return idx
+    c = coords[idx]
+    lo = c.min(axis=0)
+    span = c.max(axis=0) - lo
+    span[span == 0] = 1.0
+    resolution = np.broadcast_to(resolution, lo.shape)
+    cells = np.minimum(((c - lo) / span * resolution).astype(np.int64),
+                       resolution - 1)
+    traj1 = traj[idx]
+    ends = np.ones(len(idx), dtype=bool)
+    ends[1:] = traj1[1:] != traj1[:-1]
+    keep = ends | np.append(True, (cells[1:] != cells[:-1]).any(axis=1))
+    # Also keep the last point of each trajectory
+    keep[np.flatnonzero(ends)[1:] - 1] = True
+    keep[-1] = True
+
+    return idx[keep]
+
+
+def line_segments(columns, traj, idx):
+    '''
+    Splits decimated points into one line per trajectory, for a
+    LineCollection.
+    Args:
+        columns - sequence of arrays of coordinates
+        traj - array of trajectory numbers
+        idx - indices of points to draw (see decimate_series and decimate_path)
+    Returns:
+        list of arrays of shape (n, len(columns)), one for each trajectory with
+        at least 2 points
+    '''
+    points = np.column_stack([np.asarray(c)[idx] for c in columns])
+    traj1 = traj[idx]
+    splits = np.flatnonzero(traj1[1:] != traj1[:-1]) + 1
+
+    return [line for line in np.split(points, splits) if len(line) > 1]
+
+
+def _cycle_colors():
+    return plt.rcParams['axes.prop_cycle'].by_key()['color']
+
+
+def plot_lines_3d(ax, x, y, z, traj, resolution=500):
+    '''
+    Draws one line per trajectory on a 3D axis, decimated to resolution cells
+    along each axis and batched into a single Line3DCollection.
+    Args:
+        ax - 3D axis
+        x, y, z - arrays of coordinates
+        traj - array of trajectory numbers
+        resolution - passed to decimate_path
+    Returns:
+        Line3DCollection
+    '''
+    coords = np.column_stack((x, y, z))
+    idx = decimate_path(coords, traj, resolution=resolution)
+    lines = Line3DCollection(line_segments(coords.T, traj, idx),
+                             colors=_cycle_colors())
+    ax.add_collection3d(lines)
+    if len(idx) > 0:
+        lo = np.nanmin(coords, axis=0)
+        hi = np.nanmax(coords, axis=0)
+        ax.set_xlim(lo[0], hi[0])
+        ax.set_ylim(lo[1], hi[1])
+        ax.set_zlim(lo[2], hi[2])
+
+    return lines
+
+
+def traj_3d(df, resolution=500):
     '''
-    Plots trajectories in 3D using matplotlib. This is pretty useless for
-    anything over an hour.
+    Plots trajectories in 3D using matplotlib, decimated to resolution (see
+    plot_lines_3d).
     Args:
         df - pd.DataFrame containing trajectories
+        resolution - cells along each axis to decimate to
     '''
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
-    for i in df.index.unique():
-        ax.plot(df.loc[i].x.values, df.loc[i].y.values, df.loc[i].t.values / 60)
+    plot_lines_3d(ax, df.x.values, df.y.values, df.t.values / 60,
+                  df.index.values, resolution=resolution)
     ax.set_xlabel('x')
     ax.set_ylabel('y')
     ax.set_zlabel('Time (minutes)')
     plt.show()
 
 
-def traj_2d(df, show=True):
+def traj_2d(df, show=True, resolution=1000):
     '''
-    Plots trajectories in 2D using matplotlib
+    Plots trajectories in 2D using matplotlib, decimated to resolution cells
+    along each axis and batched into a single LineCollection.
     Args:
         df - pd.DataFrame containing trajectories
+        show - show figure
+        resolution - passed to decimate_path
+    Returns:
+        fig
     '''
-    fig, ax = plt.subplot()
-    for i in df.index.unique():
-        ax.plot(df.loc[i].x.values, df.loc[i].y.values)
+    fig, ax = plt.subplots()
+    coords = np.column_stack((df.x.values, df.y.values))
+    traj = df.index.values
+    idx = decimate_path(coords, traj, resolution=resolution)
+    ax.add_collection(LineCollection(line_segments(coords.T, traj, idx),
+                                     colors=_cycle_colors()))
+    ax.autoscale_view()
     if show is True:
         plt.show()
 
     return fig
 
 
-def calculate_velocity(df, in_place=True):
+def calculate_velocity(df, in_place=True, centre=None):
     '''
     Calculates angle, speed, rotation and distance from centre at each timepoint
     Args:
         df - DataFrame indexed by 'traj'
         in_place - process df in place and return None
+        centre - (x, y) centre of the dish, by default half the maximum x and
+                 y
     Returns:
         dataframe with two more columns, 'angle' and 'speed' (if in_place=False)
     '''
     if in_place is False:
         df = df.copy()
-    # Calculate angle
+    # Calculate angle, with no velocity calculations between trajectories
     pos_diff = df[['x', 'y']].iloc[1:].values - df[['x', 'y']].iloc[:-1].values
+    pos_diff[df.index.values[1:] != df.index.values[:-1]] = np.nan
     df['angle'] = np.insert(np.arctan2(pos_diff[:, 1], pos_diff[:, 0]), 0,
                             np.nan)
 
@@ -303,13 +629,12 @@ def calculate_velocity(df, in_place=True):
     df['rotation'] = np.insert(rot / t_diff, 0, np.nan)
 
     # Calculate distance from centre
-    centre = 0.5 * df.x.max(), 0.5 * df.y.max()
+    if centre is None:
+        centre = 0.5 * df.x.max(), 0.5 * df.y.max()
     r = np.sqrt((df.x.values - centre[0]) ** 2 + (df.y.values - centre[1]) ** 2)
     df['d_mid'] = r
+    compact_dtypes(df)
 
-    # Remove velocity calculations between trajectories
-    for i in df.index.unique():
-        df.loc[i].iloc[0][['angle', 'speed', 'rotation']] = np.nan
     if in_place is True:
         return None
     else:
@@ -339,19 +664,200 @@ def calculate_distances(df):
     sq_diff_coords = (dft.iloc[1::2][['x', 'y']].values -
                       dft.iloc[::2][['x', 'y']].values) ** 2
     ddf.d = np.sqrt(sq_diff_coords[:, 0] + sq_diff_coords[:, 1])
+    compact_dtypes(ddf)
 
     print 'Done.'
     return ddf
 
 
+def read_day_manifest(out_dir):
+    '''
+    Reads the manifest of processed days written by process_trajectories.
+    Returns:
+        dictionary with 'cond<c>/<yyyy-mm-dd>' keys
+    '''
+    path = os.path.join(out_dir, 'manifest.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as in_file:
+        return json.load(in_file)
+
+
+def write_day_manifest(out_dir, manifest):
+    '''
+    Writes the manifest of processed days, replacing the old one atomically.
+    '''
+    path = os.path.join(out_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as out_file:
+        json.dump(manifest, out_file, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def file_stats(paths):
+    '''
+    Returns:
+        dictionary with filenames as keys and [mtime, size] as values
+    '''
+    stats = {}
+    for path in paths:
+        st = os.stat(path)
+        stats[os.path.basename(path)] = [st.st_mtime, st.st_size]
+    return stats
+
+
+def output_size(path):
+    '''
+    Returns:
+        size of processed output: bytes of a csv file or rows of a partition,
+        None if it does not exist
+    '''
+    if is_partition(path):
+        return read_meta(path)['rows']
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return None
+
+
+def rollback_output(path, size):
+    '''
+    Truncates processed output to size (see output_size), removing anything
+    appended after it was recorded.
+    '''
+    if is_partition(path):
+        truncate_partition(path, size)
+    else:
+        with open(path, 'r+b') as out_file:
+            out_file.truncate(size)
+
+
+def load_day_files(paths, n, params, first_time=None, traj_start=0):
+    '''
+    Combines, filters and subsamples trajectory files as process_day.
+    Returns:
+        trajectory DataFrame, largest trajectory index before filtering
+    '''
+    df = combine_traj_files(paths, n, first_time=first_time,
+                            traj_start=traj_start)
+    traj_max = int(df.index.max())
+    df = filter_traj(df, min_length=params['min_length'],
+                     trim_start_frames=params['trim_start_frames'],
+                     trim_end_frames=params['trim_end_frames'])
+    if params['sub_sample'] > 1:
+        df = subsample(df, params['sub_sample'])
+
+    return df, traj_max
+
+
+def movie_rois(index_file):
+    '''
+    Returns:
+        dictionary of regions of interest (r0, c0, r1, c1) recorded in a movie
+        index, with movie filename stems as keys
+    '''
+    rois = {}
+    for row in read_index(index_file, columns=('filename', 'r0', 'c0', 'r1',
+                                               'c1')):
+        if None not in row[1:]:
+            rois[os.path.splitext(row[0])[0]] = row[1:]
+
+    return rois
+
+
+def day_centre(paths, rois):
+    '''
+    Centre used for distance from centre (d_mid) of a day: the centre of the
+    dish in trajectory coordinates, from the region of interest of the first
+    movie of the day which has one. Regions of interest are squares centred
+    on the dish (cond_gen.circle_to_roi), and trajectories are relative to
+    the region of interest at the scale they were tracked at, with x along
+    rows. The same rule is used whether the day is built at once or appended
+    to.
+    Args:
+        paths - trajectory files of the day, sorted by recording time
+        rois - dictionary returned by movie_rois
+    Returns:
+        [x, y], None if no movie of the day has a region of interest
+    '''
+    for path in paths:
+        camera, camera_num, date_time, scale = parse_name(path)
+        roi = rois.get('%s-%s' % (camera, date_time.strftime(TIME_FORMAT)))
+        if roi is not None and -1 not in roi:
+            return [0.5 * (roi[2] - roi[0]) * scale,
+                    0.5 * (roi[3] - roi[1]) * scale]
+
+    return None
+
+
+def process_day(paths, n, out_paths, params, entry=None, rois={}):
+    '''
+    Processes the trajectory files of one day. If entry (from a previous run)
+    is given, only the files not in it are processed and appended to the
+    output files, after removing anything written since entry was recorded
+    (eg. by an append interrupted before the manifest was written).
+    Args:
+        paths - trajectory files of the day, sorted by recording time
+        n - number of bees
+        out_paths - trajectory output path, distance output path (csv files
+                    or partition directories, see write_processed)
+        params - dictionary of filter_traj arguments and 'sub_sample'
+        entry - manifest entry of the day to append to, or None
+        rois - regions of interest of movies (see day_centre). Without one
+               for the day, the centre is half the largest x and y of the
+               data first processed for the day.
+    Returns:
+        manifest entry for the day
+    '''
+    if entry is None:
+        first_time = None
+        traj_start = 0
+        centre = None
+        new_paths = paths
+    else:
+        first_time = dt.datetime.strptime(entry['first_time'], TIME_FORMAT)
+        traj_start = entry['traj_max'] + 1
+        centre = entry['centre']
+        new_paths = [p for p in paths
+                     if os.path.basename(p) not in entry['files']]
+        for path, size in zip(out_paths, entry['sizes']):
+            if size is not None:
+                rollback_output(path, size)
+    append = entry is not None
+
+    df, traj_max = load_day_files(new_paths, n, params, first_time=first_time,
+                                  traj_start=traj_start)
+    if first_time is None:
+        first_time = get_metadata(paths[0])[1]
+    if n == 2:
+        ddf = calculate_distances(df)
+        write_processed(ddf, out_paths[1], append=append)
+        del ddf
+    if centre is None:
+        centre = day_centre(paths, rois)
+    if centre is None:
+        centre = [0.5 * float(df.x.max()), 0.5 * float(df.y.max())]
+    calculate_velocity(df, in_place=True, centre=centre)
+    write_processed(df, out_paths[0], append=append)
+    del df
+    gc.collect()
+
+    return {'files': file_stats(paths), 'traj_max': traj_max,
+            'first_time': first_time.strftime(TIME_FORMAT),
+            'centre': centre, 'params': params, 'version': DAY_VERSION,
+            'sizes': [output_size(path) for path in out_paths]}
+
+
 def process_trajectories(traj_dir, cond_file, out_dir, time_offset=9,
                          min_length=2, trim_start_frames=0, trim_end_frames=0,
-                         sub_sample=1):
+                         sub_sample=1, index_file=None, days=None,
+                         append=False, store=False):
     '''
     Parses trajectory files, trims, smooths, calculates velocity and bee
     distances when there are 2 bees. Then writes resulting dataframes to csv
-    files for each condition in each day. This is quite memory intensive and
+    files (or a columnar store) for each condition in each day. This is quite memory intensive and
     will take a while.
+    The files and settings each day was produced from, and the sizes of its
+    outputs, are recorded in manifest.json in out_dir. Days whose files and
+    settings have not changed are skipped.
     Args:
         traj_dir - path of directory where raw trajectory files are stored
         cond_file - path of conditions file
@@ -363,30 +869,71 @@ def process_trajectories(traj_dir, cond_file, out_dir, time_offset=9,
         trim_end_frames - passed to filter_traj
         sub_sample - odd integer determining size of bins to subsample,
                      by default does not subsample
+        index_file - passed to get_filenames. Regions of interest in the
+                     index give the centre of the dish for distance from
+                     centre (see day_centre).
+        days - list of (condition, datetime.date) tuples to process. By
+               default all days are processed.
+        append - if the only change to a day is new files recorded after its
+                 previous files, process just the new files and append them to
+                 the outputs. Trajectory indices and times continue from the
+                 previous files and distance from centre uses the centre
+                 recorded for the day (see day_centre).
+                 Anything appended after the manifest was last written is
+                 removed first, so an interrupted append can be repeated.
+                 Otherwise the day is rebuilt.
+        store - write to a columnar store in out_dir (see traj_store)
+                instead of csv files
     Returns:
         None
     '''
     cond_beenum = {1: 1, 2: 2, 3: 2, 4: 4}
-    files = get_filenames(traj_dir, cond_file, time_offset=time_offset)
-    for c in files.index.levels[0]:
-        for d in files.index.levels[1]:
-            print 'Processing condtion %s, %s' % (c, d.date())
-            df = combine_traj_files(files.loc[c, d].values.flat, cond_beenum[c])
-            df = filter_traj(df, min_length=min_length,
-                             trim_start_frames=trim_start_frames,
-                             trim_end_frames=trim_end_frames)
-            if sub_sample > 1:
-                df = subsample(df, sub_sample)
-            if cond_beenum[c] == 2:
-                ddf = calculate_distances(df)
-                ddf.to_csv('/'.join(
-                    [out_dir, 'cond%s' % c, 'distance', '%s.csv' % d.date()]))
-                del ddf
-            calculate_velocity(df, in_place=True)
-            df.to_csv('/'.join(
-                [out_dir, 'cond%s' % c, 'trajectory', '%s.csv' % d.date()]))
-            del df
-            gc.collect()
+    params = {'min_length': min_length, 'trim_start_frames': trim_start_frames,
+              'trim_end_frames': trim_end_frames, 'sub_sample': sub_sample}
+    files = get_filenames(traj_dir, cond_file, time_offset=time_offset,
+                          index_file=index_file)
+    manifest = read_day_manifest(out_dir)
+    rois = {} if index_file is None else movie_rois(index_file)
+    if days is not None:
+        days = set(days)
+    for (c, d), group in files.groupby(level=[0, 1]):
+        if days is not None and (c, d.date()) not in days:
+            continue
+        key = 'cond%s/%s' % (c, d.date())
+        paths = list(group.path.values)
+        if store:
+            out_paths = [partition_path(out_dir, kind, c, d.date())
+                         for kind in ('trajectory', 'distance')]
+        else:
+            out_paths = ['/'.join([out_dir, 'cond%s' % c, kind,
+                                   '%s.csv' % d.date()])
+                         for kind in ('trajectory', 'distance')]
+        entry = manifest.get(key)
+        if entry is not None:
+            outputs_exist = os.path.exists(out_paths[0]) and (
+                cond_beenum[c] != 2 or os.path.exists(out_paths[1]))
+            stats = file_stats(paths)
+            old = entry['files']
+            if (not outputs_exist or entry['params'] != params or
+                    entry.get('version') != DAY_VERSION or
+                    any(stats.get(f) != old[f] for f in old) or
+                    any(size is not None and output_size(path) < size
+                        for path, size in zip(out_paths, entry['sizes']))):
+                entry = None
+            elif len(stats) == len(old):
+                print 'Condition %s, %s unchanged' % (c, d.date())
+                continue
+            elif not append or min(f for f in stats if f not in old) < \
+                    max(old):
+                entry = None
+
+        print '%s condtion %s, %s' % (
+            'Processing' if entry is None else 'Appending to', c, d.date())
+        for path in out_paths:
+            create_dir(os.path.dirname(path))
+        manifest[key] = process_day(paths, cond_beenum[c], out_paths, params,
+                                    entry, rois=rois)
+        write_day_manifest(out_dir, manifest)
 
     print 'Done.'
     return None
@@ -399,16 +946,21 @@ def radius_hist(df, bins=25, centre=None, show=True):
     Args:
         df - trajectory dataframe
         bins - number of bins
-        centre - x and y coordinates of centre of dish. If None, calculated as
-                 0.5 * df.x.max(), 0.5 * df.y.max()
+        centre - x and y coordinates of centre of dish. If None, the distance
+                 from centre calculated when the day was processed (d_mid) is
+                 used, or without it the centre is 0.5 * df.x.max(),
+                 0.5 * df.y.max()
         show - show histogram, else just return it
     Returns:
         r, histogram
     '''
-    if centre is None:
-        centre = 0.5 * df.x.max(), 0.5 * df.y.max()
-
-    r = np.sqrt((df.x.values - centre[0]) ** 2 + (df.y.values - centre[1]) ** 2)
+    if centre is None and 'd_mid' in df.columns:
+        r = df.d_mid.values[~np.isnan(df.d_mid.values)]
+    else:
+        if centre is None:
+            centre = 0.5 * df.x.max(), 0.5 * df.y.max()
+        r = np.sqrt((df.x.values - centre[0]) ** 2 +
+                    (df.y.values - centre[1]) ** 2)
     h = plt.hist(r, bins=bins, normed=True)
     if show is True:
         plt.show()
@@ -416,64 +968,125 @@ def radius_hist(df, bins=25, centre=None, show=True):
     return r, h
 
 
-def produce_fig(df, distance_df=None, title=None, show=True, subsample_3d=5):
+def day_aggregates(df, distance_df=None, subsample_3d=5):
     '''
-    Produces figures for a given DataFrame
+    Computes the arrays plotted by render_fig for one day: histograms and a
+    subsampled trace of the trajectories.
     Args:
         df - trajectory DataFrame
         distance_df - optional distance DataFrame
+        subsample_3d - odd integer to pass to subsample for the trace
+    Returns:
+        dictionary of arrays
+    '''
+    aggs = {}
+    x = df.x.values.astype(np.float64)
+    y = df.y.values.astype(np.float64)
+
+    # Position heatmap
+    aggs['pos_hist'], aggs['pos_xedges'], aggs['pos_yedges'] = \
+        np.histogram2d(x, y, bins=100)
+
+    # Distance from centre, as calculated with the day's centre when
+    # processed (see day_centre)
+    if 'd_mid' in df.columns:
+        r = df.d_mid.values.astype(np.float64)
+        r = r[~np.isnan(r)]
+    else:
+        centre = 0.5 * x.max(), 0.5 * y.max()
+        r = np.sqrt((x - centre[0]) ** 2 + (y - centre[1]) ** 2)
+    aggs['radius_hist'], aggs['radius_edges'] = np.histogram(r, bins=25)
+
+    # Speed, and speed against angle as a density
+    # (empty histograms for a day without valid speeds)
+    speed = df.speed.values
+    angle = df.angle.values
+    moving = ~np.isnan(speed)
+    max_speed = speed[moving].max() if moving.any() else 0
+    aggs['speed_hist'], aggs['speed_edges'] = np.histogram(
+        speed[moving], bins=max(int(max_speed), 1))
+    valid = moving & ~np.isnan(angle)
+    vh, speed_edges, angle_edges = np.histogram2d(speed[valid], angle[valid],
+                                                  bins=100)
+    if vh.sum() > 0:
+        vh = vh / vh.sum() / np.outer(np.diff(speed_edges),
+                                      np.diff(angle_edges))
+    aggs['vel_hist'] = vh
+    aggs['vel_speed_edges'] = speed_edges
+    aggs['vel_angle_edges'] = angle_edges
+
+    # Pairwise distance
+    if distance_df is not None:
+        d = distance_df.values.ravel()
+        aggs['dist_hist'], aggs['dist_edges'] = np.histogram(
+            d[~np.isnan(d)], bins=50)
+
+    # Trace of trajectories, decimated for drawing
+    df1 = subsample(df[['t', 'x', 'y']], subsample_3d)
+    traj = df1.index.values
+    idx = decimate_path(df1[['x', 'y', 't']].values, traj, resolution=500)
+    aggs['trace_traj'] = traj[idx]
+    for col in ('t', 'x', 'y'):
+        aggs['trace_' + col] = df1[col].values[idx].astype(np.float32)
+
+    return aggs
+
+
+def render_fig(aggs, title=None, show=True):
+    '''
+    Draws the figure for a day from the arrays returned by day_aggregates.
+    Args:
+        aggs - dictionary (or npz file) of arrays
         title - Main figure title
         show - show figure
-        subsample_3d - odd integer to pass to subsample for plotting of 3d traj
     Returns:
         fig
     '''
     fig = plt.figure(figsize=(12, 8), tight_layout={'pad': 2.0})
 
-    # 2D plot of trajectories
-#    plt.subplot(321)
-#    for i in df.index.unique():
-#        plt.plot(df.loc[i].x.values, df.loc[i].y.values)
-#    plt.title('Trajectories')
-
     # 3D plot of trajectories
-    plt.subplot(231, projection='3d')
-    df1 = subsample(df, subsample_3d)
-    for i in df1.index.unique():
-        plt.plot(df1.loc[i].x.values, df1.loc[i].y.values, df1.loc[i].t.values)
+    ax = plt.subplot(231, projection='3d')
+    plot_lines_3d(ax, aggs['trace_x'], aggs['trace_y'], aggs['trace_t'],
+                  aggs['trace_traj'], resolution=500)
     plt.title('Trajectories')
     plt.tick_params(axis='both', which='major', labelsize=8)
 
     # 2D Histogram of position frequencies
     plt.subplot(232)
-    plt.hist2d(df.x, df.y, bins=100, norm=LogNorm())
+    plt.pcolormesh(aggs['pos_xedges'], aggs['pos_yedges'],
+                   np.ma.masked_equal(aggs['pos_hist'].T, 0), norm=LogNorm(),
+                   rasterized=True)
     plt.colorbar()
     plt.title('Pos Heatmap')
 
     # Histogram of distance from centre
     plt.subplot(233)
-    radius_hist(df, show=False)
+    edges = aggs['radius_edges']
+    plt.hist(edges[:-1], bins=edges, weights=aggs['radius_hist'], normed=True)
     plt.title('Distance from Centre')
 
     # Histogram of speed
     plt.subplot(234)
-    plt.hist(df.speed.dropna().values, bins=int(df.speed.max()),
-             normed=True, histtype='step', log=True)
+    edges = aggs['speed_edges']
+    plt.hist(edges[:-1], bins=edges, weights=aggs['speed_hist'], normed=True,
+             histtype='step', log=True)
     plt.title('Speed Distribution')
 
     # Histogram of velocities
     plt.subplot(235, polar=True)
-    vh = np.histogram2d(df.speed.dropna().values, df.angle.dropna().values,
-                        bins=100, normed=True)
-    plt.pcolormesh(vh[2], vh[1], vh[0], norm=LogNorm())
+    plt.pcolormesh(aggs['vel_angle_edges'], aggs['vel_speed_edges'],
+                   np.ma.masked_equal(aggs['vel_hist'], 0), norm=LogNorm(),
+                   rasterized=True)
     plt.colorbar(pad=0.075)
     plt.title('Velocity Heatmap')
     plt.tick_params(axis='both', which='major', labelsize=8)
 
     # Pairwise distance histogram
-    if distance_df is not None:
+    if 'dist_hist' in aggs:
         plt.subplot(236)
-        plt.hist(distance_df.values, bins=50, normed=True)
+        edges = aggs['dist_edges']
+        plt.hist(edges[:-1], bins=edges, weights=aggs['dist_hist'],
+                 normed=True)
         plt.title('Pairwise Distance')
 
     plt.suptitle(title)
@@ -484,6 +1097,23 @@ def produce_fig(df, distance_df=None, title=None, show=True, subsample_3d=5):
     return fig
 
 
+def produce_fig(df, distance_df=None, title=None, show=True, subsample_3d=5):
+    '''
+    Produces figures for a given DataFrame
+    Args:
+        df - trajectory DataFrame
+        distance_df - optional distance DataFrame
+        title - Main figure title
+        show - show figure
+        subsample_3d - odd integer to pass to subsample for plotting of 3d traj
+    Returns:
+        fig
+    '''
+    return render_fig(day_aggregates(df, distance_df=distance_df,
+                                     subsample_3d=subsample_3d),
+                      title=title, show=show)
+
+
 def fig_from_vars(condition, date_str, directory='ProcessedFiles', show=True):
     '''
     Wrapper for produce_fig
@@ -496,13 +1126,12 @@ def fig_from_vars(condition, date_str, directory='ProcessedFiles', show=True):
         fig
     '''
     print 'Loading trajectory file.'
-    df = pd.read_csv('%s/cond%s/trajectory/%s.csv' % (directory, condition,
-                                                      date_str),
-                     index_col='traj')
+    df = read_traj(processed_path(directory, 'trajectory', condition,
+                                  date_str))
     if condition in {2, 3}:
         print 'Loading distance file.'
-        ddf = pd.read_csv('%s/cond%s/distance/%s.csv'
-                          % (directory, condition, date_str), index_col='t')
+        ddf = read_traj(processed_path(directory, 'distance', condition,
+                                       date_str), index_col='t')
     else:
         ddf = None
 
@@ -512,38 +1141,239 @@ def fig_from_vars(condition, date_str, directory='ProcessedFiles', show=True):
     return fig
 
 
-def all_figs(pdf_name, conditions=[1, 2, 3, 4], data_dir='ProcessedFiles'):
+def _source_mtime(path):
+    if is_partition(path):
+        return os.path.getmtime(os.path.join(path, 'meta.json'))
+    return os.path.getmtime(path)
+
+
+def _aggregate_job(job):
     '''
-    Produces ands saves figures as a pdf file.
+    Computes and saves day_aggregates for one day.
+    Args:
+        job - tuple (trajectory path, distance path or None, cache path,
+              subsample_3d)
+    Returns:
+        cache path
+    '''
+    traj_path, dist_path, cache_path, subsample_3d = job
+    df = read_traj(traj_path, columns=['t', 'x', 'y', 'speed', 'angle',
+                                       'd_mid'])
+    ddf = None
+    if dist_path is not None:
+        ddf = read_traj(dist_path, columns=['d'], index_col='t')
+    aggs = day_aggregates(df, distance_df=ddf, subsample_3d=subsample_3d)
+    del df, ddf
+    np.savez_compressed(cache_path, cache_version=AGGREGATE_VERSION,
+                        subsample_3d=subsample_3d, **aggs)
+
+    return cache_path
+
+
+def _cache_valid(cache_path, sources, subsample_3d):
+    '''
+    Returns:
+        True if the aggregate cache at cache_path is newer than its sources
+        and was made by this version of day_aggregates with the same
+        subsample_3d
+    '''
+    if (not os.path.isfile(cache_path) or os.path.getmtime(cache_path) <
+            max(_source_mtime(p) for p in sources)):
+        return False
+    if not zipfile.is_zipfile(cache_path):
+        return False
+    with np.load(cache_path) as aggs:
+        return ('cache_version' in aggs.files and
+                int(aggs['cache_version']) == AGGREGATE_VERSION and
+                int(aggs['subsample_3d']) == subsample_3d)
+
+
+def aggregate_figs(data_dir='ProcessedFiles', conditions=[1, 2, 3, 4],
+                   cache_dir=None, processes=1, subsample_3d=5):
+    '''
+    Computes day_aggregates for each processed day and caches them as
+    <cache_dir>/cond<c>/<date>.npz. Days whose cache is newer than their data
+    and was made with the same subsample_3d and AGGREGATE_VERSION are skipped.
+    Args:
+        data_dir - directory where data is stored
+        conditions - conditions to process
+        cache_dir - directory of cache files, default <data_dir>/fig_cache
+        processes - number of days to aggregate in parallel, 0 uses all
+                    processors
+        subsample_3d - passed to day_aggregates
+    Returns:
+        list of (condition, date_str, cache path) tuples
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(data_dir, 'fig_cache')
+    caches = []
+    jobs = []
+    for condition, date_str, path in list_processed(data_dir, conditions):
+        create_dir(os.path.join(cache_dir, 'cond%s' % condition))
+        cache_path = os.path.join(cache_dir, 'cond%s' % condition,
+                                  '%s.npz' % date_str)
+        dist_path = None
+        sources = [path]
+        if condition in {2, 3}:
+            dist_path = processed_path(data_dir, 'distance', condition,
+                                       date_str)
+            sources.append(dist_path)
+        caches.append((condition, date_str, cache_path))
+        if not _cache_valid(cache_path, sources, subsample_3d):
+            jobs.append((path, dist_path, cache_path, subsample_3d))
+
+    print 'Aggregating %s of %s days' % (len(jobs), len(caches))
+    if processes == 1:
+        for job in jobs:
+            print _aggregate_job(job)
+    else:
+        pool = Pool(processes if processes > 0 else None)
+        for cache_path in pool.imap_unordered(_aggregate_job, jobs):
+            print cache_path
+        pool.close()
+        pool.join()
+
+    return caches
+
+
+def all_figs(pdf_name, conditions=[1, 2, 3, 4], data_dir='ProcessedFiles',
+             cache_dir=None, processes=1):
+    '''
+    Produces ands saves figures as a pdf file. Histograms are computed once
+    per day and cached (see aggregate_figs), so figures are drawn from small
+    cache files only and regenerating a report is fast.
     Args:
         pdf_name - path of pdf file
         conditions - conditions to process
         data_dir - directory where data is stored
+        cache_dir - passed to aggregate_figs
+        processes - passed to aggregate_figs
     Returns:
         None
     '''
+    caches = aggregate_figs(data_dir, conditions=conditions,
+                            cache_dir=cache_dir, processes=processes)
     pdf_file = PdfPages(pdf_name)
-    for condition in conditions:
-        date_list = []
-        for f in os.listdir('%s/cond%s/trajectory' % (data_dir, condition)):
-            if f[-4:] == '.csv':
-                date_list.append(f[:-4])
-
-        for date_str in date_list:
-            print 'Condition %s %s' % (condition, date_str)
-            fig = fig_from_vars(condition, date_str, directory=data_dir,
-                                show=False)
-            pdf_file.savefig()
-            plt.close(fig)
+    for condition, date_str, cache_path in caches:
+        print 'Condition %s %s' % (condition, date_str)
+        aggs = np.load(cache_path)
+        fig = render_fig(aggs, title='Condition %s %s' % (condition, date_str),
+                         show=False)
+        aggs.close()
+        pdf_file.savefig()
+        plt.close(fig)
 
     pdf_file.close()
 
 
+_vid_shared = {}
+
+
+def _init_vid_worker(kwds, single_thread=False):
+    '''
+    Sets up process_frame arguments for _vid_stages, once per process. Pool
+    workers run OpenCV single threaded so they do not compete for processors.
+    '''
+    if single_thread:
+        cv2.setNumThreads(1)
+    _vid_shared.clear()
+    _vid_shared.update(kwds)
+    _vid_shared['dilate_kernel'] = np.ones((5, 5), dtype=np.uint8)
+
+
+def _vid_stages(frame):
+    '''
+    Runs process_frame on a frame.
+    Returns:
+        list of the 4 grayscale uint8 images shown by produce_process_vid
+        (frame, normalised, threshold, dilated maxima) and the observed
+        coordinates (see get_observed)
+    '''
+    kwds = _vid_shared
+    p = process_frame(frame, kwds['bee_number'], kwds['log_kernel'],
+                      roi=kwds['roi'], roi_mask=kwds['roi_mask'],
+                      scale=kwds['scale'],
+                      thresh_kernel_size=kwds['thresh_kernel_size'])
+    maxima = cv2.dilate((p[0] * 255).astype(np.uint8), kwds['dilate_kernel'])
+
+    return [p[5], p[3], p[2], maxima], get_observed(p)
+
+
+class FrameWriter(threading.Thread):
+    '''
+    Writes frames to a cv2.VideoWriter from a queue, so encoding overlaps
+    processing. Frames are written from a ring of preallocated buffers: each
+    buffer is put back on self.free once written, and the producer takes
+    buffers from self.free, so it waits if the writer falls behind.
+    '''
+    def __init__(self, writer, buffers):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.writer = writer
+        self.queue = Queue.Queue()
+        self.free = Queue.Queue()
+        for buf in buffers:
+            self.free.put(buf)
+
+    def run(self):
+        while 1:
+            buf = self.queue.get()
+            if buf is None:
+                break
+            self.writer.write(buf)
+            self.free.put(buf)
+
+
+def _composite_buffer(h, w):
+    '''
+    Allocates a 2x2 composite image of (h, w) tiles separated by white lines.
+    '''
+    buf = np.zeros((2 * h + 1, 2 * w + 1, 3), dtype=np.uint8)
+    buf[h] = 255
+    buf[:, w] = 255
+
+    return buf
+
+
+def draw_predictions(image, predicted, mkf, origins,
+                     colors=((0, 0, 255), (0, 255, 0), (255, 0, 0),
+                             (0, 180, 180), (180, 180, 0), (180, 0, 180),
+                             (0, 0, 0), (127, 127, 127))):
+    '''
+    Draws predicted positions of Kalman filters, and a line to their corrected
+    positions, on tiles of an image.
+    Args:
+        image - BGR image
+        predicted - array returned by MultiKalman.predict
+        mkf - MultiKalman instance after correction
+        origins - (row, column) of top left corner of each tile to draw on
+    '''
+    for i, kf in enumerate(mkf.tracks):
+        if not mkf.found_dict[kf]:
+            continue
+        color = colors[i % len(colors)]
+        pre = predicted[:2, i]
+        post = kf.statePost.flat[:2]
+        for r, c in origins:
+            pt1 = (int(pre[1]) + c, int(pre[0]) + r)
+            pt2 = (int(post[1]) + c, int(post[0]) + r)
+            cv2.circle(image, pt1, 6, color, 2)
+            cv2.line(image, pt1, pt2, color, 2)
+
+
 def produce_process_vid(movie_path, roi, out_file, dur, discard=0, sigma=16,
-                        scale=1.0, thresh_kernel_size=101, fps=25.0, show=True):
+                        scale=1.0, thresh_kernel_size=101, fps=25.0, show=True,
+                        bee_number=4, max_dist=25, reset_time=0.5, processes=1,
+                        buffers=8, draw_kalman=True):
     '''
     Performs a mock processing of movie and saves a new movie displaying 4
-    stages of the process.
+    stages of the process: the frame, the normalised Laplacian of a Gaussian,
+    the threshold and the detected maxima. Detections are tracked with
+    MultiKalman as in multi_tracker.process_video, and predicted positions are
+    drawn on the frame and maxima tiles.
+    Frames are composited into a ring of preallocated buffers and encoded by a
+    FrameWriter thread. Only single core runs have been timed, so whether
+    processes > 1 keeps up with real time is unverified.
     Args:
         movie_path - path of movie
         roi - region of interest
@@ -555,40 +1385,101 @@ def produce_process_vid(movie_path, roi, out_file, dur, discard=0, sigma=16,
         thresh_kernel_size - change kernel size for adaptive threshold
         fps - fps to save video as
         show - show video progress
+        bee_number - number of Kalman filters to track with
+        max_dist - distance threshold for assigning observations to bees
+        reset_time - time in seconds before an unassigned Kalman filter is
+                     reinitialised
+        processes - number of processes to run process_frame in, 0 uses all
+                    processors
+        buffers - number of composite buffers in the ring
+        draw_kalman - draw Kalman filter predictions
     '''
-    circlemask = get_roi_mask(roi, scale)
-    k = get_log_kernel(scale * sigma)
+    kwds = {'bee_number': bee_number, 'log_kernel': get_log_kernel(scale * sigma),
+            'roi': roi, 'roi_mask': get_roi_mask(roi, scale), 'scale': scale,
+            'thresh_kernel_size': get_thresh_kernel_size(roi, scale)}
+    mkf = MultiKalman(bee_number, max_dist, reset_time)
     cap = cv2.VideoCapture(movie_path)
     fourcc = cv2.VideoWriter_fourcc(*'DIVX')
-    thresh_k_size = get_thresh_kernel_size(roi, scale)
 
     for i in range(discard):
         ret, frame = cap.read()
-    imsize = (int((roi[2] - roi[0]) * 2 * scale + 1),
-              int((roi[3] - roi[1]) * 2 * scale + 1))
-    out = cv2.VideoWriter(out_file, fourcc, fps, imsize)
 
-    for i in range(dur):
-        print '\r%s / %s' % (i, dur),
-        ret, frame = cap.read()
-        if not ret:
-            break
-        p = process_frame(frame, 4, k, roi=roi, roi_mask=circlemask,
-                          scale=scale, thresh_kernel_size=thresh_k_size)
-        p0 = cv2.dilate((p[0] * 255).astype(np.uint8), np.ones((5, 5)))
-        vline = np.ones((p0.shape[0], 1), dtype=np.uint8) * 255
-        hline = np.ones((1, p0.shape[1] * 2 + 1), dtype=np.uint8) * 255
-        joined = np.vstack((np.hstack((p[5], vline, p[3])), hline,
-                            np.hstack((p[2], vline, p0))))
-        color = cv2.cvtColor(joined, cv2.COLOR_GRAY2BGR)
-        out.write(color)
-        if show:
-            cv2.imshow('Combined Image', color)
-            if cv2.waitKey(1) == ord('q'):
+    # Frames are processed in order in a bounded window, so memory stays
+    # constant for long movies (Pool.imap would read the whole movie ahead)
+    pool = None
+    pending = collections.deque()
+    window = 1
+    if processes != 1:
+        pool = Pool(processes if processes > 0 else None, _init_vid_worker,
+                    (kwds, True))
+        window = 4 * (processes if processes > 0 else cpu_count())
+    else:
+        _init_vid_worker(kwds)
+
+    writer = None
+    read_frames = 0
+    done_frames = 0
+    try:
+        while 1:
+            while read_frames < dur and len(pending) < window:
+                ret, frame = cap.read()
+                if not ret:
+                    dur = read_frames
+                    break
+                read_frames += 1
+                if pool is None:
+                    pending.append(_vid_stages(frame))
+                else:
+                    pending.append(pool.apply_async(_vid_stages, (frame,)))
+            if len(pending) == 0:
                 break
-    cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+            result = pending.popleft()
+            tiles, observed = result if pool is None else result.get()
+            done_frames += 1
+            capture_time = (discard + done_frames) / fps
+            predicted = mkf.predict(capture_time)
+            mkf.correct(observed, predicted, capture_time)
+
+            h, w = tiles[0].shape
+            if writer is None:
+                out = cv2.VideoWriter(out_file, fourcc, fps,
+                                      (2 * w + 1, 2 * h + 1))
+                writer = FrameWriter(out, [_composite_buffer(h, w)
+                                           for i in range(buffers)])
+                writer.start()
+            buf = writer.free.get()
+            for tile, (r, c) in zip(tiles, ((0, 0), (0, w + 1), (h + 1, 0),
+                                            (h + 1, w + 1))):
+                # Converted straight into the buffer. OpenCV builds that do
+                # not accept a strided dst return a new array instead.
+                view = buf[r:r + h, c:c + w]
+                bgr = cv2.cvtColor(tile, cv2.COLOR_GRAY2BGR, dst=view)
+                if bgr is not view:
+                    np.copyto(view, bgr)
+            if draw_kalman:
+                draw_predictions(buf, predicted, mkf,
+                                 ((0, 0), (h + 1, w + 1)))
+            writer.queue.put(buf)
+
+            if done_frames % 25 == 0:
+                print '\r%s / %s' % (done_frames, dur),
+                sys.stdout.flush()
+            if show:
+                cv2.imshow('Combined Image', buf)
+                if cv2.waitKey(1) == ord('q'):
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+        cap.release()
+        if writer is not None:
+            writer.queue.put(None)
+            writer.join()
+            out.release()
+        if show:
+            cv2.destroyAllWindows()
+    print
+
     return None
 
 
@@ -603,20 +1494,103 @@ def id_dead(df):
     pass
 
 
+def iter_columns(path, columns, chunksize=1 << 20):
+    '''
+    Reads columns of processed data in chunks, from a csv file or store
+    partition, so files of any size are read in constant memory. Rows are
+    in file order, and 'traj' can be read as a column.
+    Args:
+        path - path of csv file or partition directory
+        columns - columns to read
+        chunksize - rows per chunk read from csv files (partitions are read
+                    one row group at a time)
+    Yields:
+        DataFrames of columns with TRAJ_DTYPES
+    '''
+    columns = list(columns)
+    if is_partition(path):
+        for df in iter_row_groups(path, columns=columns):
+            yield compact_dtypes(df)
+    else:
+        dtype = dict((c, np.float32) for c in columns
+                     if TRAJ_DTYPES.get(c) == np.float32)
+        for df in pd.read_csv(path, usecols=columns, chunksize=chunksize,
+                              dtype=dtype or None):
+            yield compact_dtypes(df)
+
+
+def iter_column(path, column, chunksize=1 << 20):
+    '''
+    Reads one column of processed data in chunks (see iter_columns).
+    Yields:
+        arrays of column values
+    '''
+    for df in iter_columns(path, [column], chunksize=chunksize):
+        yield df[column].values
+
+
+def moving_counts(file_path, thresholds):
+    '''
+    Counts rows with speed above each of several thresholds in one pass.
+    Args:
+        file_path - path of processed trajectory csv file or store partition
+        thresholds - sequence of speed thresholds
+    Returns:
+        array of counts for each threshold, total number of rows (including
+        rows without a speed)
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(thresholds)
+    sorted_thresh = thresholds[order]
+    # hist[k] counts speeds above exactly k of the sorted thresholds
+    hist = np.zeros(len(thresholds) + 1, dtype=np.int64)
+    total = 0
+    for speed in iter_column(file_path, 'speed'):
+        total += len(speed)
+        speed = speed[~np.isnan(speed)]
+        hist += np.bincount(np.searchsorted(sorted_thresh, speed),
+                            minlength=len(thresholds) + 1)
+    counts = np.empty(len(thresholds), dtype=np.int64)
+    counts[order] = np.cumsum(hist[::-1])[::-1][1:]
+
+    return counts, total
+
+
+def _moving_counts_job(job):
+    return moving_counts(*job)
+
+
+def moving_props(counts, total):
+    '''
+    Returns:
+        counts / total as floats, NaN if total is 0 (no rows with a speed)
+    '''
+    if total == 0:
+        return np.full(len(counts), np.nan)
+    return counts.astype(np.float64) / total
+
+
 def perc_t_moving(file_path, threshold=1):
     '''
     Calculate the proportion of time bees are moving
     Args:
-        file_path - str containing path of processed trajectory csv file
-        threshold - velocity threshold for determining if bee is moving
+        file_path - str containing path of processed trajectory csv file or
+                    store partition
+        threshold - velocity threshold for determining if bee is moving, or a
+                    sequence of thresholds
     Returns:
-        float - proportion of time moving
+        float - proportion of time moving (array for a sequence of
+                thresholds), NaN if the file has no rows with a speed
     '''
-    df = pd.read_csv(file_path, index_col='traj')
-    return float(len(df[df.speed > threshold])) / float(len(df))
+    counts, total = moving_counts(file_path, np.atleast_1d(threshold))
+    prop = moving_props(counts, total)
+    if np.ndim(threshold) == 0:
+        return float(prop[0])
+    return prop
 
 
-def all_perc_t_moving(directory, conditions=[1, 2, 3, 4], threshold=1):
+def all_perc_t_moving(directory, conditions=[1, 2, 3, 4], threshold=1,
+                      processes=1):
     '''
     Call perc_t_moving on all processed trajectory files in directory
     Args:
@@ -625,33 +1599,150 @@ def all_perc_t_moving(directory, conditions=[1, 2, 3, 4], threshold=1):
                         directory -|-cond1/trajectory/
                                    |-cond2/trajectory/
                                    |-etc...
-        threshold - passed to perc_t_moving
+                    or be a columnar store (see list_processed)
+        threshold - passed to perc_t_moving. A sequence of thresholds is
+                    evaluated in a single pass over each file.
+        processes - number of files to read in parallel, 0 uses all
+                    processors
     Returns:
         DataFrame indexed by 'cond', 'date', with values 'perc_t_moving'
+        (NaN for files with no rows with a speed). For a sequence of
+        thresholds, there is a column for each threshold.
     '''
-    conditions_list = []
-    date_list = []
-    perc_list = []
-
-    for i in conditions:
-        print 'Condition %s' % i
-        path_str = '%s/cond%s/trajectory' % (directory, i)
-        files = []
-        for f in os.listdir(path_str):
-            if f[-4:] == '.csv':
-                files.append('/'.join((path_str, f)))
-
-        for f in files:
-            print 'Processing %s' % f
-            prop = perc_t_moving(f, threshold=threshold)
-            conditions_list.append(i)
-            date_list.append(f[-14:-4])
-            perc_list.append(prop)
+    files = list_processed(directory, conditions)
+    thresholds = np.atleast_1d(threshold)
+    jobs = [(f, thresholds) for i, date_str, f in files]
+    print 'Processing %s files' % len(jobs)
+    if processes == 1:
+        results = map(_moving_counts_job, jobs)
+    else:
+        pool = Pool(processes if processes > 0 else None)
+        results = pool.map(_moving_counts_job, jobs)
+        pool.close()
+        pool.join()
 
     print 'Making DataFrame'
-    df = pd.DataFrame({'cond': conditions_list, 'date': date_list,
-                       'perc_t_moving': perc_list}).set_index(['cond', 'date'])
-    return df
+    index = pd.MultiIndex.from_arrays([[f[0] for f in files],
+                                       [f[1] for f in files]],
+                                      names=['cond', 'date'])
+    props = np.array([moving_props(counts, total)
+                      for counts, total in results]).reshape(
+                          (len(files), len(thresholds)))
+    if np.ndim(threshold) == 0:
+        return pd.DataFrame({'perc_t_moving': props[:, 0]}, index=index)
+
+    return pd.DataFrame(props, index=index,
+                        columns=pd.Index(thresholds, name='threshold'))
+
+
+def _block_counts(starts, t, x, y, iterations, initial_time_step,
+                  scaling_factor, xy_boxes):
+    '''
+    Box counts for trajectories stored as contiguous runs of t, x and y, split
+    into blocks of the largest time box. Each sample is given an integer
+    (trajectory, time box, x box, y box) key once, and the boxes of larger
+    scales are found by integer division of the time box, so occupied boxes
+    are counted with np.unique for all trajectories at once.
+    Args:
+        starts - index of the first sample of each trajectory
+        t, x, y - arrays of samples
+        others - see box_counts
+    Returns:
+        log_inv_sizes - log(1/time box size) for each scale
+        counts - array (n_blocks, iterations) of occupied boxes in each block
+        block_starts - index of the first block of each trajectory
+        long_enough - boolean array (n_traj, iterations), False where a
+                      trajectory is not longer than the time box
+    '''
+    assert scaling_factor == int(scaling_factor)
+    scaling_factor = int(scaling_factor)
+    n_traj = len(starts)
+    group = np.repeat(np.arange(n_traj, dtype=np.int64),
+                      np.diff(np.append(starts, len(t))))
+    t = t.astype(np.float64)
+    tmin = np.minimum.reduceat(t, starts)
+    tmax = np.maximum.reduceat(t, starts)
+
+    # Spatial boxes, xy_boxes - 1 across each trajectory's range as with
+    # np.histogram2d and xy_boxes edges
+    n_xy = xy_boxes - 1
+    xy_key = np.zeros(len(t), dtype=np.int64)
+    for v in (x, y):
+        v = v.astype(np.float64)
+        vmin = np.minimum.reduceat(v, starts)
+        vrange = np.maximum.reduceat(v, starts) - vmin
+        vrange[vrange == 0] = 1.0
+        b = ((v - vmin[group]) / vrange[group] * n_xy).astype(np.int64)
+        xy_key = xy_key * n_xy + np.clip(b, 0, n_xy - 1)
+    t_box = ((t - tmin[group]) / initial_time_step).astype(np.int64)
+
+    # Blocks of the largest time box
+    n_blocks = np.maximum.reduceat(
+        t_box // scaling_factor ** (iterations - 1), starts) + 1
+    block_starts = np.append(0, np.cumsum(n_blocks)[:-1])
+    counts = np.zeros((n_blocks.sum(), iterations), dtype=np.int64)
+
+    sizes = initial_time_step * float(scaling_factor) ** np.arange(iterations)
+    for n in range(iterations):
+        t_box_n = t_box // scaling_factor ** n
+        n_t = int(t_box_n.max()) + 1
+        assert float(n_traj) * n_t * n_xy ** 2 < 2 ** 62
+        key = np.unique((group * n_t + t_box_n) * n_xy ** 2 + xy_key)
+        key //= n_xy ** 2
+        block = (block_starts[key // n_t] +
+                 (key % n_t) // scaling_factor ** (iterations - 1 - n))
+        counts[:, n] = np.bincount(block, minlength=len(counts))
+    long_enough = (tmax - tmin)[:, None] > sizes
+
+    return np.log(1.0 / sizes), counts, block_starts, long_enough
+
+
+def _box_counts(starts, t, x, y, iterations, initial_time_step,
+                scaling_factor, xy_boxes):
+    '''
+    Box counts for trajectories stored as contiguous runs of t, x and y (see
+    _block_counts).
+    Returns:
+        log(1/time box size) for each scale, array (n_traj, iterations) of
+        log(box count)
+    '''
+    log_inv_sizes, counts, block_starts, long_enough = _block_counts(
+        starts, t, x, y, iterations, initial_time_step, scaling_factor,
+        xy_boxes)
+    log_counts = np.full(long_enough.shape, np.nan)
+    totals = np.add.reduceat(counts, block_starts, axis=0)
+    log_counts[long_enough] = np.log(totals[long_enough])
+
+    return log_inv_sizes, log_counts
+
+
+def box_counts(df, iterations=3, initial_time_step=0.08, scaling_factor=2,
+               xy_boxes=100):
+    '''
+    Box counts every trajectory in a DataFrame at once. Spatial box-size is
+    fixed relative to each trajectory's range, and time box size is varied.
+    Args:
+        df - DataFrame containing trajectories, indexed by 'traj'
+        iterations - iterations of box-counting to perform
+        initial_time_step - size of initial time boxes
+        scaling_factor - integer factor to increase box sizes by each
+                         iteration
+        xy_boxes - number of spatial box edges (across one row/column)
+    Returns:
+        trajs - array of trajectory indices
+        log_inv_sizes - array (iterations, ) of log(1/stepsize)
+        log_counts - array (n_traj, iterations) of log(box_count). NaN where
+                     a trajectory is not longer than the time box.
+    '''
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='mergesort')
+    traj = df.index.values
+    starts = np.flatnonzero(np.insert(traj[1:] != traj[:-1], 0, True))
+    log_inv_sizes, log_counts = _box_counts(
+        starts, df.t.values, df.x.values, df.y.values, iterations,
+        initial_time_step, scaling_factor, xy_boxes)
+
+    return traj[starts], log_inv_sizes, log_counts
 
 
 def box_count(df, iterations=3, initial_time_step=0.08, scaling_factor=2,
@@ -664,40 +1755,18 @@ def box_count(df, iterations=3, initial_time_step=0.08, scaling_factor=2,
         df - DataFrame containing single trajectory
         iterations - iterations of box-counting to perform
         initial_time_step - size of initial time boxes
-        scaling_factor - factor to increase box sizes by each iteration
+        scaling_factor - integer factor to increase box sizes by each
+                         iteration
         xy_boxes - number of spatial boxes (across one row/column)
     Returns:
         array with log(1/stepsize) down the first column and log(box_count) down
         the second column.
     '''
-    tmin, tmax = df.t.min(), df.t.max()
-    xmin, xmax = df.x.min(), df.x.max()
-    ymin, ymax = df.y.min(), df.y.max()
-    t = df.t.values - tmin,
-    x = (df.x.values - xmin) / (xmax - xmin)  # Normed
-    y = (df.y.values - ymin) / (ymax - ymin)  # Normed
-    # Spatial box edges:
-    xybins = [np.linspace(0.0, 1.0, num=xy_boxes) for i in range(2)]
-
-    # Determine box count for various time-step box sizes
-    box_count_list = []
-    for n in range(iterations):
-        print 'Scale iteration %i.' % (n + 1)
-        t_size = initial_time_step * scaling_factor ** n
-        assert t_size < tmax - tmin
-        box_number = int((tmax - tmin) / t_size)
-        box_count = 0
-        t_boxes, t_actual_size = np.linspace(0.0, tmax - tmin, num=box_number,
-                                             endpoint=False, retstep=True)
-        for time in t_boxes:
-            print '\rProgress %d / %d     ' % (time, tmax - tmin),
-            time_mask = np.bitwise_and(t >= time, t < time + t_actual_size)[0]
-            pos_hist = np.histogram2d(x[time_mask], y[time_mask], bins=xybins)
-            box_count += np.count_nonzero(pos_hist[0])
-        print '\rDone.                                               '
-        box_count_list.append([np.log(1.0 / t_actual_size), np.log(box_count)])
-
-    return np.array(box_count_list)
+    log_inv_sizes, log_counts = _box_counts(
+        np.array([0]), df.t.values, df.x.values, df.y.values, iterations,
+        initial_time_step, scaling_factor, xy_boxes)
+
+    return np.column_stack((log_inv_sizes, log_counts[0]))
 
 
 def fractal_dim(box_counts):
@@ -719,6 +1788,21 @@ def fractal_dim(box_counts):
     return fractal_dimension
 
 
+def fractal_slopes(log_inv_sizes, log_counts):
+    '''
+    Slopes of linear regressions of log_counts on log_inv_sizes for many
+    trajectories at once (see fractal_dim).
+    Args:
+        log_inv_sizes - array (iterations, )
+        log_counts - array (n_traj, iterations)
+    Returns:
+        array (n_traj, ) of fractal dimensions, NaN if any count is NaN
+    '''
+    dx = log_inv_sizes - log_inv_sizes.mean()
+
+    return (log_counts * dx).sum(axis=-1) / (dx ** 2).sum()
+
+
 def fractal_dims(df, iterations=3, initial_time_step=0.08, scaling_factor=2,
                  xy_boxes=100):
     '''
@@ -727,21 +1811,189 @@ def fractal_dims(df, iterations=3, initial_time_step=0.08, scaling_factor=2,
         df - DataFrame containing trajectories, indexed by 'traj'
         iterations - iterations of box-counting to perform
         initial_time_step - size of initial time boxes
-        scaling_factor - factor to increase box sizes by each iteration
+        scaling_factor - integer factor to increase box sizes by each
+                         iteration
         xy_boxes - number of spatial boxes (across one row/column)
     Returns:
-        array containing trajectory index, fractal dimension pairs
+        array containing trajectory index, fractal dimension pairs. Dimension
+        is NaN for trajectories too short for the largest time box.
     '''
-    dim_list = []
-    for traj in df.index.unique():
-        print 'Trajectory %i' % traj
-        bc = box_count(df.loc[traj], iterations=iterations,
-                       initial_time_step=initial_time_step,
-                       scaling_factor=scaling_factor,
-                       xy_boxes=xy_boxes)
-        dim_list.append([traj, fractal_dim(bc)])
+    trajs, log_inv_sizes, log_counts = box_counts(
+        df, iterations=iterations, initial_time_step=initial_time_step,
+        scaling_factor=scaling_factor, xy_boxes=xy_boxes)
+
+    return np.column_stack((trajs, fractal_slopes(log_inv_sizes, log_counts)))
+
+
+def _fractal_fit(starts, t, x, y, iterations=3, initial_time_step=0.08,
+                 scaling_factor=2, xy_boxes=100, bootstrap=0, ci=0.95,
+                 seed=0):
+    '''
+    Fits fractal dimensions of trajectories stored as contiguous runs of t, x
+    and y. Confidence intervals are from a block bootstrap: blocks of the
+    largest time box are resampled with replacement and the box counts of
+    every scale refitted.
+    Args:
+        starts - index of the first sample of each trajectory
+        t, x, y - arrays of samples
+        bootstrap - number of bootstrap resamples, 0 for no intervals
+        ci - confidence level of intervals
+        seed - random seed of the first trajectory, incremented for each
+               trajectory so results do not depend on how trajectories are
+               split between workers
+        others - see box_counts
+    Returns:
+        array (n_traj, 4) of dimension, rms residual of the fit, lower and
+        upper confidence limits (NaN without bootstrap)
+    '''
+    log_inv_sizes, counts, block_starts, long_enough = _block_counts(
+        starts, t, x, y, iterations, initial_time_step, scaling_factor,
+        xy_boxes)
+    log_counts = np.full(long_enough.shape, np.nan)
+    totals = np.add.reduceat(counts, block_starts, axis=0)
+    log_counts[long_enough] = np.log(totals[long_enough])
+
+    out = np.full((len(starts), 4), np.nan)
+    out[:, 0] = fractal_slopes(log_inv_sizes, log_counts)
+    dx = log_inv_sizes - log_inv_sizes.mean()
+    fitted = (log_counts.mean(axis=1)[:, None] + out[:, 0][:, None] * dx)
+    out[:, 1] = np.sqrt(np.mean((log_counts - fitted) ** 2, axis=1))
+
+    if bootstrap > 0:
+        block_ends = np.append(block_starts[1:], len(counts))
+        alpha = 50.0 * (1.0 - ci)
+        for i in np.flatnonzero(np.all(long_enough, axis=1)):
+            rng = np.random.RandomState(seed + i)
+            c = counts[block_starts[i]:block_ends[i]]
+            boot = []
+            # Resample in batches to bound memory for long trajectories
+            for b in range(0, bootstrap, 64):
+                w = rng.multinomial(len(c), np.full(len(c), 1.0 / len(c)),
+                                    size=min(64, bootstrap - b))
+                with np.errstate(divide='ignore'):
+                    boot.append(fractal_slopes(log_inv_sizes,
+                                               np.log(np.dot(w, c))))
+            out[i, 2:] = np.percentile(np.hstack(boot), [alpha, 100 - alpha])
+
+    return out
+
+
+_fractal_shared = {}
+
+
+def _init_fractal_worker(t, x, y, starts, kwds):
+    '''
+    Pool initializer. Wraps shared arrays without copying.
+    '''
+    _fractal_shared['t'] = np.frombuffer(t, dtype=np.float64)
+    _fractal_shared['x'] = np.frombuffer(x, dtype=np.float32)
+    _fractal_shared['y'] = np.frombuffer(y, dtype=np.float32)
+    _fractal_shared['starts'] = np.frombuffer(starts, dtype=np.int64)
+    _fractal_shared['kwds'] = kwds
+
+
+def _fractal_worker(chunk):
+    '''
+    Fits fractal dimensions of trajectories lo to hi of the shared arrays.
+    '''
+    lo, hi = chunk
+    starts = _fractal_shared['starts']
+    first = starts[lo]
+    last = starts[hi] if hi < len(starts) else len(_fractal_shared['t'])
+    kwds = dict(_fractal_shared['kwds'])
+    kwds['seed'] = kwds.get('seed', 0) + lo
+
+    return _fractal_fit(starts[lo:hi] - first,
+                        _fractal_shared['t'][first:last],
+                        _fractal_shared['x'][first:last],
+                        _fractal_shared['y'][first:last], **kwds)
+
+
+def _shared_array(a, ctype, dtype):
+    shared = RawArray(ctype, len(a))
+    np.frombuffer(shared, dtype=dtype)[:] = a
+    return shared
+
+
+def fractal_dims_table(df, iterations=3, initial_time_step=0.08,
+                       scaling_factor=2, xy_boxes=100, bootstrap=0, ci=0.95,
+                       seed=0, processes=1):
+    '''
+    Estimates fractal dimension of trajectories in DataFrame, optionally with
+    bootstrap confidence intervals, splitting trajectories between worker
+    processes. Coordinates are put in shared memory once rather than copied
+    to each worker.
+    Args:
+        df - DataFrame containing trajectories, indexed by 'traj'
+        iterations, initial_time_step, scaling_factor, xy_boxes - see
+            box_counts
+        bootstrap - number of block bootstrap resamples for confidence
+                    intervals, 0 for none
+        ci - confidence level of intervals
+        seed - random seed for bootstrap
+        processes - number of worker processes, 0 uses all processors
+    Returns:
+        DataFrame with columns 'traj', 'dimension', 'residual' (rms residual
+        of the log-log fit), 'dim_low' and 'dim_high' (confidence limits,
+        NaN without bootstrap)
+    '''
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='mergesort')
+    traj = df.index.values
+    starts = np.flatnonzero(np.insert(traj[1:] != traj[:-1], 0, True))
+    kwds = {'iterations': iterations, 'initial_time_step': initial_time_step,
+            'scaling_factor': scaling_factor, 'xy_boxes': xy_boxes,
+            'bootstrap': bootstrap, 'ci': ci, 'seed': seed}
+
+    if processes == 1 or len(starts) < 2:
+        out = _fractal_fit(starts, df.t.values, df.x.values, df.y.values,
+                           **kwds)
+    else:
+        if processes < 1:
+            processes = cpu_count()
+        # Chunks of about equal numbers of samples
+        bounds = np.unique(np.searchsorted(
+            starts, np.linspace(0, len(df), 4 * processes + 1)[1:-1]))
+        bounds = [0] + [b for b in bounds if 0 < b < len(starts)] + \
+            [len(starts)]
+        pool = Pool(processes, initializer=_init_fractal_worker, initargs=(
+            _shared_array(df.t.values, ctypes.c_double, np.float64),
+            _shared_array(df.x.values, ctypes.c_float, np.float32),
+            _shared_array(df.y.values, ctypes.c_float, np.float32),
+            _shared_array(starts, ctypes.c_int64, np.int64), kwds))
+        out = np.vstack(pool.map(_fractal_worker, zip(bounds[:-1],
+                                                      bounds[1:])))
+        pool.close()
+        pool.join()
+
+    table = pd.DataFrame(out, columns=['dimension', 'residual', 'dim_low',
+                                       'dim_high'])
+    table.insert(0, 'traj', traj[starts])
+    return table
+
+
+def all_fractal_dims(directory, conditions=[1, 2, 3, 4], **kwargs):
+    '''
+    Calls fractal_dims_table on all processed trajectory files in directory
+    (see list_processed), reading only t, x and y.
+    Args:
+        directory - directory processed data is stored in
+        conditions - conditions to process
+        **kwargs passed to fractal_dims_table
+    Returns:
+        DataFrame with columns 'cond', 'date', then those of
+        fractal_dims_table
+    '''
+    table_list = []
+    for c, date_str, path in list_processed(directory, conditions):
+        print 'Condition %s %s' % (c, date_str)
+        table = fractal_dims_table(read_traj(path, columns=['t', 'x', 'y']),
+                                   **kwargs)
+        table.insert(0, 'date', date_str)
+        table.insert(0, 'cond', c)
+        table_list.append(table)
 
-    return np.array(dim_list)
+    return pd.concat(table_list, ignore_index=True)
 
 
 def parse_args():
@@ -757,7 +2009,7 @@ def parse_args():
 def main():
     args = parse_args()
     if len(args.i) > 0:
-        df = pd.read_csv(args.i, index_col='traj')
+        df = read_traj_csv(args.i)
     return df
 
 if __name__ == "__main__":
@@ -1,12 +1,21 @@
 # Fits a Gaussian Hidden Markov Model to determine underlying behavioural
 # regimes.
 
+import argparse
 from hmmlearn.hmm import GaussianHMM
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+import collections
+from feature_store import FeatureStore
+from hmm_em import ParallelGaussianHMM
 import numpy as np
+import os
 import pandas as pd
-from post_process import subsample, calculate_velocity
+import time
+from post_process import subsample, calculate_velocity, read_traj, \
+    decimate_series, line_segments
+from traj_store import list_partitions, write_column
 
 
 def sub_calc(df, subsample_factor):
@@ -31,14 +40,19 @@ def get_features(df, features=['speed', 'rotation']):
         features - features to include. Default ['speed', 'rotation']
     Returns:
         X, lengths
-        X - features matrix
-        lengths - lengths of samples
+        X - features matrix, without the first two rows of each trajectory
+        lengths - lengths of samples. Trajectories of two rows or fewer have
+                  no rows left and are left out.
     '''
-    feature_list = []
-    for traj in df.index.unique():
-        feature_list.append(df.loc[traj][features].values[2:])
+    starts, ends = traj_bounds(df.index.values)
+    first = np.minimum(starts + 2, ends)
+    lengths = ends - first
+    rows = np.repeat(first - np.cumsum(lengths) + lengths, lengths) + \
+        np.arange(lengths.sum())
 
-    return (np.vstack(feature_list), np.array([len(a) for a in feature_list]))
+    # Models are fitted in double precision
+    return (df[features].values[rows].astype(np.float64),
+            lengths[lengths > 0])
 
 
 def fit_hmm(df, n_components, features=['speed', 'rotation'],
@@ -60,6 +74,20 @@ def fit_hmm(df, n_components, features=['speed', 'rotation'],
     return model
 
 
+def traj_bounds(traj_idx):
+    '''
+    Trajectories are contiguous runs of the index.
+    Args:
+        traj_idx - trajectory number of each row
+    Returns:
+        starts, ends - row ranges of each trajectory
+    '''
+    starts = np.flatnonzero(np.insert(traj_idx[1:] != traj_idx[:-1], 0, True))
+    ends = np.append(starts[1:], len(traj_idx))
+
+    return starts, ends
+
+
 def decode_states(df, model, features=['speed', 'rotation']):
     '''
     Decode each trajectory and add a 'state' column to df (inplace).
@@ -68,15 +96,24 @@ def decode_states(df, model, features=['speed', 'rotation']):
         model - model to decode with
         features - features used for model fitting
     Returns:
-        DataFrame indexed by 'traj' with values 'logprob' (logprob of path)
-        'state' columns is added to df in place.
+        DataFrame indexed by 'traj' with values 'logprob' (logprob of path,
+        NaN for trajectories of two rows or fewer, which are not decoded)
+        int8 'state' column is added to df in place, -1 where not decoded.
     '''
     lnp_list = []
-    df['state'] = np.nan
-    for traj in df.index.unique():
-        lnp, states = model.decode(df.loc[traj][features].values[2:])
-        lnp_list.append([traj, lnp])
-        df.loc[traj]['state'].iloc[2:] = states
+    X = df[features].values.astype(np.float64)
+    state = np.full(len(df), -1, dtype=np.int8)
+    traj_idx = df.index.values
+    starts, ends = traj_bounds(traj_idx)
+    for start, end in zip(starts, ends):
+        # Trajectories of two rows or fewer have nothing to decode
+        if end - start <= 2:
+            lnp_list.append([traj_idx[start], np.nan])
+            continue
+        lnp, states = model.decode(X[start + 2:end])
+        lnp_list.append([traj_idx[start], lnp])
+        state[start + 2:end] = states
+    df['state'] = state
 
     lnp_df = pd.DataFrame(lnp_list, columns=['traj', 'lnp']).set_index('traj')
 
@@ -91,11 +128,14 @@ def thresh_decode(df, threshold, feature='speed'):
         threshold - value to threshold at
         feature - feature to threshold over. Default: 'speed'
     Returns:
-        None. column 'thresh' is added to df in place.
+        None. int8 column 'thresh' is added to df in place, -1 where feature
+        is NaN.
     '''
-    df['thresh'] = np.nan
-    df.thresh[df[feature] > threshold] = 1
-    df.thresh[df[feature] <= threshold] = 0
+    values = df[feature].values
+    thresh = np.full(len(df), -1, dtype=np.int8)
+    thresh[values > threshold] = 1
+    thresh[values <= threshold] = 0
+    df['thresh'] = thresh
 
     return None
 
@@ -111,7 +151,7 @@ def features_from_csv(path, features=['speed', 'rotation'], subsample_factor=1):
         X, lengths, trajectory DataFrame
     '''
     print 'Loading %s' % path
-    df = pd.read_csv(path, index_col='traj')
+    df = read_traj(path)
     print 'Subsampling... Factor: %d' % subsample_factor
     df1 = sub_calc(df, subsample_factor)
     print 'Getting features...'
@@ -132,7 +172,7 @@ def fit_from_csv(path, n_components=2, subsample_factor=1,
         model, DataFrame
     '''
     print 'Loading %s' % path
-    df = pd.read_csv(path, index_col='traj')
+    df = read_traj(path)
     print 'Subsampling... Factor: %d' % subsample_factor
     df1 = sub_calc(df, subsample_factor)
     print 'Fitting model...'
@@ -154,7 +194,7 @@ def decode_from_csv(path, model, subsample_factor=1,
         lnp_df - log probability DataFrame
     '''
     print 'Loading %s' % path
-    df = pd.read_csv(path, index_col='traj')
+    df = read_traj(path)
     print 'Subsampling... Factor: %d' % subsample_factor
     df1 = sub_calc(df, subsample_factor)
     print 'Running Viterbi algorithm...'
@@ -170,7 +210,7 @@ def count_states(df):
     Returns:
         array with shape (n_components, )
     '''
-    return np.bincount(df.state.dropna().astype(np.int64))
+    return np.bincount(df.state.values[df.state.values >= 0].astype(np.int64))
 
 
 def fit_and_decode(traj_data, concat_fit=True, n_components=2,
@@ -208,7 +248,7 @@ def fit_and_decode(traj_data, concat_fit=True, n_components=2,
 
         if concat_fit is True:
             print 'Loading %s' % path
-            df = pd.read_csv(path, index_col='traj')
+            df = read_traj(path)
             print 'Subsampling... Factor: %d' % subsample_factor
             df = sub_calc(df, subsample_factor)
 
@@ -233,8 +273,59 @@ def fit_and_decode(traj_data, concat_fit=True, n_components=2,
     return model, lnp_df_list, np.vstack(state_counts_list)
 
 
+def build_feature_store(traj_data, store_path, features=['speed', 'rotation'],
+                        subsample_factor=1):
+    '''
+    Appends the features of trajectory files to a feature store (see
+    feature_store.py), one file at a time. Files already in the store are
+    skipped, so the store grows as new days are processed. A file modified
+    since it was added (eg. a day still being processed) is replaced: the
+    store is truncated before it and it is appended again, with any files
+    that followed it.
+    Args:
+        traj_data - list of trajectory csv paths
+        store_path - directory of feature store
+        features - feature columns (must match an existing store)
+        subsample_factor - subsample factor to apply to all files (must match
+                           an existing store)
+    Returns:
+        FeatureStore
+    '''
+    store = FeatureStore(store_path, features=features,
+                         subsample_factor=subsample_factor)
+    paths = list(traj_data)
+    mtimes = dict((path, os.path.getmtime(path)) for path in paths)
+    stale = [i for i, s in enumerate(store.meta['sources'])
+             if s['path'] in mtimes and s['mtime'] != mtimes[s['path']]]
+    if len(stale) > 0:
+        removed = [s['path'] for s in store.meta['sources'][stale[0]:]]
+        print 'Source files changed, appending %s files again' % len(removed)
+        store.truncate(stale[0])
+        # Sources that followed a changed one are kept if they still exist
+        for path in removed:
+            if path not in mtimes and os.path.exists(path):
+                paths.append(path)
+                mtimes[path] = os.path.getmtime(path)
+    for path in paths:
+        if store.has_source(path):
+            continue
+        print 'Loading %s' % path
+        df = sub_calc(read_traj(path), subsample_factor)
+        # As get_features, without the first two rows of each trajectory
+        starts, ends = traj_bounds(df.index.values)
+        first = np.minimum(starts + 2, ends)
+        lengths = ends - first
+        rows = np.repeat(first - np.cumsum(lengths) + lengths, lengths) + \
+            np.arange(lengths.sum())
+        store.append(df[features].values[rows], lengths,
+                     df.index.values[starts], path, mtime=mtimes[path])
+
+    return store
+
+
 def fit_batch(traj_data, n_components=2, subsample_factor=1,
-              features=['speed', 'rotation'], **kwargs):
+              features=['speed', 'rotation'], engine='hmmlearn',
+              store_path=None, **kwargs):
     '''
     Fits model to concatenated traj_data
     Args:
@@ -242,24 +333,44 @@ def fit_batch(traj_data, n_components=2, subsample_factor=1,
         n_components - number of hidden states
         subsample_factor - subsample factor to apply to all files
         features - columns to fit model to
-        **kwargs passed to GaussianHMM
+        engine - 'hmmlearn', or 'parallel' to fit with
+                 hmm_em.ParallelGaussianHMM (eg. processes=8, batch_size=200)
+        store_path - directory of a feature store. If given, traj_data are
+                     added to the store (see build_feature_store) and the
+                     model is fitted to their data in the store (see
+                     FeatureStore.select) through a memory map rather than
+                     concatenated in memory. Use with engine='parallel' for
+                     data larger than memory.
+        **kwargs passed to GaussianHMM or ParallelGaussianHMM
     Returns:
-        model - fitted model
+        model - fitted model (GaussianHMM for either engine)
     '''
-    # Concatenate data
-    feature_list = []
-    lengths_list = []
-    for path in traj_data:
-        X, l = features_from_csv(path, features=features,
-                                 subsample_factor=subsample_factor)
-        feature_list.append(X)
-        lengths_list.append(l)
-    print 'Concatenating features...'
-    X = np.vstack(feature_list)
-    l = np.hstack(lengths_list)
+    if store_path is not None:
+        store = build_feature_store(traj_data, store_path, features=features,
+                                    subsample_factor=subsample_factor)
+        X, l = store.select(traj_data)
+    else:
+        # Concatenate data
+        feature_list = []
+        lengths_list = []
+        for path in traj_data:
+            X, l = features_from_csv(path, features=features,
+                                     subsample_factor=subsample_factor)
+            feature_list.append(X)
+            lengths_list.append(l)
+        print 'Concatenating features...'
+        X = np.vstack(feature_list)
+        l = np.hstack(lengths_list)
+    # Sequences without rows (trajectories of two rows or fewer) are not
+    # accepted by GaussianHMM.fit
+    l = l[l > 0]
 
     # Fit HMM
     print 'Fitting model...'
+    if engine == 'parallel':
+        model = ParallelGaussianHMM(n_components, **kwargs)
+        return model.fit(X, lengths=l).to_hmmlearn()
+
     model = GaussianHMM(n_components, **kwargs)
     model.fit(X, lengths=l)
 
@@ -290,6 +401,349 @@ def decode_batch(traj_data, model, subsample_factor=1,
     return df_list, lnp_df_list
 
 
+def decode_store(store_path, model, column='state'):
+    '''
+    Viterbi decodes each sequence of a feature store from its memory map.
+    Args:
+        store_path - directory of feature store (see build_feature_store)
+        model - fitted HMM to decode data with
+        column - name of store column to write states to
+    Returns:
+        DataFrame with columns 'source', 'traj' and 'lnp' (logprob of path)
+        for each sequence. int8 states are written to the store column
+        (FeatureStore.column), -1 where not decoded.
+    '''
+    store = FeatureStore(store_path)
+    X = store.data()
+    state = store.column(column)
+    lnp = np.full(len(store.lengths), np.nan)
+    for i, (start, length) in enumerate(zip(store.offsets, store.lengths)):
+        if length > 0:
+            lnp[i], state[start:start + length] = model.decode(
+                X[start:start + length])
+    if len(state) > 0:
+        state.flush()
+
+    lnp_df = store.sequences()[['source', 'traj']]
+    lnp_df['lnp'] = lnp
+
+    return lnp_df
+
+
+def decode_partition(path, model=None, threshold=None,
+                     features=['speed', 'rotation'], feature='speed'):
+    '''
+    Decodes a processed store partition (see traj_store) and saves the states
+    in it as a column, row aligned with the partition, for bouts.file_bouts.
+    Args:
+        path - partition directory
+        model - fitted HMM to decode with (decode_states), written to column
+                'state'
+        threshold - if model is None, threshold to decode with
+                    (thresh_decode), written to column 'thresh'
+        features - features used for model fitting
+        feature - feature to threshold
+    Returns:
+        DataFrame indexed by 'traj' with values 'lnp' for a model, otherwise
+        None
+    '''
+    lnp_df = None
+    if model is not None:
+        df = read_traj(path, columns=features)
+        lnp_df = decode_states(df, model, features=features)
+        column = 'state'
+    else:
+        assert threshold is not None
+        df = read_traj(path, columns=[feature])
+        thresh_decode(df, threshold, feature=feature)
+        column = 'thresh'
+    write_column(path, column, df[column].values)
+
+    return lnp_df
+
+
+def decode_partitions(store_dir, model=None, threshold=None, conditions=None,
+                      **kwargs):
+    '''
+    Calls decode_partition on each trajectory partition of a processed store.
+    Args:
+        store_dir - root directory of store
+        conditions - conditions to decode, by default all
+        others - see decode_partition
+    Returns:
+        list of partition paths
+    '''
+    paths = []
+    for condition, date, path in list_partitions(store_dir).values:
+        if conditions is not None and condition not in conditions:
+            continue
+        print 'Decoding condition %s, %s' % (condition, date)
+        decode_partition(path, model=model, threshold=threshold, **kwargs)
+        paths.append(path)
+
+    return paths
+
+
+def _logsumexp(a, axis):
+    m = np.max(a, axis=axis, keepdims=True)
+    m[~np.isfinite(m)] = 0.0
+    return np.log(np.sum(np.exp(a - m), axis=axis)) + np.squeeze(m, axis=axis)
+
+
+class _OnlineTrack:
+    '''
+    Decoding state of one track in OnlineDecoder.
+    '''
+    def __init__(self):
+        self.samples = 0            # Subsampled positions seen
+        self.last = None            # Last (t, x, y)
+        self.angle = np.nan         # Last movement angle
+        self.bin = []               # Positions waiting to be subsampled
+        self.log_alpha = None       # Normalised log forward probabilities
+        self.window = collections.deque()   # (t, log_alpha, log_lik) to smooth
+
+
+class OnlineDecoder:
+    '''
+    Decodes behavioural states live, as positions arrive, with the parameters
+    of a GaussianHMM (eg. from fit_hmm). For each track, positions are
+    subsampled and features calculated as by sub_calc, then states are
+    estimated by forward filtering (lag=0), or by fixed-lag smoothing: the
+    estimate for a sample is emitted once lag more samples of the track have
+    arrived. State per track is O(lag * n_components).
+    Estimates are the most probable state at each time given the data so far,
+    equal to model.predict_proba (not the Viterbi path) when the lag covers
+    the whole track.
+    As in decode_states, the first 2 samples of each track are not decoded.
+    Positions at 0, 0 (track not found yet) are ignored, and a track ends when
+    it is missing from an update (see multi_tracker.MultiKalman.coords).
+    '''
+    def __init__(self, model, features=['speed', 'rotation'], lag=0,
+                 subsample_factor=1, centre=None, on_state=None):
+        '''
+        Args:
+            model - fitted GaussianHMM
+            features - features the model was fitted to, from 'speed',
+                       'rotation', 'angle' and 'd_mid' (requires centre)
+            lag - number of samples to smooth over
+            subsample_factor - factor the model's data was subsampled by
+            centre - (x, y) centre of dish for 'd_mid'
+            on_state - optional function called with each list of estimates
+                       returned by update and flush
+        '''
+        self.model = model
+        self.features = list(features)
+        self.lag = lag
+        self.subsample_factor = subsample_factor
+        self.centre = centre
+        self.on_state = on_state
+        with np.errstate(divide='ignore'):
+            self.log_startprob = np.log(model.startprob_)
+            self.log_transmat = np.log(model.transmat_)
+        self.tracks = {}
+
+    def _features(self, track, t, x, y):
+        '''
+        Adds a subsampled position to a track.
+        Returns:
+            feature vector, or None if it cannot be decoded yet
+        '''
+        values = {}
+        if track.last is not None:
+            t0, x0, y0 = track.last
+            angle = np.arctan2(y - y0, x - x0)
+            values['angle'] = angle
+            values['speed'] = np.sqrt((x - x0) ** 2 + (y - y0) ** 2) / (t - t0)
+            rot = np.mod(angle - track.angle, 2 * np.pi)
+            if rot > np.pi:
+                rot -= 2 * np.pi
+            values['rotation'] = rot / (t - t0)
+            track.angle = angle
+        if self.centre is not None:
+            values['d_mid'] = np.sqrt((x - self.centre[0]) ** 2 +
+                                      (y - self.centre[1]) ** 2)
+        track.last = (t, x, y)
+        track.samples += 1
+        if track.samples <= 2:
+            return None
+        row = np.array([values.get(f, np.nan) for f in self.features])
+        if np.isnan(row).any():
+            return None
+
+        return row
+
+    def _smoothed(self, track_id, track, count):
+        '''
+        Pops the oldest count samples from a track's window.
+        Returns:
+            list of (track, t, state, posterior probabilities)
+        '''
+        window = track.window
+        beta = np.zeros(len(self.log_startprob))
+        betas = [beta]
+        for i in range(len(window) - 1, 0, -1):
+            ll = window[i][2]
+            beta = _logsumexp(self.log_transmat + (ll + beta)[np.newaxis, :],
+                              axis=1)
+            betas.append(beta)
+        betas.reverse()
+        out = []
+        for i in range(count):
+            t, log_alpha, ll = window.popleft()
+            log_post = log_alpha + betas[i]
+            post = np.exp(log_post - _logsumexp(log_post, axis=0))
+            out.append((track_id, t, int(np.argmax(post)), post))
+
+        return out
+
+    def update(self, t, coords):
+        '''
+        Adds the positions of tracks at a time.
+        Args:
+            t - time in seconds
+            coords - iterable of (track number, x, y)
+        Returns:
+            list of (track, t, state, posterior probabilities) estimates
+            which have become available, oldest first for each track
+        '''
+        out = []
+        ready = []
+        seen = set()
+        for track_id, x, y in coords:
+            if x <= 0 or y <= 0:
+                continue
+            seen.add(track_id)
+            track = self.tracks.get(track_id)
+            if track is None:
+                track = self.tracks[track_id] = _OnlineTrack()
+            if self.subsample_factor > 1:
+                track.bin.append((t, x, y))
+                if len(track.bin) < self.subsample_factor:
+                    continue
+                st, sx, sy = np.median(track.bin, axis=0)
+                track.bin = []
+            else:
+                st, sx, sy = t, x, y
+            row = self._features(track, st, sx, sy)
+            if row is not None:
+                ready.append((track_id, track, st, row))
+
+        # Tracks missing from this update have ended
+        for track_id in [i for i in self.tracks if i not in seen]:
+            out.extend(self._finish(track_id))
+
+        if len(ready) > 0:
+            log_lik = self.model._compute_log_likelihood(
+                np.vstack([r[3] for r in ready]))
+            for (track_id, track, st, row), ll in zip(ready, log_lik):
+                if track.log_alpha is None:
+                    log_alpha = self.log_startprob + ll
+                else:
+                    log_alpha = _logsumexp(track.log_alpha[:, np.newaxis] +
+                                           self.log_transmat, axis=0) + ll
+                track.log_alpha = log_alpha - _logsumexp(log_alpha, axis=0)
+                track.window.append((st, track.log_alpha, ll))
+                if len(track.window) > self.lag:
+                    out.extend(self._smoothed(track_id, track, 1))
+
+        if self.on_state is not None and len(out) > 0:
+            self.on_state(out)
+        return out
+
+    def _finish(self, track_id):
+        track = self.tracks.pop(track_id)
+        return self._smoothed(track_id, track, len(track.window))
+
+    def flush(self):
+        '''
+        Ends all tracks, emitting estimates still waiting for lag samples.
+        Returns:
+            list of (track, t, state, posterior probabilities)
+        '''
+        out = []
+        for track_id in list(self.tracks):
+            out.extend(self._finish(track_id))
+        if self.on_state is not None and len(out) > 0:
+            self.on_state(out)
+        return out
+
+
+def follow_traj_file(path, interval=0.5, timeout=None):
+    '''
+    Reads rows from a raw trajectory file (see multi_tracker.MultiKalman
+    .write_coords) as they are written, like tail -f.
+    Args:
+        path - path of trajectory file
+        interval - seconds to wait between checks for new rows
+        timeout - stop after this many seconds without new rows, by default
+                  follow forever
+    Yields:
+        t, list of (track number, x, y)
+    '''
+    while not os.path.exists(path):
+        time.sleep(interval)
+    waited = 0.0
+    partial = ''
+    with open(path, 'r') as in_file:
+        while 1:
+            line = in_file.readline()
+            if line == '':
+                if timeout is not None and waited >= timeout:
+                    break
+                time.sleep(interval)
+                waited += interval
+                continue
+            waited = 0.0
+            partial += line
+            if not partial.endswith('\n'):
+                continue
+            values = partial.split(',')
+            partial = ''
+            n = (len(values) - 1) / 3
+            yield float(values[0]), [(int(values[3 * i + 1]),
+                                      float(values[3 * i + 2]),
+                                      float(values[3 * i + 3]))
+                                     for i in range(n)]
+
+
+def decode_file_online(path, model, out_path=None, interval=0.5, timeout=None,
+                       **kwargs):
+    '''
+    Decodes states from a trajectory file while it is being written by the
+    tracker (see follow_traj_file).
+    Args:
+        path - path of raw trajectory file
+        model - fitted GaussianHMM
+        out_path - optional csv file to write t,track,state rows to
+        interval, timeout - passed to follow_traj_file
+        **kwargs passed to OnlineDecoder
+    Returns:
+        DataFrame with columns 't', 'track' and 'state'
+    '''
+    rows = []
+    out_file = None if out_path is None else open(out_path, 'w')
+
+    def on_state(estimates):
+        for track, t, state, post in estimates:
+            rows.append((t, track, state))
+            if out_file is not None:
+                out_file.write('%f,%i,%i\n' % (t, track, state))
+        if out_file is not None:
+            out_file.flush()
+
+    decoder = OnlineDecoder(model, on_state=on_state, **kwargs)
+    try:
+        for t, coords in follow_traj_file(path, interval=interval,
+                                          timeout=timeout):
+            decoder.update(t, coords)
+        decoder.flush()
+    finally:
+        if out_file is not None:
+            out_file.close()
+
+    return pd.DataFrame(rows, columns=['t', 'track', 'state'])
+
+
 def get_state_times(df, n_bees=1, state_col='state'):
     '''
     Gets xranges and yranges for broken_barh
@@ -302,6 +756,7 @@ def get_state_times(df, n_bees=1, state_col='state'):
     '''
     assert state_col in {'state', 'thresh'}
     df1 = df.dropna()[['t', state_col]]
+    df1 = df1[df1[state_col] >= 0]
     components = df1[state_col].unique()
     components.sort()
     if state_col == 'state':
@@ -342,14 +797,18 @@ def get_state_times(df, n_bees=1, state_col='state'):
 
 
 def plot_states(df, n_bees=1, colors=('red', 'blue', 'yellow', 'green'),
-                plot_thresh_model=False):
+                plot_thresh_model=False, buckets=2000):
     '''
     Produces figure with plots of position, and state for decoded DataFrame.
+    Each feature is decimated to buckets points in time (see
+    post_process.decimate_series) and drawn as a single LineCollection, so a
+    whole day can be plotted.
     Args:
         df - trajectory Dataframe which has been decoded.
         n_bees - number of bees
         colors - colors to represent each state in.
         plot_thresh_model - Boolean of whether to plot thresh model below HMM
+        buckets - horizontal resolution lines are decimated to
     Returns:
         figure
     '''
@@ -363,14 +822,24 @@ def plot_states(df, n_bees=1, colors=('red', 'blue', 'yellow', 'green'),
     ax_d_mid = fig.add_subplot(716, sharex=ax_x)
     ax_s = fig.add_subplot(717, sharex=ax_x)
 
-    for traj in df.index.unique():
-        ax_x.plot(df.loc[traj].t.iloc[2:], df.loc[traj].x.iloc[2:])
-        ax_y.plot(df.loc[traj].t.iloc[2:], df.loc[traj].y.iloc[2:])
-        ax_speed.plot(df.loc[traj].t.iloc[2:], df.loc[traj].speed.iloc[2:])
-        ax_angle.plot(df.loc[traj].t.iloc[2:], df.loc[traj].angle.iloc[2:])
-        ax_rotation.plot(df.loc[traj].t.iloc[2:],
-                         df.loc[traj].rotation.iloc[2:])
-        ax_d_mid.plot(df.loc[traj].t.iloc[2:], df.loc[traj].d_mid.iloc[2:])
+    # Leave out the first 2 points of each trajectory
+    traj = df.index.values
+    new = np.append(True, traj[1:] != traj[:-1])
+    starts = np.flatnonzero(new)
+    pos = np.arange(len(traj)) - starts[np.cumsum(new) - 1]
+    rows = np.flatnonzero(pos >= 2)
+    traj = traj[rows]
+    t = df.t.values[rows]
+    trange = (0.0, df.t.max())
+    line_colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    for ax, col in ((ax_x, 'x'), (ax_y, 'y'), (ax_speed, 'speed'),
+                    (ax_angle, 'angle'), (ax_rotation, 'rotation'),
+                    (ax_d_mid, 'd_mid')):
+        v = df[col].values[rows]
+        idx = decimate_series(t, v, traj, buckets=buckets, trange=trange)
+        ax.add_collection(LineCollection(line_segments((t, v), traj, idx),
+                                         colors=line_colors))
+        ax.autoscale_view()
     for row in range(n_bees):
         for state in states:
             ax_s.broken_barh(xranges[row][state], yranges[row],
@@ -412,49 +881,157 @@ def plot_states(df, n_bees=1, colors=('red', 'blue', 'yellow', 'green'),
     return fig
 
 
-def state_props(data, thresh, feature='speed', subsample_factor=1,
-                trange=(0., 86400.), bins=144):
+def thresh_counts(t, values, thresholds, trange=(0., 86400.), bins=144):
     '''
-    Simeseries of proportion of bees who are active in each timebin for
-    each condition.
+    Counts rows above each of many thresholds in each time bin, as
+    thresh_decode and np.histogram would for each threshold, but with one
+    sort of the rows.
+    Args:
+        t - time of each row
+        values - feature value of each row (NaN rows are not counted)
+        thresholds - array of thresholds
+        trange - time range of bins
+        bins - number of time bins
+    Returns:
+        binned_above - array of shape (len(thresholds), bins), rows in each
+                       time bin with value > threshold
+        binned_valid - array of shape (bins, ), rows in each time bin with a
+                       value
+    '''
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+    ok = ~np.isnan(values)
+    t = np.asarray(t, dtype=np.float64)[ok]
+    values = values[ok]
+    n = len(values)
+    order = np.argsort(values, kind='mergesort')
+    # Rows with value <= threshold are the first below[i] in value order
+    below = np.searchsorted(values[order], thresholds, side='right')
+
+    edges = np.linspace(trange[0], trange[1], bins + 1)
+    t = t[order]
+    b = np.searchsorted(edges, t, side='right') - 1
+    b[t == trange[1]] = bins - 1
+    in_range = (b >= 0) & (b < bins)
+    # Composite key of time bin and value rank, so each bin is a sorted run
+    keys = (b.astype(np.int64) * n + np.arange(n))[in_range]
+    keys.sort()
+    bin_starts = np.searchsorted(keys, np.arange(bins + 1) * n)
+    binned_valid = np.diff(bin_starts)
+    binned_below = np.searchsorted(
+        keys, np.arange(bins)[:, np.newaxis] * n + below).T - bin_starts[:-1]
+
+    return binned_valid - binned_below, binned_valid
+
+
+def _read_feature(path, feature, subsample_factor, trange):
+    print 'Loading %s' % path
+    if subsample_factor == 1:
+        return read_traj(path, columns=['t', feature], trange=trange,
+                         index_col=None)
+    df = read_traj(path)
+    print 'Subsampling... Factor: %d' % subsample_factor
+    return sub_calc(df, subsample_factor)
+
+
+def state_props_sweep(data, thresholds, feature='speed', subsample_factor=1,
+                      trange=(0., 86400.), bins=144):
+    '''
+    state_props for a grid of thresholds at once. Each file is read and
+    sorted once (see thresh_counts) rather than once per threshold.
     Args:
-        data - list of lists of trajectory data. First index is for different
-                conditions.
-        thresh - threshold values
+        data - list of lists of trajectory data (csv files or store
+               partitions). First index is for different conditions.
+        thresholds - array of threshold values
         feature - feature to threshold
-        subsample_factor - subsample trajectory data
+        subsample_factor - subsample trajectory data. If 1, only t and
+                           feature are read, from the time range plotted.
         trange - time range to plot. default 24hours
         bins - number of bins - default 144 (10min if 24h range)
     Returns:
-        time_array, list of prop_1 arrays
+        time_array - centres of time bins
+        prop_list - for each condition, array of shape (len(thresholds),
+                    bins) of proportion active in each time bin
+        active_list - for each condition, array of shape (len(thresholds), )
+                      of proportion active over trange
     '''
-    prop_1_list = []
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+    prop_list = []
+    active_list = []
     for cond in range(len(data)):
-        df_list = []
+        above = np.zeros((len(thresholds), bins), dtype=np.int64)
+        valid = np.zeros(bins, dtype=np.int64)
         for path in data[cond]:
-            print 'Loading %s' % path
-            df = pd.read_csv(path, index_col='traj')
-            print 'Subsampling... Factor: %d' % subsample_factor
-            df = sub_calc(df, subsample_factor)
+            df = _read_feature(path, feature, subsample_factor, trange)
             print 'Thresholding...'
-            thresh_decode(df, thresh, feature=feature)
-            df_list.append(df)
+            a, v = thresh_counts(df.t.values, df[feature].values, thresholds,
+                                 trange=trange, bins=bins)
+            above += a
+            valid += v
 
-        print 'Calculating timeseries...'
-        t0_times = np.hstack([df1.t[df1.thresh == 0] for df1 in df_list])
-        t1_times = np.hstack([df1.t[df1.thresh == 1] for df1 in df_list])
-        h_t0, b = np.histogram(t0_times, range=trange, bins=bins)
-        h_t1, b = np.histogram(t1_times, range=trange, bins=bins)
-        prop_1 = h_t1.astype(np.float64) / (h_t0 + h_t1)
-        prop_1_list.append(prop_1)
+        prop_list.append(above.astype(np.float64) / valid)
+        active_list.append(above.sum(axis=1) / float(valid.sum()))
 
+    b = np.linspace(trange[0], trange[1], bins + 1)
     time_array = b[:-1] + 0.5 * (b[1:] - b[:-1])
 
-    return time_array, prop_1_list
+    return time_array, prop_list, active_list
+
+
+def state_props(data, thresh, feature='speed', subsample_factor=1,
+                trange=(0., 86400.), bins=144):
+    '''
+    Simeseries of proportion of bees who are active in each timebin for
+    each condition.
+    Args:
+        data - list of lists of trajectory data (csv files or store
+               partitions). First index is for different conditions.
+        thresh - threshold value (see state_props_sweep for many)
+        feature - feature to threshold
+        subsample_factor - subsample trajectory data. If 1, only t and
+                           feature are read, from the time range plotted.
+        trange - time range to plot. default 24hours
+        bins - number of bins - default 144 (10min if 24h range)
+    Returns:
+        time_array, list of prop_1 arrays
+    '''
+    time_array, prop_list, active_list = state_props_sweep(
+        data, [thresh], feature=feature, subsample_factor=subsample_factor,
+        trange=trange, bins=bins)
+
+    return time_array, [prop[0] for prop in prop_list]
 
 
 def main():
-    pass
+    parser = argparse.ArgumentParser(description='''Decodes the states of
+                                     each condition and day of a processed
+                                     store and saves them in it, with a
+                                     speed threshold ('thresh' column) or a
+                                     Gaussian HMM fitted to the store
+                                     ('state' column).''')
+
+    parser.add_argument('-t', default=None, type=float, metavar='Threshold',
+                        help='Speed threshold. If not given, an HMM is fitted.')
+
+    parser.add_argument('-n', default=2, type=int, metavar='Components',
+                        help='Number of hidden states of the HMM.')
+
+    parser.add_argument('-c', default=None, type=int, nargs='+',
+                        metavar='Condition',
+                        help='Conditions to decode (default all).')
+
+    parser.add_argument('StoreDir', type=str,
+                        help='Root directory of the processed store.')
+
+    args = parser.parse_args()
+
+    model = None
+    if args.t is None:
+        partitions = list_partitions(args.StoreDir)
+        if args.c is not None:
+            partitions = partitions[partitions.condition.isin(args.c)]
+        model = fit_batch(list(partitions.path), n_components=args.n)
+    decode_partitions(args.StoreDir, model=model, threshold=args.t,
+                      conditions=args.c)
 
 if __name__ == '__main__':
     main()
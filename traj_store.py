@@ -0,0 +1,285 @@
+# traj_store.py
+# Partitioned columnar store for processed trajectory and distance data, so
+# readers only decompress the columns and time ranges they need. Layout:
+#     <store>/<kind>/cond=<condition>/date=<yyyy-mm-dd>/
+#         meta.json - columns, dtypes and row groups with min/max statistics
+#         <column>.npz - one compressed array per row group
+
+import io
+import json
+import numpy as np
+import os
+import pandas as pd
+import zipfile
+
+ROW_GROUP_SIZE = 1 << 18
+STATS_COLUMNS = ('t', 'speed')
+
+
+def partition_path(store_dir, kind, condition, date_str):
+    '''
+    Args:
+        store_dir - root directory of store
+        kind - 'trajectory' or 'distance'
+        condition - condition number
+        date_str - date in format YYYY-MM-DD
+    Returns:
+        path of partition directory
+    '''
+    return os.path.join(store_dir, kind, 'cond=%s' % condition,
+                        'date=%s' % date_str)
+
+
+def list_partitions(store_dir, kind='trajectory'):
+    '''
+    Lists the partitions of a store.
+    Returns:
+        DataFrame with columns 'condition', 'date' (YYYY-MM-DD) and 'path',
+        sorted by condition and date
+    '''
+    rows = []
+    kind_dir = os.path.join(store_dir, kind)
+    if os.path.isdir(kind_dir):
+        for cond_name in os.listdir(kind_dir):
+            if not cond_name.startswith('cond='):
+                continue
+            cond_dir = os.path.join(kind_dir, cond_name)
+            for date_name in os.listdir(cond_dir):
+                path = os.path.join(cond_dir, date_name)
+                if (date_name.startswith('date=') and
+                        os.path.isfile(os.path.join(path, 'meta.json'))):
+                    rows.append((int(cond_name[5:]), date_name[5:], path))
+
+    return pd.DataFrame(sorted(rows), columns=['condition', 'date', 'path'])
+
+
+def is_partition(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'meta.json'), 'r') as in_file:
+        return json.load(in_file)
+
+
+def _write_meta(path, meta):
+    meta_path = os.path.join(path, 'meta.json')
+    with open(meta_path + '.tmp', 'w') as out_file:
+        json.dump(meta, out_file, indent=1, sort_keys=True)
+    os.rename(meta_path + '.tmp', meta_path)
+
+
+def _write_array(zf, name, a):
+    '''
+    Adds an array to an open npz (zip) file as <name>.npy.
+    '''
+    buf = io.BytesIO()
+    np.lib.format.write_array(buf, np.ascontiguousarray(a),
+                              allow_pickle=False)
+    zf.writestr(name + '.npy', buf.getvalue())
+
+
+def _min_max(a):
+    finite = a[~np.isnan(a)] if a.dtype.kind == 'f' else a
+    if len(finite) == 0:
+        return None
+    return [float(finite.min()), float(finite.max())]
+
+
+def write_partition(df, path, row_group_size=ROW_GROUP_SIZE, append=False):
+    '''
+    Writes a DataFrame to a partition. A named index (eg. 'traj') is stored
+    as a column.
+    Args:
+        df - DataFrame of numeric columns
+        path - partition directory
+        row_group_size - rows per row group
+        append - add df as new row groups of an existing partition (must have
+                 the same columns, apart from columns added by write_column,
+                 which are filled with NaN, or -1 for integer columns)
+    Returns:
+        None
+    '''
+    if df.index.name is not None:
+        df = df.reset_index()
+    columns = [str(c) for c in df.columns]
+    if append and is_partition(path):
+        meta = read_meta(path)
+        added = [c for c in meta['columns'] if c not in columns]
+        assert set(columns) | set(added) == set(meta['columns'])
+        if len(added) > 0:
+            df = df.copy()
+            for c in added:
+                dtype = np.dtype(meta['dtypes'][c])
+                df[c] = np.full(len(df), np.nan if dtype.kind == 'f' else -1,
+                                dtype=dtype)
+        columns = meta['columns']
+        mode = 'a'
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for f in os.listdir(path):
+            os.remove(os.path.join(path, f))
+        meta = {'columns': columns,
+                'dtypes': dict((c, df[c].dtype.str) for c in columns),
+                'rows': 0, 'row_groups': []}
+        mode = 'w'
+
+    zfs = dict((c, zipfile.ZipFile(os.path.join(path, c + '.npz'), mode,
+                                   zipfile.ZIP_DEFLATED, True))
+               for c in columns)
+    for start in range(0, len(df), row_group_size):
+        stop = min(start + row_group_size, len(df))
+        name = 'rg%05i' % len(meta['row_groups'])
+        row_group = {'rows': stop - start}
+        for c in columns:
+            a = df[c].values[start:stop]
+            _write_array(zfs[c], name, a)
+            if c in STATS_COLUMNS:
+                row_group[c] = _min_max(a)
+        meta['row_groups'].append(row_group)
+        meta['rows'] += stop - start
+    for zf in zfs.values():
+        zf.close()
+    _write_meta(path, meta)
+
+    return None
+
+
+def write_column(path, name, values):
+    '''
+    Adds a column to a partition, or replaces it (eg. decoded states from
+    traj_hmm.decode_partition). The column is split into the partition's row
+    groups, and listed in meta.json once its file is complete.
+    Args:
+        path - partition directory
+        name - column name
+        values - array with a value for each row of the partition
+    Returns:
+        None
+    '''
+    meta = read_meta(path)
+    values = np.asarray(values)
+    assert len(values) == meta['rows']
+    col_path = os.path.join(path, name + '.npz')
+    with zipfile.ZipFile(col_path + '.tmp', 'w', zipfile.ZIP_DEFLATED,
+                         True) as zf:
+        start = 0
+        for i, row_group in enumerate(meta['row_groups']):
+            stop = start + row_group['rows']
+            _write_array(zf, 'rg%05i' % i, values[start:stop])
+            if name in STATS_COLUMNS:
+                row_group[name] = _min_max(values[start:stop])
+            start = stop
+    os.rename(col_path + '.tmp', col_path)
+    if name not in meta['columns']:
+        meta['columns'].append(name)
+    meta['dtypes'][name] = values.dtype.str
+    _write_meta(path, meta)
+
+    return None
+
+
+def truncate_partition(path, rows):
+    '''
+    Removes row groups appended after the partition had rows rows (eg. by an
+    append that was not committed). Column files are rewritten only if they
+    contain row groups beyond those kept.
+    Args:
+        path - partition directory
+        rows - number of rows to keep, at a row group boundary
+    Returns:
+        None
+    '''
+    meta = read_meta(path)
+    kept = np.cumsum([0] + [rg['rows'] for rg in meta['row_groups']])
+    n_groups = int(np.searchsorted(kept, rows))
+    assert n_groups < len(kept) and kept[n_groups] == rows
+    # Meta first, so an interruption leaves extra entries rather than row
+    # groups without data
+    if n_groups < len(meta['row_groups']):
+        meta['row_groups'] = meta['row_groups'][:n_groups]
+        meta['rows'] = rows
+        _write_meta(path, meta)
+    names = set('rg%05i.npy' % i for i in range(n_groups))
+    for c in meta['columns']:
+        col_path = os.path.join(path, c + '.npz')
+        with zipfile.ZipFile(col_path, 'r') as zf:
+            if set(zf.namelist()) <= names:
+                continue
+            with zipfile.ZipFile(col_path + '.tmp', 'w', zipfile.ZIP_DEFLATED,
+                                 True) as out_zf:
+                for name in sorted(names):
+                    out_zf.writestr(name, zf.read(name))
+        os.rename(col_path + '.tmp', col_path)
+
+    return None
+
+
+def _overlaps(row_group, ranges):
+    for c, (lo, hi) in ranges.items():
+        if c not in row_group:
+            continue
+        if row_group[c] is None:
+            return False
+        if lo is not None and row_group[c][1] < lo:
+            return False
+        if hi is not None and row_group[c][0] >= hi:
+            return False
+
+    return True
+
+
+def iter_row_groups(path, columns=None, ranges=None):
+    '''
+    Reads a partition one row group at a time. Only the requested columns are
+    decompressed, and row groups outside ranges are skipped using their
+    statistics.
+    Args:
+        path - partition directory
+        columns - columns to read, by default all
+        ranges - dictionary of column: (lo, hi). Only rows with
+                 lo <= value < hi are returned, None is unbounded.
+    Yields:
+        DataFrame for each row group with rows in ranges
+    '''
+    meta = read_meta(path)
+    columns = meta['columns'] if columns is None else list(columns)
+    ranges = ranges or {}
+    needed = columns + [c for c in ranges if c not in columns]
+    files = dict((c, np.load(os.path.join(path, c + '.npz'))) for c in needed)
+    try:
+        for i, row_group in enumerate(meta['row_groups']):
+            if not _overlaps(row_group, ranges):
+                continue
+            name = 'rg%05i' % i
+            data = dict((c, files[c][name]) for c in needed)
+            if len(ranges) > 0:
+                mask = np.ones(row_group['rows'], dtype=bool)
+                for c, (lo, hi) in ranges.items():
+                    if lo is not None:
+                        mask &= data[c] >= lo
+                    if hi is not None:
+                        mask &= data[c] < hi
+                data = dict((c, data[c][mask]) for c in columns)
+            yield pd.DataFrame(data, columns=columns)
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def read_partition(path, columns=None, ranges=None):
+    '''
+    Reads a partition (see iter_row_groups).
+    Returns:
+        DataFrame with a default index
+    '''
+    df_list = list(iter_row_groups(path, columns=columns, ranges=ranges))
+    if len(df_list) == 0:
+        meta = read_meta(path)
+        columns = meta['columns'] if columns is None else list(columns)
+        return pd.DataFrame(dict(
+            (c, np.array([], dtype=meta['dtypes'][c])) for c in columns),
+            columns=columns)
+
+    return pd.concat(df_list, ignore_index=True)
@@ -0,0 +1,332 @@
+# transfer.py
+# Pulls movies from the cameras to the server concurrently, verifying checksums
+# before deleting them from the cameras.
+
+import argparse
+import hashlib
+from metadata import NAME_RE
+from multiprocessing.pool import ThreadPool
+import os
+import pipes
+import Queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+CHUNK_SIZE = 1 << 20
+
+
+def file_md5(path, md5=None):
+    '''
+    Computes md5 checksum of a file.
+    Args:
+        path - path of file
+        md5 - hashlib md5 object to update, by default a new one
+    Returns:
+        updated md5 object
+    '''
+    if md5 is None:
+        md5 = hashlib.md5()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(CHUNK_SIZE), ''):
+            md5.update(chunk)
+
+    return md5
+
+
+def is_movie(name):
+    '''
+    Returns True if name is a movie filename (see metadata.NAME_RE).
+    '''
+    m = NAME_RE.match(name)
+    return m is not None and m.group('scale') is None
+
+
+class LocalSource:
+    '''
+    Camera movie directory on this machine. Stands in for a camera when
+    testing, or can be used with a network mount.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+
+    def list(self):
+        '''
+        Returns:
+            dictionary with movie names as keys and (size, mtime) as values
+        '''
+        listing = {}
+        for f in os.listdir(self.path):
+            if is_movie(f):
+                st = os.stat(os.path.join(self.path, f))
+                listing[f] = (st.st_size, st.st_mtime)
+        return listing
+
+    def open(self, name, offset=0):
+        '''
+        Opens a movie for reading from byte offset.
+        '''
+        in_file = open(os.path.join(self.path, name), 'rb')
+        in_file.seek(offset)
+        return in_file
+
+    def checksum(self, name):
+        return file_md5(os.path.join(self.path, name)).hexdigest()
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, name))
+
+
+class ProcessReader:
+    '''
+    File-like wrapper around the stdout of a process, raising an error on
+    close if the process failed.
+    '''
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def read(self, size):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise IOError('%s exited with %s' % (' '.join(self.cmd),
+                                                 self.proc.returncode))
+
+
+class SSHSource:
+    '''
+    Camera reached with ssh. Requires key-based login.
+    '''
+    def __init__(self, host, path):
+        self.host = host
+        self.path = path
+        self.name = '%s:%s' % (host, path)
+
+    def _path(self, name):
+        return pipes.quote(os.path.join(self.path, name))
+
+    def _ssh(self, command):
+        return subprocess.check_output(['ssh', self.host, command])
+
+    def list(self):
+        '''
+        Returns:
+            dictionary with movie names as keys and (size, mtime) as values
+        '''
+        out = self._ssh('cd %s && stat -c "%%n %%s %%Y" raspberrypi* '
+                        '2>/dev/null; true' % pipes.quote(self.path))
+        listing = {}
+        for line in out.splitlines():
+            parts = line.split()
+            if len(parts) == 3 and is_movie(parts[0]):
+                listing[parts[0]] = (int(parts[1]), float(parts[2]))
+        return listing
+
+    def open(self, name, offset=0):
+        '''
+        Streams a movie from byte offset.
+        '''
+        return ProcessReader(['ssh', self.host, 'tail -c +%i %s' % (
+            offset + 1, self._path(name))])
+
+    def checksum(self, name):
+        return self._ssh('md5sum %s' % self._path(name)).split()[0]
+
+    def remove(self, name):
+        self._ssh('rm %s' % self._path(name))
+
+
+def parse_source(spec):
+    '''
+    Creates a source from a command line specification.
+    Args:
+        spec - local directory, or host:path for a camera reached with ssh
+    Returns:
+        LocalSource or SSHSource
+    '''
+    if ':' in spec and not os.path.isdir(spec):
+        host, path = spec.split(':', 1)
+        return SSHSource(host, path)
+
+    return LocalSource(spec)
+
+
+def transfer_file(source, name, dest_dir):
+    '''
+    Copies a movie from source into dest_dir and deletes it from source once
+    the checksums match. Data is written to <name>.part, so an interrupted
+    transfer resumes from the end of the partial file.
+    Args:
+        source - LocalSource or SSHSource
+        name - movie filename
+        dest_dir - directory to copy to
+    Returns:
+        path of copied movie, or None if checksums did not match. A copy with
+        a bad checksum (partial, or complete but not yet deleted from source)
+        is removed so it is copied again from the start next time.
+    '''
+    final_path = os.path.join(dest_dir, name)
+    part_path = final_path + '.part'
+    checksum = None
+
+    if os.path.exists(final_path):
+        # Copied previously but not deleted from source
+        checksum = source.checksum(name)
+        if file_md5(final_path).hexdigest() == checksum:
+            source.remove(name)
+            return final_path
+        os.remove(final_path)
+
+    offset = 0
+    md5 = hashlib.md5()
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        file_md5(part_path, md5)
+    in_file = source.open(name, offset)
+    with open(part_path, 'ab') as out_file:
+        for chunk in iter(lambda: in_file.read(CHUNK_SIZE), ''):
+            md5.update(chunk)
+            out_file.write(chunk)
+    in_file.close()
+
+    if checksum is None:
+        checksum = source.checksum(name)
+    if md5.hexdigest() != checksum:
+        os.remove(part_path)
+        return None
+
+    os.rename(part_path, final_path)
+    source.remove(name)
+
+    return final_path
+
+
+class Transfer:
+    '''
+    Pulls movies from several sources into one directory with a bounded number
+    of concurrent connections. Each completed movie is put on self.queue (and
+    passed to on_complete) as soon as it has been verified, so tracking can
+    start immediately.
+    '''
+    def __init__(self, sources, dest_dir, connections=4, min_age=60.0,
+                 on_complete=None):
+        self.sources = sources
+        self.dest_dir = dest_dir
+        self.connections = connections
+        self.min_age = min_age
+        self.on_complete = on_complete
+        self.queue = Queue.Queue()
+        self.pool = ThreadPool(connections)
+
+    def _list(self, source):
+        try:
+            return source.list()
+        except (IOError, OSError, subprocess.CalledProcessError):
+            print 'Could not list %s' % source.name
+            return {}
+
+    def _transfer(self, task):
+        source, name = task
+        try:
+            return source, name, transfer_file(source, name, self.dest_dir), \
+                None
+        except Exception:
+            return source, name, None, traceback.format_exc()
+
+    def poll(self):
+        '''
+        Lists all sources and transfers every movie which has not been
+        modified for min_age seconds (movies still being recorded are left).
+        Returns:
+            list of paths of movies transferred
+        '''
+        listings = self.pool.map(self._list, self.sources)
+        now = time.time()
+        tasks = []
+        for source, listing in zip(self.sources, listings):
+            for name in sorted(listing):
+                if now - listing[name][1] >= self.min_age:
+                    tasks.append((source, name))
+
+        done = []
+        for source, name, path, error in self.pool.imap_unordered(
+                self._transfer, tasks):
+            if error is not None:
+                print 'FAILED %s %s\n%s' % (source.name, name, error)
+            elif path is None:
+                print 'Checksum mismatch %s %s, will retry' % (source.name,
+                                                                name)
+            else:
+                print '%s %s -> %s' % (source.name, name, path)
+                done.append(path)
+                self.queue.put(path)
+                if self.on_complete is not None:
+                    self.on_complete(path)
+            sys.stdout.flush()
+
+        return done
+
+    def run(self, interval=60.0):
+        '''
+        Polls sources every interval seconds. If interval <= 0, polls once.
+        '''
+        while 1:
+            self.poll()
+            if interval <= 0:
+                break
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Pull movies from cameras,
+                                     deleting them from the cameras once their
+                                     checksums have been verified.''')
+
+    parser.add_argument('-j', default=4, type=int, metavar='Connections',
+                        help='Maximum concurrent transfers (default 4).')
+
+    parser.add_argument('-a', default=60.0, type=float, metavar='MinAge',
+                        help='''Only transfer movies not modified for this
+                        many seconds (default 60).''')
+
+    parser.add_argument('-i', default=0.0, type=float, metavar='Interval',
+                        help='''Poll cameras every Interval seconds. By
+                        default poll once and exit.''')
+
+    parser.add_argument('-e', default=None, type=str, metavar='Command',
+                        help='''Command run for each transferred movie, with
+                        {} replaced by its path, eg. to start tracking.''')
+
+    parser.add_argument('DestDir', type=str,
+                        help='Directory to copy movies to.')
+
+    parser.add_argument('Sources', type=str, nargs='+',
+                        help='''Camera movie directories, as host:path for
+                        cameras reached with ssh, or local directories.''')
+
+    args = parser.parse_args()
+
+    on_complete = None
+    if args.e is not None:
+        def run_command(path):
+            subprocess.call(args.e.replace('{}', pipes.quote(path)),
+                            shell=True)
+
+        def on_complete(path):
+            # Runs in its own thread, which waits for (reaps) the command
+            thread = threading.Thread(target=run_command, args=(path,))
+            thread.start()
+
+    transfer = Transfer([parse_source(s) for s in args.Sources], args.DestDir,
+                        connections=args.j, min_age=args.a,
+                        on_complete=on_complete)
+    transfer.run(args.i)
+
+if __name__ == '__main__':
+    main()